@@ -1,8 +1,24 @@
-from dash import Dash, dcc, html, Input, Output, callback, callback_context
+from dash import Dash, dcc, html, Input, Output, State, ALL, Patch, callback, callback_context, no_update
+from dash.exceptions import MissingCallbackContextException, PreventUpdate
+from flask import jsonify, request
 import os
+import sys
 import numpy as np
 import pandas as pd
-from ChannelAttribution import *
+from models import ModelCache, run_models, models_from_counts, markov_tag
+from jobs import JobManager
+from bootstrap import bootstrap_intervals
+from preview import preview_models
+from data_loader import load_compact, load_users
+from users import parse_user_ids
+from parallel import worker_count
+from compact import CHANNEL_NAMES
+from aggregates import touch_stats, channel_count_stats
+from ingest import FILTERS, Snapshot, SnapshotStore
+from trie import END
+from export import load_artifacts
+from metrics import Metrics
+from payload import FigureCompactor, compress_responses, slim_template, typed_arrays_enabled
 import plotly.io as pio
 import plotly.express as px
 import plotly.graph_objects as go
@@ -27,6 +43,7 @@ conv_colors = {
 
 model_colors = {
     'markov_model':'#8900e1', #Ultra Violet
+    'shapley':'#57068c', #NYU Violet
     'linear_touch':'#6d6d6d', #Medium Gray 1
     'last_touch':'#b8b8b8', #Medium Gray 2
     'first_touch':'#d6d6d6', # Medium Gray 3
@@ -35,16 +52,46 @@ model_colors = {
 ### ----- ----- ----- ----- -----
 ### -----  load the data -----
 ### ----- ----- ----- ----- -----
-Data = pd.read_csv('MTA_Input.csv')
+## MTA_CACHE_PATH: columnar cache of the CSV + derived columns
+## (defaults to MTA_Input.feather, rebuilt whenever the CSV changes)
+## Paths holds the rows compactly: int8 channel codes of every path in one
+## flat array with offsets, int8 first/last touch codes and int32 counts
+## PREPROCESS_WORKERS: processes parsing the CSV into the cache and building
+## the cube, each on a contiguous slice of the rows (0 = every core, default 1;
+## the results are identical to the serial ones, see parallel.py)
+preprocess_workers = worker_count(os.environ.get('PREPROCESS_WORKERS', 1))
+Paths = load_compact('MTA_Input.csv', cache_path = os.environ.get('MTA_CACHE_PATH'),
+                     workers = preprocess_workers)
 #channel = pd.read_csv("NintendoMapping.csv")
-
-# some counting
-Data['channels_count'] = Data.str_path.apply(lambda x: x.count("&"))
-Data['users_count'] = Data.user_id.apply(lambda x: x.count(" ")+1)
-
-unique_channel_cnt = Data.channels_count.sort_values().unique()
-
-df = Data.groupby(['first_touch','last_touch']).agg(
+## USER_INDEX: set to 1 to build the index from user ID to rows behind the
+## Cohort Lookup tab and /cohort (users.py; built once into
+## MTA_Input.users.feather next to the cache, memory-mapped on later starts).
+## Off by default: it lets anyone with the dashboard look up single users
+user_index = load_users('MTA_Input.csv', cache_path = os.environ.get('MTA_CACHE_PATH')) \
+    if os.environ.get('USER_INDEX', '0') == '1' else None
+
+## MTA_ARTIFACTS: folder written by `python export.py` (headless export of
+## every output); when it was exported from the current MTA_Input.csv its
+## cube is used as is, and its model results fill the model cache below
+artifacts = load_artifacts(os.environ['MTA_ARTIFACTS']) if os.environ.get('MTA_ARTIFACTS') else None
+if artifacts is not None and not artifacts.matches_source('MTA_Input.csv'):
+    print('MTA_ARTIFACTS was exported from another MTA_Input.csv, ignoring it', file=sys.stderr)
+    artifacts = None
+
+## the rows indexed by channel count and the aggregate cube of
+## converters/nonconverters by (channels_count, first_touch, last_touch);
+## any selection of channel counts merges the buckets of its counts, and
+## all figures except the models are answered from the cube slices.
+## Callbacks read them from data_store.current, which ingested batches replace
+data_store = SnapshotStore(Snapshot(Paths, artifacts.cube, artifacts.fingerprint, users = user_index) if artifacts
+                           else Snapshot.build(Paths, workers = preprocess_workers, users = user_index))
+
+unique_channel_cnt = np.unique(Paths.channels_count)
+first_touch_names = list(CHANNEL_NAMES[pd.unique(Paths.first_touch)])
+last_touch_names = list(CHANNEL_NAMES[pd.unique(Paths.last_touch)])
+channel_names = list(CHANNEL_NAMES[np.unique(Paths.codes)])
+
+df = data_store.current.cube.groupby(['first_touch','last_touch'], observed=True).agg(
         conv = pd.NamedAgg(column= 'converters', aggfunc='sum'), 
         nonconv = pd.NamedAgg(column= 'nonconverters', aggfunc='sum'),
         )
@@ -52,31 +99,81 @@ df['cnt'] = df.conv + df.nonconv
 df = df.reset_index()
 df = df[df['first_touch'].isin(['Awareness Search Ads'])]
 
-# function to convert str_path to the required format for ChannelAttribute
-def str_to_path(str_path):
-## creat mapping for channel names
-    channel_map = {'A_FTV-DIS':'Awareness Fire TV Display Ads',
-    'A_SA': 'Awareness Search Ads',
-    'C_OLV': 'Consideration Online Video Ads',
-    'C_DSP-DIS': 'Consideration DSP Display Ads',
-    'P_DSP-DIS': 'Purchase DSP Display Ads',
-    'P_SP': 'Purchase Sponsored Products Ads',
-    'P_OO-SA': 'Purchase O&O Search Ads'}
-
-    touchpoints = str_path.split("@")
-    arr = [None] * len(touchpoints)
-    for tp in touchpoints:
-        i, ch = tp.split('&')
-        i = int(i) - 1
-        arr[i] = channel_map[ch]
-    return " > ".join(str(x) for x in arr)
+## INGEST_DIR: folder polled for new batch CSVs (same columns as MTA_Input.csv)
+## that are appended to the data without a restart; a file that fails to
+## parse is logged once and skipped until it is replaced
+## INGEST_INTERVAL: seconds between two polls of INGEST_DIR
+ingest_dir = os.environ.get('INGEST_DIR')
+ingest_interval = float(os.environ.get('INGEST_INTERVAL', 60))
 
-## replace path_clean with the format for ChannelAttibute
-Data["path_clean"] = Data.str_path.apply(str_to_path)
 
-
-Data_One = Data[Data['channels_count'] == 1]
-Data_TwoMore = Data[Data['channels_count'] != 1]
+### ----- ----- ----- ----- -----
+### ----- model result cache -----
+### ----- ----- ----- ----- -----
+## MODEL_CACHE_SIZE: max number of (dataset, filter) results kept in memory
+## MODEL_CACHE_DIR: optional folder shared by workers / restarts
+## MODEL_CACHE_WARMUP: set to 0 to skip fitting the built-in filters at startup
+## MODEL_ENGINE: 'ChannelAttribution' (default) or 'native' (attribution.py)
+## MODEL_MARKOV_ORDER: order of the Markov model, 'heldout' (default, best
+## held-out likelihood), 'auto' (penalized ROC AUC like ChannelAttribution's
+## auto_markov_model), 'variable' (variable-order context tree, native engine
+## only) or a fixed order
+## MODEL_MARKOV_MAX_ORDER: highest order tried / longest variable-order context
+## MODEL_MARKOV_MIN_COUNT: users a context needs to be kept in the variable-order model
+## (benchmarks/bench_orders.py reports time, memory and likelihood per order)
+markov_options = dict(order = os.environ.get('MODEL_MARKOV_ORDER', 'heldout'),
+                      max_order = int(os.environ.get('MODEL_MARKOV_MAX_ORDER', 10)),
+                      min_count = int(os.environ.get('MODEL_MARKOV_MIN_COUNT', 100)))
+model_cache = ModelCache(maxsize = int(os.environ.get('MODEL_CACHE_SIZE', 8)),
+                         cache_dir = os.environ.get('MODEL_CACHE_DIR') or None,
+                         engine = os.environ.get('MODEL_ENGINE', 'ChannelAttribution'),
+                         markov = markov_options)
+
+## with the native engine and a fixed MODEL_MARKOV_ORDER the model tab is
+## solved from additive counts kept per snapshot (attribution.ModelCounts):
+## after an ingest only the new batch is counted, nothing is refitted on the
+## distinct paths. 'auto' / 'heldout' choose the order on all paths and
+## 'variable' contexts depend on all paths, so those refit every time
+counted_order = int(markov_options['order']) \
+    if model_cache.engine == 'native' and str(markov_options['order']).isdigit() else None
+
+if artifacts is not None and artifacts.matches_models(model_cache.engine, markov_options):
+    for f in artifacts.filters:
+        model_cache.store(artifacts.fingerprint, f, artifacts.models(f))
+        intervals = artifacts.intervals(f)
+        if intervals is not None:
+            model_cache.store(artifacts.fingerprint, f + '-bootstrap', intervals)
+elif os.environ.get('MODEL_CACHE_WARMUP', '1') != '0':
+    model_cache.warm_up(data_store.current.fingerprint,
+                        {f: data_store.current.model_input(f) for f in FILTERS})
+
+## MODEL_BACKGROUND: set to 0 to fit models inside the callback again
+## MODEL_WORKERS: size of the process pool fitting the models
+model_jobs = JobManager(max_workers = int(os.environ.get('MODEL_WORKERS', 2))) \
+    if os.environ.get('MODEL_BACKGROUND', '1') != '0' else None
+
+## PREVIEW_SAMPLE: journeys of the stratified sample drawn at load time
+## (preview.py); while the exact models of a larger filter are fitted, the
+## model tab shows them fitted on the sample with 95% bounds (0 to disable)
+## PREVIEW_REPLICATES: independent replicates the sample is split into
+## PREVIEW_MAX_ORDER: highest Markov order of the preview fits
+## (benchmarks/bench_preview.py reports error and time per sample size)
+preview_options = dict(size = int(os.environ.get('PREVIEW_SAMPLE', 50_000)),
+                       replicates = int(os.environ.get('PREVIEW_REPLICATES', 5)),
+                       max_order = int(os.environ.get('PREVIEW_MAX_ORDER', 3)))
+if model_jobs is not None and preview_options['size'] > 0:
+    data_store.current.preview_sample(preview_options['size'], preview_options['replicates'])
+
+## BOOTSTRAP_RESAMPLES: resample budget of the model confidence intervals
+## BOOTSTRAP_TIME_LIMIT: seconds after which the intervals use the resamples done so far
+## BOOTSTRAP_WORKERS: processes refitting the resamples, per bootstrap job
+## (defaults to MODEL_WORKERS, 0 for all cores). A bootstrap job runs in a MODEL_WORKERS
+## process and starts BOOTSTRAP_WORKERS more, so a server can run up to
+## GUNICORN_WORKERS x MODEL_WORKERS x (1 + BOOTSTRAP_WORKERS) model processes at once
+bootstrap_options = dict(n_resamples = int(os.environ.get('BOOTSTRAP_RESAMPLES', 200)),
+                         time_limit = float(os.environ.get('BOOTSTRAP_TIME_LIMIT', 60)),
+                         max_workers = int(os.environ.get('BOOTSTRAP_WORKERS', os.environ.get('MODEL_WORKERS', 2))),
+                         markov = markov_options)
 
 
 
@@ -89,8 +186,46 @@ Data_TwoMore = Data[Data['channels_count'] != 1]
 
 #app = Dash(__name__)
 app = Dash(prevent_initial_callbacks="initial_duplicate")
+## WSGI entry point: gunicorn -c gunicorn.conf.py Dashboard:server
 server = app.server
 
+## figure payloads (payload.py; benchmarks/bench_payload.py reports the
+## bytes of every figure callback):
+## RESPONSE_COMPRESSION: brotli (with the brotli package) or gzip responses
+## for the clients accepting them, 0 to leave it to a proxy in front
+## FIGURE_TYPED_ARRAYS: numeric figure arrays as base64 typed arrays,
+## 'auto' (default: when the plotly.js bundled with dash reads them), 1 or 0
+## FIGURE_TEMPLATE: plotly template of the figures, 'adflow' (default, the
+## 'plotly' look without the defaults of unused trace types) or any plotly one
+if os.environ.get('RESPONSE_COMPRESSION', '1') != '0':
+    compress_responses(server)
+figure_payload = FigureCompactor(typed_arrays = typed_arrays_enabled(os.environ.get('FIGURE_TYPED_ARRAYS', 'auto')))
+pio.templates['adflow'] = slim_template()
+pio.templates.default = os.environ.get('FIGURE_TEMPLATE', 'adflow')
+
+## per-callback compute / figure / serialize seconds, (uncompressed) payload size and
+## (optionally) peak allocation, in Prometheus format on /metrics
+## METRICS_MEMORY: set to 1 to trace allocations (slows every callback)
+## METRICS_PROFILE: set to 1 to enable the sampling profiler: /metrics/profile, and callback
+## requests with an X-Profile: 1 header (see metrics.py)
+## METRICS_PROFILE_SECONDS: longest profile, capped at a quarter of GUNICORN_TIMEOUT
+## METRICS_PROFILE_TOKEN: if set, profiling needs an X-Profile-Token header with this value
+metrics = Metrics(track_memory = os.environ.get('METRICS_MEMORY', '0') == '1',
+                  profile = os.environ.get('METRICS_PROFILE', '0') == '1',
+                  profile_seconds = min(float(os.environ.get('METRICS_PROFILE_SECONDS', 10)),
+                                        int(os.environ.get('GUNICORN_TIMEOUT', 120)) / 4),
+                  profile_token = os.environ.get('METRICS_PROFILE_TOKEN') or None)
+metrics.init_app(server)
+
+## the ingest thread is started per worker process on its first request
+## (threads do not survive gunicorn's fork)
+ingest_watcher = {}
+
+@server.before_request
+def start_ingest_watcher():
+    if ingest_dir and os.getpid() not in ingest_watcher:
+        ingest_watcher[os.getpid()] = data_store.watch(ingest_dir, ingest_interval)
+
 
 header_L = html.Div([
     html.H1(
@@ -121,18 +256,18 @@ header_R = html.Div([
                 'full':'Full Set',
                 'One':'1 Channel only',
                 'Two':'>2 Channels',
-                #'custom':'Custom',
+                'custom':'Custom',
                 },
             value='full', 
             id = 'filter_channel'
         ), 
-        # dcc.Checklist(
-        #     options=unique_channel_cnt,
-        #     value=unique_channel_cnt,
-        #     inline = True, 
-        #     id = 'filter_channel_cnt',
-        #     #style={'display': 'flex', 'flexDirection': 'row'}
-        # ),
+        dcc.Checklist(
+            options=[int(c) for c in unique_channel_cnt],
+            value=[int(c) for c in unique_channel_cnt],
+            inline = True, 
+            id = 'filter_channel_cnt',
+            #style={'display': 'flex', 'flexDirection': 'row'}
+        ),
         #dcc.Store(id='Data_filtered_ch_cnt')
     ],style={})
 ])
@@ -212,8 +347,8 @@ Conv_filter = html.Div([
 First_filter = html.Div([
     html.Div('First Touch'),
     dcc.Checklist(
-        options=Data.first_touch.unique(), 
-        value=Data.first_touch.unique(), 
+        options=first_touch_names, 
+        value=first_touch_names, 
         id = 'filter-First', 
     ), 
 ])
@@ -221,8 +356,8 @@ First_filter = html.Div([
 Last_filter = html.Div([
     html.Div('Last Touch'),
     dcc.Checklist(
-        options=Data.last_touch.unique(), 
-        value=Data.last_touch.unique(), 
+        options=last_touch_names, 
+        value=last_touch_names, 
         id = 'filter-Last', 
     ), 
 ])
@@ -236,10 +371,85 @@ Tab_Sankey = html.Div([
 
 ## Tab for model output
 Tab_model = html.Div([
+    dcc.Checklist(id='model-ci',
+                  options={'bootstrap':'Bootstrap 95% confidence intervals'},
+                  value=[], inline=True),
+    html.Div(id='model-status', style={'color': colors['header']}),
+    dcc.Interval(id='model-poll', interval=1000, disabled=True),
     dcc.Graph(id='fig-model', style={'height':'700px', 'width':'1024px'})
 ])
 
 
+## Tab for the path explorer: the most frequent continuations of a path
+## prefix (data_store.current.trie); clicking a bar extends the prefix
+Explorer_filter = html.Div([
+    html.Div('Show top'),
+    dcc.Dropdown(options=[5, 10, 20], value=10, clearable=False, id='explorer-top'),
+    html.Br(),
+    html.Div('Rank by'),
+    dcc.RadioItems(
+        options={'converters':'Conversions', 'journeys':'Journeys', 'conversion_pct':'Conversion rate'},
+        value='converters',
+        id='explorer-sort',
+    ),
+    html.Br(),
+    html.Button('Back', id='explorer-up'),
+    html.Button('Reset', id='explorer-reset'),
+    dcc.Store(id='explorer-prefix', data=[]),
+], style={'width': '200px'})
+
+## Tab for the budget simulator: one slider per channel scaling the
+## transitions into it (0 removes the channel, 2 doubles it)
+Budget_filter = html.Div([
+    html.Div([
+        html.Div(name),
+        dcc.Slider(min=0, max=2, step=0.05, value=1,
+                   marks={0:'off', 0.5:'-50%', 1:'now', 1.5:'+50%', 2:'x2'},
+                   id={'type': 'budget-scale', 'channel': name}),
+    ]) for name in channel_names
+] + [html.Button('Reset', id='budget-reset')], style={'width': '400px'})
+
+Tab_budget = html.Div([
+    Budget_filter,
+    html.Div([
+        html.Div(id='budget-total', style={'color': colors['header']}),
+        dcc.Graph(id='fig-budget', style={'height':'500px', 'width':'900px'}),
+        dcc.Graph(id='fig-budget-response', style={'height':'400px', 'width':'900px'}),
+    ]),
+], style={'display': 'flex', 'flexDirection': 'row'}
+)
+
+
+Tab_explorer = html.Div([
+    Explorer_filter,
+    html.Div([
+        html.Div(id='explorer-path', style={'color': colors['header']}),
+        dcc.Graph(id='fig-explorer', style={'height':'700px', 'width':'1024px'}),
+    ]),
+], style={'display': 'flex', 'flexDirection': 'row'}
+)
+
+
+## Tab for a cohort of users: their journeys and the attribution models
+## fitted on them (data_store.current.users, the index from user ID to rows)
+Cohort_filter = html.Div([
+    html.Div('User IDs'),
+    dcc.Textarea(id='cohort-users', placeholder='separated by spaces, commas or new lines',
+                 style={'width': '100%', 'height': '300px'}),
+    html.Button('Look up', id='cohort-lookup'),
+], style={'width': '250px'})
+
+Tab_cohort = html.Div([
+    Cohort_filter,
+    html.Div([
+        html.Div(id='cohort-status', style={'color': colors['header']}),
+        dcc.Graph(id='fig-cohort', style={'height':'500px', 'width':'1024px'}),
+        dcc.Graph(id='fig-cohort-model', style={'height':'500px', 'width':'1024px'}),
+    ]),
+], style={'display': 'flex', 'flexDirection': 'row'}
+)
+
+
 
 ### ----- ----- ----- -----
 ### ----- Final Layout -----
@@ -247,12 +457,19 @@ Tab_model = html.Div([
 
 app.layout = html.Div(style={'backgroundColor': colors['background']}, children=[
     header,
-    dcc.Tabs([
-        dcc.Tab(label="Summary", children= Tab_summary), 
-        dcc.Tab(label="Flow Sankey", children= Tab_Sankey),
-        dcc.Tab(label="Touch Points Analysis", children= Tab_touch),
-        dcc.Tab(label="Conversions in the models", children=Tab_model)
-    ])
+    dcc.Tabs(id = 'tabs', value = 'summary', children = [
+        dcc.Tab(label="Summary", value = 'summary', children= Tab_summary), 
+        dcc.Tab(label="Flow Sankey", value = 'sankey', children= Tab_Sankey),
+        dcc.Tab(label="Touch Points Analysis", value = 'touch', children= Tab_touch),
+        dcc.Tab(label="Conversions in the models", value = 'model', children=Tab_model),
+        dcc.Tab(label="Path Explorer", value = 'explorer', children=Tab_explorer),
+        dcc.Tab(label="Budget Simulator", value = 'budget', children=Tab_budget),
+        dcc.Tab(label="Cohort Lookup", value = 'cohort', children=Tab_cohort),
+    ]),
+    ## filter key each figure was last drawn for, see lazy_tab
+    *[dcc.Store(id = 'drawn-' + fig) for fig in ['fig_conv_count', 'fig_group_channel_cnt', 'fig-Sankey',
+                                                 'fig-first_last_count', 'fig-model', 'fig-explorer',
+                                                 'fig-budget', 'fig-cohort']],
 ])
 
 
@@ -262,36 +479,63 @@ app.layout = html.Div(style={'backgroundColor': colors['background']}, children=
 ### ----- ----- ----- ----- ----- ----- ----- -----
 
 
-## Channel count filtering
+## Channel count filtering: the dropdown presets fill the checklist, and
+## the checklist sets the dropdown to the preset it matches (else 'Custom').
+## A preset only selects the counts the data has; with none of them the
+## checklist stays and the dropdown goes back to match it
+## Every figure follows the checklist; its options are the channel counts
+## of the current snapshot, which grow with ingested batches
 @callback(
-    #Output('filter_channel','value'),
+    Output('filter_channel','value'),
+    Output('filter_channel_cnt','options'),
     Output('filter_channel_cnt','value'),
     Input('filter_channel','value'),
     Input('filter_channel_cnt','value')
 )
-def sync_channel_filters(filter_ch): #, filter_ch_cnt):
-    ctx = callback_context
-    input_id = ctx.triggered[0]["prop_id"].split(".")[0]
-    #print(input_id)
+@metrics.instrument()
+def sync_channel_filters(filter_ch, filter_ch_cnt):
+    snapshot = data_store.current
+    input_id = callback_context.triggered_id
     if input_id == 'filter_channel':
-        if filter_ch == 'full':
-            filter_ch_cnt = unique_channel_cnt
-        elif filter_ch == 'One':
-            filter_ch_cnt = [unique_channel_cnt[0]]
-        elif filter_ch == 'Two':
-            filter_ch_cnt = unique_channel_cnt[1:]
-    # else:
-    #     if set(filter_ch_cnt) == set(unique_channel_cnt):
-    #         filter_ch = 'full'
-    #     elif set(filter_ch_cnt) == set(unique_channel_cnt[0]):
-    #         filter_ch = 'One'
-    #     elif set(filter_ch_cnt) == set(unique_channel_cnt[1:]):
-    #         filter_ch = 'Two'
-    #     else:
-    #         filter_ch = 'custom'
-
-    #return filter_ch, filter_ch_cnt
-    return filter_ch_cnt
+        if filter_ch == 'custom':
+            return no_update, snapshot.counts, no_update
+        # a preset without any of its counts in the data keeps the checklist
+        preset = [c for c in snapshot.filter_counts(filter_ch) or snapshot.counts if c in snapshot.counts]
+        filter_ch_cnt = preset or filter_ch_cnt or snapshot.counts
+        filter_key = snapshot.filter_key(filter_ch_cnt)
+        filter_ch = filter_key if filter_key in FILTERS else 'custom'
+    else:
+        if not filter_ch_cnt:
+            filter_ch_cnt = snapshot.counts
+        filter_key = snapshot.filter_key(filter_ch_cnt)
+        filter_ch = filter_key if filter_key in FILTERS else 'custom'
+
+    return filter_ch, snapshot.counts, sorted(filter_ch_cnt)
+
+
+## figure title suffix of a channel count selection
+def filter_title(filter_key):
+    if filter_key == 'One':
+        return "(Paths with only one channel)"
+    if filter_key == 'Two':
+        return "(Paths with >2 channels)"
+    if filter_key == 'full':
+        return "(Full dataset)"
+    return "(Paths with {} channels)".format(filter_key[4:].replace('-', ', '))
+
+
+## Lazy tabs: the figures of a tab take the selected tab as input and are
+## only computed while their tab is open, so the first page load draws the
+## Summary tab alone and the model fits start when their tab is opened.
+## Each figure keeps in its 'drawn-<figure id>' store the snapshot and filter
+## it was last drawn for: reopening a tab whose filter did not change reuses
+## the figures the browser still holds, a filter changed (or a batch
+## ingested) meanwhile redraws them on opening. Returns that key
+def lazy_tab(tab, selected, drawn, snapshot, filter_key):
+    key = snapshot.fingerprint + ':' + filter_key
+    if selected != tab or (triggered_id() == 'tabs' and drawn == key):
+        raise PreventUpdate
+    return key
 
 
 # ## Data filtered by Channel cnt
@@ -357,22 +601,22 @@ def sync_channel_filters(filter_ch): #, filter_ch_cnt):
 
 @app.callback(
     Output('fig-first_last_count', 'figure'),
-    Input('filter_channel', 'value'),
+    Output('drawn-fig-first_last_count', 'data'),
+    Input('filter_channel_cnt', 'value'),
+    Input('tabs', 'value'),
+    State('drawn-fig-first_last_count', 'data'),
 )
-def Update_first_Last_graph(filtered_data):
-    def stat(data, touch):
-        stat_data = data.groupby(touch).agg(
-            conversion = pd.NamedAgg(column='converters', aggfunc='sum'),
-            non_conversion = pd.NamedAgg(column='nonconverters', aggfunc="sum")
-        )
-        stat_data['conversion_pct'] = stat_data.conversion/(stat_data.conversion + stat_data.non_conversion) *100
-        stat_data['non_conversion_pct'] = stat_data.non_conversion/(stat_data.conversion + stat_data.non_conversion)*100
-        return stat_data.reset_index().rename(columns={touch: 'channel'}).sort_values('conversion')
-    
-    data = Data_One if filtered_data == 'One' else Data_TwoMore if filtered_data == 'Two' else Data
-    dff = stat(data, 'first_touch')
-    dff_l = stat(data, 'last_touch')
-
+@metrics.instrument()
+@figure_payload.compact
+def Update_first_Last_graph(channel_cnt, tab, drawn):
+    snapshot = data_store.current
+    filter_key = snapshot.filter_key(channel_cnt)
+    drawn = lazy_tab('touch', tab, drawn, snapshot, filter_key)
+    data = snapshot.cube_for(filter_key)
+    dff = touch_stats(data, 'first_touch')
+    dff_l = touch_stats(data, 'last_touch')
+
+    metrics.mark()
     fig = make_subplots(rows=1, cols=2, specs=[[{},{}]], shared_xaxes = True, shared_yaxes = False, vertical_spacing=0.001)
     fig.append_trace(
         go.Bar(x=dff_l.conversion, y=dff_l.channel, orientation='h', 
@@ -406,8 +650,7 @@ def Update_first_Last_graph(filtered_data):
         1, 2
     )
     
-    add_title = "(Paths with only one channel)" if filtered_data == 'One' else "(Paths with >2 channels)" \
-        if filtered_data == 'Two' else "(Full dataset)"
+    add_title = filter_title(filter_key)
 
     fig.update_layout(
         margin=dict(l=20, r=20, t=50, b=20),
@@ -423,7 +666,7 @@ def Update_first_Last_graph(filtered_data):
         plot_bgcolor=colors['plot_bg'], #'rgb(248, 248, 255)',
     )
 
-    return fig
+    return fig, drawn
 
 
 
@@ -435,9 +678,14 @@ def Update_first_Last_graph(filtered_data):
 
 @callback(
     Output('fig_conv_count', 'figure'),
-    Input('filter_channel', 'value')
+    Output('drawn-fig_conv_count', 'data'),
+    Input('filter_channel_cnt', 'value'),
+    Input('tabs', 'value'),
+    State('drawn-fig_conv_count', 'data'),
 )
-def update_pie_fig(filtered_data):
+@metrics.instrument()
+@figure_payload.compact
+def update_pie_fig(channel_cnt, tab, drawn):
     def create_pie(val, name, title):
         fig = go.Figure(data=[go.Pie(labels=name, 
                              values=val, 
@@ -464,26 +712,35 @@ def update_pie_fig(filtered_data):
                            x = 0.5, y = 0.45, showarrow = False,
                            font=dict(size= 20))
         return fig
-    dff = Data_One if filtered_data == 'One' else Data_TwoMore if filtered_data == 'Two' else Data
-    add_title = "(Paths with only one channel)" if filtered_data == 'One' else "(Paths with >2 channels)" \
-        if filtered_data == 'Two' else "(Full dataset)"
+    snapshot = data_store.current
+    filter_key = snapshot.filter_key(channel_cnt)
+    drawn = lazy_tab('summary', tab, drawn, snapshot, filter_key)
+    dff = snapshot.cube_for(filter_key)
+    add_title = filter_title(filter_key)
+    metrics.mark()
     fig_conv = create_pie([dff.converters.sum(), dff.nonconverters.sum()], ["Converters","Non Conversters"], add_title)
-    return fig_conv
+    return fig_conv, drawn
 
 
 ## Graph -- group by channel cnt
+## (all channel counts at once: a new selection alone does not redraw it)
 @callback(
     Output('fig_group_channel_cnt', 'figure'), 
-    Input('filter_channel', 'value')
+    Output('drawn-fig_group_channel_cnt', 'data'),
+    Input('filter_channel_cnt', 'value'),
+    Input('tabs', 'value'),
+    State('drawn-fig_group_channel_cnt', 'data'),
 )
-def update_channel_cnt_fig(value):
-    df = Data.groupby('channels_count').agg(
-        converters = pd.NamedAgg(column='converters', aggfunc='sum'),
-        nonconverters = pd.NamedAgg(column='nonconverters', aggfunc="sum"),
-        ).reset_index()
-    df['conversion_pct'] = df.converters/(df.converters + df.nonconverters) *100
-    df['non_conversion_pct'] = df.nonconverters/(df.converters + df.nonconverters)*100
-
+@metrics.instrument()
+@figure_payload.compact
+def update_channel_cnt_fig(value, tab, drawn):
+    snapshot = data_store.current
+    key = lazy_tab('summary', tab, drawn, snapshot, 'full')
+    if drawn == key:
+        raise PreventUpdate
+    df = channel_count_stats(snapshot.cube)
+
+    metrics.mark()
     fig = make_subplots(rows=2, cols=1, specs=[[{"type":"scatter"}], [{"type":"bar"}]],
                     shared_xaxes=True, vertical_spacing=0.03,
                     row_heights=[0.25, 0.75])
@@ -525,98 +782,590 @@ def update_channel_cnt_fig(value):
                     #font=dict(size=18),
                     )
     
-    return fig
+    return fig, key
 
 
-## Sankey
+## Sankey: the links of every filter are prebuilt (data_store.current.sankey).
+## Toggling First / Last / conversion only changes the links and the title,
+## so those interactions send a Patch of them instead of the whole figure;
+## a new channel count selection (or the first render) sends the figure
 @app.callback(
     Output('fig-Sankey', 'figure'),
-    Input('filter_channel', 'value'),
+    Output('drawn-fig-Sankey', 'data'),
+    Input('filter_channel_cnt', 'value'),
     Input('filter-First', 'value'), 
     Input('filter-Last', 'value'),
-    Input('filter-convert', 'value')
+    Input('filter-convert', 'value'),
+    Input('tabs', 'value'),
+    State('drawn-fig-Sankey', 'data'),
 )
-def update_sankey(filtered_data, First, Last, conv):
-    dff = Data_One if filtered_data == 'One' else Data_TwoMore if filtered_data == 'Two' else Data
-    df = dff.groupby(['first_touch','last_touch']).agg(
-        conv = pd.NamedAgg(column= 'converters', aggfunc='sum'), 
-        nonconv = pd.NamedAgg(column= 'nonconverters', aggfunc='sum'),
-        )
-    df['cnt'] = df.conv + df.nonconv
-    df = df.reset_index()
-    
-    node = df.first_touch.unique()
-    df = df[df['first_touch'].isin(First)]
-    df = df[df['last_touch'].isin(Last)]
-
-    for i in range(len(node)):
-        df.loc[df.first_touch == node[i], 'first_touch'] = i
-        df.loc[df.last_touch == node[i], 'last_touch'] = i
+@metrics.instrument()
+@figure_payload.compact
+def update_sankey(channel_cnt, First, Last, conv, tab, drawn):
+    snapshot = data_store.current
+    filter_key = snapshot.filter_key(channel_cnt)
+    drawn = lazy_tab('sankey', tab, drawn, snapshot, filter_key)
+    sankey = snapshot.sankey(filter_key)
+    source, target, value = sankey.links(First, Last, conv)
+    title_text = conv + " From First Touch to Last Touch " + filter_title(filter_key)
+
+    metrics.mark()
+    if triggered_id() in ('filter-First', 'filter-Last', 'filter-convert'):
+        patch = Patch()
+        # labels too, an ingested batch may have added channels since the last full figure
+        patch['data'][0]['node']['label'] = sankey.labels
+        patch['data'][0]['link'] = figure_payload.arrays(dict(source = source, target = target, value = value))
+        patch['layout']['title']['text'] = title_text
+        return patch, drawn
 
     fig = go.Figure(data=[go.Sankey(
         node = dict(
             #pad = 15,
             #thickness = 20,
             #line = dict(color = "black", width = 0.5),
-            label = [*node,*node],
+            label = sankey.labels,
             #color = "blue"
             ),
         link = dict(
-        source = df.first_touch, 
-        target = [x + len(node) for x in df.last_touch],
-        value = df.conv if conv == 'Converters' else df.nonconv if conv == 'Non Converters' else df.cnt
+        source = source, 
+        target = target,
+        value = value
     ))])
 
-    add_title = "(Paths with only one channel)" if filtered_data == 'One' else "(Paths with >2 channels)" \
-        if filtered_data == 'Two' else "(Full dataset)"
-    fig.update_layout(title_text= conv + " From First Touch to Last Touch " + add_title)
+    fig.update_layout(title_text= title_text)
     
-    return fig
+    return fig, drawn
+
+
+## Path explorer: 'explorer-prefix' holds the channel names of the prefix;
+## a click on a continuation appends its channel, Back / Reset go up
+@callback(
+    Output('explorer-prefix', 'data'),
+    Input('fig-explorer', 'clickData'),
+    Input('explorer-up', 'n_clicks'),
+    Input('explorer-reset', 'n_clicks'),
+    State('explorer-prefix', 'data'),
+)
+def update_explorer_prefix(click, up, reset, prefix):
+    input_id = triggered_id()
+    if input_id == 'explorer-reset':
+        return []
+    if input_id == 'explorer-up':
+        return (prefix or [])[:-1]
+    channel = click['points'][0]['y'] if click else END
+    if channel == END:
+        raise PreventUpdate
+    return (prefix or []) + [channel]
+
+
+## the statistics of every prefix are sums in the trie built once per
+## snapshot (summed per filter on first use), so a new prefix, ranking or
+## top N only reads the children of one node
+@callback(
+    Output('fig-explorer', 'figure'),
+    Output('explorer-path', 'children'),
+    Output('drawn-fig-explorer', 'data'),
+    Input('filter_channel_cnt', 'value'),
+    Input('explorer-prefix', 'data'),
+    Input('explorer-top', 'value'),
+    Input('explorer-sort', 'value'),
+    Input('tabs', 'value'),
+    State('drawn-fig-explorer', 'data'),
+)
+@metrics.instrument()
+@figure_payload.compact
+def update_explorer(channel_cnt, prefix, top, by, tab, drawn):
+    snapshot = data_store.current
+    filter_key = snapshot.filter_key(channel_cnt)
+    drawn = lazy_tab('explorer', tab, drawn, snapshot, filter_key)
+    prefix = prefix or []
+    trie = snapshot.trie
+    stats = snapshot.trie_stats(filter_key)
+    node = trie.find(prefix)
+    conv, null, journeys = stats.totals(node) if node is not None else (0, 0, 0)
+    path_text = '{}: {:,} journeys, {:,} conversions ({:.2f}%)'.format(
+        ' > '.join(prefix) or 'All journeys', journeys, conv, conv / journeys * 100 if journeys else 0)
+    dff = trie.continuations(node, stats, top, by) if journeys else None
+
+    metrics.mark()
+    fig = go.Figure()
+    if dff is None:
+        fig.add_annotation(text="No journey starts with this path for the selected channel counts",
+                           xref= "paper", yref= "paper",
+                           x = 0.5, y = 0.5, showarrow = False,
+                           font=dict(size= 20))
+        fig.update_xaxes(visible=False)
+        fig.update_yaxes(visible=False)
+    else:
+        fig.add_trace(
+            go.Bar(x=dff.converters, y=dff.channel, orientation='h',
+                   marker=dict(color=conv_colors['conversion']),
+                   name='conversion'),
+        )
+        # conversion rate at the end of the stacked bar
+        fig.add_trace(
+            go.Bar(x=dff.nonconverters, y=dff.channel, orientation='h',
+                   text=dff.conversion_pct, texttemplate='%{text:.2f}%', textposition='outside',
+                   marker=dict(color=conv_colors['non-conversion']),
+                   name='non-conversion'),
+        )
+        fig.update_yaxes(title=None, autorange='reversed')
+        fig.update_xaxes(title=None, showticklabels=False)
+    fig.update_layout(
+        margin=dict(l=20, r=20, t=70, b=20),
+        barmode='stack',
+        title='Where do the journeys go next? ' + filter_title(filter_key),
+        plot_bgcolor= colors['plot_bg'],
+        legend = dict(orientation="h",
+                    yanchor="bottom", y=1.0,
+                    xanchor="right", x=1.0,
+                    title = None),
+        )
+    return fig, path_text, drawn
+
+
+@callback(
+    Output({'type': 'budget-scale', 'channel': ALL}, 'value'),
+    Input('budget-reset', 'n_clicks'),
+    State({'type': 'budget-scale', 'channel': ALL}, 'value'),
+)
+def reset_budget(n_clicks, scales):
+    if not n_clicks:
+        raise PreventUpdate
+    return [1] * len(scales)
+
+
+## Budget simulator: what-if scenarios on the order 1 transition matrix of
+## the filter (data_store.current.simulator, prepared once per filter).
+## A slider move solves the scenario with the removal of every channel, and
+## the response curves (every channel over the whole slider range), as two
+## batched solves
+BUDGET_GRID = np.linspace(0, 2, 41)
+
+@callback(
+    Output('fig-budget', 'figure'),
+    Output('fig-budget-response', 'figure'),
+    Output('budget-total', 'children'),
+    Output('drawn-fig-budget', 'data'),
+    Input('filter_channel_cnt', 'value'),
+    Input({'type': 'budget-scale', 'channel': ALL}, 'value'),
+    Input('tabs', 'value'),
+    State({'type': 'budget-scale', 'channel': ALL}, 'id'),
+    State('drawn-fig-budget', 'data'),
+)
+@metrics.instrument()
+@figure_payload.compact
+def update_budget(channel_cnt, values, tab, ids, drawn):
+    snapshot = data_store.current
+    filter_key = snapshot.filter_key(channel_cnt)
+    drawn = lazy_tab('budget', tab, drawn, snapshot, filter_key)
+    simulator = snapshot.simulator(filter_key)
+    scales = simulator.scales({i['channel']: v for i, v in zip(ids, values) if v is not None})
+    dff = simulator.project(scales).sort_values('base')
+    response = simulator.response(scales, BUDGET_GRID)
+    base, projected = dff.base.sum(), dff.projected.sum()
+    total_text = 'Projected conversions {}: {:,.0f} ({:+,.0f}, {:+.1f}%)'.format(
+        filter_title(filter_key), projected, projected - base, (projected / base - 1) * 100 if base else 0)
+
+    metrics.mark()
+    fig = go.Figure()
+    fig.add_trace(
+        go.Bar(x=dff.base, y=dff.channel, orientation='h',
+               marker=dict(color=conv_colors['non-conversion']),
+               name='current'),
+    )
+    fig.add_trace(
+        go.Bar(x=dff.projected, y=dff.channel, orientation='h',
+               text=dff.change, texttemplate='%{text:+.3s}', textposition='outside',
+               marker=dict(color=conv_colors['conversion']),
+               name='scenario'),
+    )
+    fig.update_yaxes(title=None)
+    fig.update_xaxes(title=None, showticklabels=False)
+    fig.update_layout(
+        margin=dict(l=20, r=20, t=70, b=20),
+        barmode='group',
+        title='How would the conversions by touchpoint change? (order 1 Markov model)',
+        plot_bgcolor= colors['plot_bg'],
+        legend = dict(orientation="h",
+                    yanchor="bottom", y=1.0,
+                    xanchor="right", x=1.0,
+                    title = None),
+        )
 
+    fig_response = go.Figure()
+    for name, line in response.groupby('channel', sort=False):
+        fig_response.add_trace(go.Scatter(x=line.scale, y=line.conversions, mode='lines', name=name))
+    fig_response.add_hline(y=projected, line_dash='dot', line_color=colors['header'])
+    fig_response.update_layout(
+        margin=dict(l=20, r=20, t=50, b=20),
+        title='Total conversions when one channel is scaled, the others as set',
+        xaxis = dict(title='scale of the channel', showgrid=False),
+        yaxis = dict(title=None, showgrid=True),
+        plot_bgcolor= colors['plot_bg'],
+        )
+    return fig, fig_response, total_text, drawn
 
 
+## Cohort lookup: the rows of the user IDs are two binary searches in the
+## user index, and the models are fitted inside the callback on the
+## distinct paths of the cohort
+## COHORT_ENGINE: engine of the cohort models, 'native' (default, exact
+## Markov removal effects, ~0.3 s for 10k users of 10M) or
+## 'ChannelAttribution' (simulated, seconds per cohort; its order selection
+## fails on some tiny cohorts). The Markov order follows MODEL_MARKOV_ORDER
+## (benchmarks/bench_users.py reports lookup and model seconds per cohort size)
+cohort_engine = os.environ.get('COHORT_ENGINE', 'native')
+## COHORT_MAX_USERS: most user IDs one lookup may ask for
+cohort_max_users = int(os.environ.get('COHORT_MAX_USERS', 100_000))
+
+@callback(
+    Output('fig-cohort', 'figure'),
+    Output('fig-cohort-model', 'figure'),
+    Output('cohort-status', 'children'),
+    Output('drawn-fig-cohort', 'data'),
+    Input('filter_channel_cnt', 'value'),
+    Input('cohort-lookup', 'n_clicks'),
+    Input('tabs', 'value'),
+    State('cohort-users', 'value'),
+    State('drawn-fig-cohort', 'data'),
+)
+@metrics.instrument()
+@figure_payload.compact
+def update_cohort(channel_cnt, n_clicks, tab, text, drawn):
+    snapshot = data_store.current
+    filter_key = snapshot.filter_key(channel_cnt)
+    drawn = lazy_tab('cohort', tab, drawn, snapshot, filter_key)
+    add_title = filter_title(filter_key)
+    user_ids = parse_user_ids(text)
+    too_many = len(user_ids) > cohort_max_users
+    cohort, journeys, R, error = cohort_results(snapshot, [] if too_many else user_ids, filter_key)
+    if snapshot.users is None:
+        status = 'The user index is off (set USER_INDEX=1)'
+    elif too_many:
+        status = 'Too many user IDs: {:,}, at most {:,} per lookup'.format(len(user_ids), cohort_max_users)
+    elif cohort is None:
+        status = 'Enter user IDs and press Look up'
+    else:
+        status = '{:,} of {:,} users found: {:,} journeys, {:,} conversions {}'.format(
+            cohort.found, cohort.requested, journeys.journeys.sum(), journeys.converters.sum(), add_title)
+        if error:
+            status += '. Model fit failed: {}'.format(error)
+
+    metrics.mark()
+    title = 'Which paths did the cohort take? ' + add_title
+    if journeys is None:
+        fig = message_figure(status, title)
+    elif journeys.empty:
+        fig = message_figure('No journey of these users for the selected channel counts', title)
+    else:
+        top = journeys.head(20)
+        fig = go.Figure()
+        fig.add_trace(
+            go.Bar(x=top.converters, y=top.path_clean, orientation='h',
+                   marker=dict(color=conv_colors['conversion']),
+                   name='conversion'),
+        )
+        fig.add_trace(
+            go.Bar(x=top.nonconverters, y=top.path_clean, orientation='h',
+                   text=top.conversion_pct, texttemplate='%{text:.2f}%', textposition='outside',
+                   marker=dict(color=conv_colors['non-conversion']),
+                   name='non-conversion'),
+        )
+        fig.update_yaxes(title=None, autorange='reversed')
+        fig.update_xaxes(title=None, showticklabels=False)
+        fig.update_layout(
+            margin=dict(l=20, r=20, t=70, b=20),
+            barmode='stack',
+            title=title,
+            plot_bgcolor= colors['plot_bg'],
+            legend = dict(orientation="h",
+                        yanchor="bottom", y=1.0,
+                        xanchor="right", x=1.0,
+                        title = None),
+            )
+    if R is None:
+        fig_model = message_figure('The models could not be fitted on the cohort' if error
+                                   else 'No conversion to attribute in the cohort',
+                                   'What is the Conversions by touchpoint in each model? (cohort) ' + add_title)
+    else:
+        fig_model = model_figure(R, '(cohort) ' + add_title)
+    return fig, fig_model, status, drawn
+
+
+## the users.Cohort of user_ids within a filter, its journeys, its models'
+## R (None without conversions or when the fit fails) and the fit error;
+## all None without a user index or user IDs
+def cohort_results(snapshot, user_ids, filter_key):
+    cohort = snapshot.cohort(user_ids, filter_key) if user_ids else None
+    if cohort is None:
+        return None, None, None, None
+    journeys = cohort.journeys(snapshot.paths)
+    if journeys.converters.sum() == 0:
+        return cohort, journeys, None, None
+    try:
+        R, _, _, _ = run_models(journeys[['path_clean', 'converters', 'nonconverters']],
+                                cohort_engine, markov = markov_options)
+    except Exception as e:
+        return cohort, journeys, None, str(e) or type(e).__name__
+    return cohort, journeys, R, None
+
+
+## GET /cohort?users=<IDs>&channels=<count>&channels=...: the same as JSON
+## (users separated like in the tab; channels are the channel counts of the
+## filter, all by default). Only served with USER_INDEX=1
+def cohort_api():
+    snapshot = data_store.current
+    if snapshot.users is None:
+        return jsonify(error='the user index is off (set USER_INDEX=1)'), 404
+    filter_key = snapshot.filter_key(request.args.getlist('channels', type=int))
+    user_ids = parse_user_ids(request.args.get('users'))
+    if len(user_ids) > cohort_max_users:
+        return jsonify(error='too many user IDs: {}, at most {} per lookup'.format(
+            len(user_ids), cohort_max_users)), 413
+    cohort, journeys, R, error = cohort_results(snapshot, user_ids, filter_key)
+    if cohort is None:
+        return jsonify(error='no user IDs given'), 400
+    return jsonify(filter=filter_key, requested=cohort.requested, found=cohort.found,
+                   journeys=journeys.to_dict('records'),
+                   attribution=None if R is None else R.to_dict('records'), model_error=error)
+
+if user_index is not None:
+    server.add_url_rule('/cohort', 'cohort', cohort_api)
+
+
+## id of the input that fired the callback, None outside a callback
+def triggered_id():
+    try:
+        return callback_context.triggered_id
+    except MissingCallbackContextException:
+        return None
+
+
+
+## models are fitted in the background: the first call submits the fit
+## (one job per filter, shared by every session asking for it, see
+## model_job), then the interval polls until the result is in model_cache.
+## The bootstrap intervals follow the same route once the models are in.
+## The figure only counts as drawn (lazy_tab) once the final one is sent;
+## closing the tab stops the polling, reopening it resumes the same job
 @app.callback(
     Output('fig-model', 'figure'),
-    Input('filter_channel', 'value'),
+    Output('model-status', 'children'),
+    Output('model-poll', 'disabled'),
+    Output('drawn-fig-model', 'data'),
+    Input('filter_channel_cnt', 'value'),
+    Input('model-ci', 'value'),
+    Input('model-poll', 'n_intervals'),
+    Input('tabs', 'value'),
+    State('drawn-fig-model', 'data'),
 )
-def plot_model_conv(filtered_data):
-    def runModel(Data):
-        #ESTIMATE HEURISTIC MODELS (first-/last-/linear- touch models)
-        H = heuristic_models(Data,"path_clean","converters",
-                            #var_value = "total_conv_values",
-                            flg_adv = False)
-
-        #ESTIMATE MARKOV MODEL
-        Auto_M = auto_markov_model(Data,
-                                "path_clean",
-                                "converters",
-                                #var_value = "total_conv_values",
-                                var_null = "nonconverters",
-                                out_more = True,
-                                flg_adv = False)
-        
-        # COMBINE HEURITSTIC & MARKOV
-        R = pd.merge(H,Auto_M['result'],on="channel_name",how="inner")
-        R.columns=["channel","first_touch","last_touch","linear_touch","markov_model"]
-        R = R.sort_values('markov_model', ascending=True)
+@metrics.instrument()
+@figure_payload.compact
+def plot_model_conv(channel_cnt, ci, n_intervals, tab, drawn):
+    snapshot = data_store.current
+    data_fp = snapshot.fingerprint
+    filter_key = snapshot.filter_key(channel_cnt)
+    if tab != 'model' and triggered_id() == 'model-poll':
+        return no_update, no_update, True, no_update
+    shown = drawn
+    drawn = lazy_tab('model', tab, drawn, snapshot, filter_key)
+    add_title = filter_title(filter_key)
+    if snapshot.cube_for(filter_key).converters.sum() == 0:
+        return message_figure('No conversions to attribute', 'What is the Conversions by touchpoint in each model? '
+                              + add_title), '', True, drawn
+    models = model_cache.lookup(data_fp, filter_key)
+    if models is None and model_jobs is None:
+        fn, args, kwargs = model_fit(snapshot, filter_key)
+        models = fn(*args, **kwargs)
+        model_cache.store(data_fp, filter_key, models)
+
+    if models is None:
+        # the preview job goes first, so it does not queue behind the exact fit
+        preview = model_preview(snapshot, filter_key)
+        job_key = (data_fp, filter_key, model_cache.engine, markov_tag(markov_options))
+        job = model_job(job_key, data_fp, filter_key, lambda: model_fit(snapshot, filter_key))
+        if job is None or not job.done():
+            if job is None:
+                status = 'Fitting attribution models {} in another worker'.format(add_title)
+            else:
+                step, total, label = model_jobs.progress(job_key)
+                status = 'Fitting attribution models {}: {} ({}/{})'.format(add_title, label, step, total)
+            polled = triggered_id() == 'model-poll'
+            if preview is None:
+                return (no_update if polled else model_placeholder(add_title)), status, False, None
+            df, intervals = preview
+            status = 'Preview from {} stratified samples of {:,} journeys (95% bounds). {}'.format(
+                preview_options['replicates'], preview_options['size'] // preview_options['replicates'], status)
+            # the preview figure is sent once, the polls then only update the status
+            if polled and shown == 'preview:' + drawn:
+                return no_update, status, False, no_update
+            return model_figure(df, add_title + ' - preview', intervals), status, False, 'preview:' + drawn
+        try:
+            models = job.result()
+        except Exception as e:
+            model_jobs.discard(job_key)
+            return model_placeholder(add_title), 'Model fit failed: {}'.format(e), True, None
+
+    df, df_RE, df_TM , df_TM1 = models
+    if 'bootstrap' not in (ci or []):
+        return model_figure(df, add_title), '', True, drawn
+
+    ci_key = filter_key + '-bootstrap'
+    intervals = model_cache.lookup(data_fp, ci_key)
+    if intervals is None and model_jobs is None:
+        intervals = bootstrap_intervals(snapshot.model_input(filter_key), **bootstrap_options)
+        model_cache.store(data_fp, ci_key, intervals)
+
+    if intervals is None:
+        job_key = (data_fp, ci_key)
+        job = model_job(job_key, data_fp, ci_key,
+                        lambda: (bootstrap_intervals, (snapshot.model_input(filter_key),), bootstrap_options))
+        if job is None or not job.done():
+            if job is None:
+                status = 'Bootstrapping {} in another worker'.format(add_title)
+            else:
+                step, total, label = model_jobs.progress(job_key)
+                status = 'Bootstrapping {}: {} ({}/{})'.format(add_title, label, step, total)
+            polled = triggered_id() == 'model-poll'
+            return (no_update if polled else model_figure(df, add_title)), status, False, None
+        try:
+            intervals = job.result()
+        except Exception as e:
+            model_jobs.discard(job_key)
+            return model_figure(df, add_title), 'Bootstrap failed: {}'.format(e), True, None
+
+    status = 'Bootstrap 95% intervals from {} resamples'.format(intervals.n_resamples.iloc[0])
+    if model_cache.engine != 'native':
+        # the resamples are fitted with the native engine: its Markov estimate is not
+        # the ChannelAttribution bar, the interval would be drawn around the wrong value
+        intervals = intervals[intervals.model != 'markov_model']
+        status += ' (none for markov_model: the resamples use the native engine, the bars {})'.format(
+            model_cache.engine)
+    return model_figure(df, add_title, intervals), status, True, drawn
+
+
+## the background job filling the model_cache entry (fingerprint, cache_key),
+## submitted on the first call, None while another worker fits it. fit()
+## gives its function, args and kwargs; it runs in a JobManager thread, so
+## building the inputs (model input, counts, merges) never holds up the callback.
+## A finished job stores its result and is forgotten right away, from the
+## pool's callback thread, so a session polling at any time finds either
+## the job or the result; a failed job stays until a poll collects the error.
+## Jobs live in one gunicorn worker: with MODEL_CACHE_DIR set, the worker
+## holding the ModelCache claim fits and the others poll the cache until the
+## result is written; without it every worker asked for an entry fits it once
+def model_job(job_key, fingerprint, cache_key, fit):
+    job = model_jobs.get(job_key)
+    if job is not None or not model_cache.claim(fingerprint, cache_key):
+        return job
+    # another worker may have stored the entry since this one looked it up
+    if model_cache.lookup(fingerprint, cache_key) is not None:
+        model_cache.release(fingerprint, cache_key)
+        return None
+    job = model_jobs.submit_prepared(job_key, fit)
+
+    def finished(job):
+        try:
+            if not job.cancelled() and job.exception() is None:
+                model_cache.store(fingerprint, cache_key, job.result())
+                model_jobs.discard(job_key)
+        finally:
+            model_cache.release(fingerprint, cache_key)
+    job.add_done_callback(finished)
+    return job
+
+
+## (function, args, kwargs) of the exact model fit of a filter: from the
+## snapshot's additive counts with counted_order, else run_models on the
+## distinct paths (after an ingest the order 1 transition counts are
+## already merged, no need to recount them)
+def model_fit(snapshot, filter_key):
+    if counted_order is not None:
+        return models_from_counts, (snapshot.model_counts(filter_key, counted_order),
+                                    snapshot.transition_matrix(filter_key)), {}
+    transitions = snapshot.transition_matrix(filter_key) if snapshot.batches else None
+    return run_models, (snapshot.model_input(filter_key), model_cache.engine), \
+        dict(transitions = transitions, markov = markov_options)
+
+
+## models fitted on the preview sample (data_store.current.preview_sample)
+## of the filter, as (R, intervals); a short job of its own, None while it
+## runs, when previews are off or when the filter is no larger than the sample
+def model_preview(snapshot, filter_key):
+    size, replicates, max_order = preview_options['size'], preview_options['replicates'], preview_options['max_order']
+    cube = snapshot.cube_for(filter_key)
+    if model_jobs is None or size <= 0 or cube.converters.sum() + cube.nonconverters.sum() <= size:
+        return None
+    preview_key = '{}-preview{}x{}o{}'.format(filter_key, size, replicates, max_order)
+    preview = model_cache.lookup(snapshot.fingerprint, preview_key)
+    if preview is not None:
+        return preview
+
+    job_key = (snapshot.fingerprint, preview_key, markov_tag(markov_options))
+    job = model_job(job_key, snapshot.fingerprint, preview_key, lambda: (
+        preview_models,
+        (snapshot.preview_sample(size, replicates).model_inputs(snapshot.filter_counts(filter_key)),
+         int(cube.converters.sum())),
+        dict(markov = markov_options, max_order = max_order)))
+    if job is None or not job.done():
+        return None
+    try:
+        return job.result()
+    except Exception as e:
+        print('model preview failed: {}'.format(e), file=sys.stderr)
+        model_jobs.discard(job_key)
+        return None
+
+
+## an empty figure with a message in the middle
+def message_figure(text, title):
+    fig = go.Figure()
+    fig.add_annotation(text=text,
+                       xref= "paper", yref= "paper",
+                       x = 0.5, y = 0.5, showarrow = False,
+                       font=dict(size= 20))
+    fig.update_xaxes(visible=False)
+    fig.update_yaxes(visible=False)
+    fig.update_layout(title = title, plot_bgcolor= colors['plot_bg'])
+    return fig
 
-        # ESTIMATE TRANSITION MATRIX in ORDER = 1
-        T = transition_matrix(Data, "path_clean", "converters", var_null = "nonconverters", flg_adv = False)
 
-        return R, Auto_M['removal_effects'].sort_values('removal_effect'), Auto_M['transition_matrix'], T
+def model_placeholder(add_title):
+    metrics.mark()
+    fig = go.Figure()
+    fig.add_annotation(text="Fitting the attribution models...", 
+                       xref= "paper", yref= "paper",
+                       x = 0.5, y = 0.5, showarrow = False,
+                       font=dict(size= 20))
+    fig.update_xaxes(visible=False)
+    fig.update_yaxes(visible=False)
+    fig.update_layout(
+        title = 'What is the Conversions by touchpoint in each model? ' + add_title, 
+        plot_bgcolor= colors['plot_bg'], 
+        )
+    return fig
 
-    add_title = "(Paths with only one channel)" if filtered_data == 'One' else "(Paths with >2 channels)" \
-        if filtered_data == 'Two' else "(Full dataset)"
-    
-    df = Data_One if filtered_data == 'One' else Data_TwoMore if filtered_data == 'Two' else Data
-    df, df_RE, df_TM , df_TM1 = runModel(df)
 
+## intervals: optional output of bootstrap_intervals, drawn as error bars
+## with the interval width around the estimate shown in the bar (models
+## without rows in intervals get none)
+def model_figure(df, add_title, intervals=None):
+    metrics.mark()
     fig = go.Figure()
-    for m in ["markov_model","linear_touch","last_touch","first_touch"]:
+    for m in ["markov_model","shapley","linear_touch","last_touch","first_touch"]:
+        error_x = None
+        if intervals is not None and (intervals.model == m).any():
+            ci = intervals[intervals.model == m].set_index('channel').reindex(df['channel'])
+            error_x = dict(type='data', symmetric=False,
+                           array=(ci.upper - ci.estimate).clip(lower=0).values,
+                           arrayminus=(ci.estimate - ci.lower).clip(lower=0).values,
+                           color=colors['header'])
         fig.add_trace(
             go.Bar(x = df[m], y = df['channel'], orientation='h', 
                    text = df[m], insidetextanchor="end", texttemplate='%{text:.3s}',
                    marker=dict(color=model_colors[m]),
+                   error_x = error_x,
                    name = m),
         )
     fig.update_yaxes(title=None)
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+CUBE_KEYS = ['channels_count', 'first_touch', 'last_touch']
+
+
+### ----- ----- ----- ----- -----
+### ----- aggregate cube -----
+### ----- ----- ----- ----- -----
+# converters / nonconverters summed by (channels_count, first_touch, last_touch).
+# It is built once at load time; every view in the dashboard is a sum over
+# a slice of it, so callbacks cost O(cube) instead of O(paths).
+# The sums keep the row-level column names so the cube can be grouped the
+# same way as Data.
+def build_cube(Data):
+    cube = Data.groupby(CUBE_KEYS, observed=True).agg(
+        converters = pd.NamedAgg(column='converters', aggfunc='sum'),
+        nonconverters = pd.NamedAgg(column='nonconverters', aggfunc='sum'),
+        paths = pd.NamedAgg(column='converters', aggfunc='size'),
+    )
+    return cube.reset_index()
+
+
+# the cube of several batches of rows is the sum of their cubes
+def merge_cubes(cube, *others):
+    cube = pd.concat([cube, *others], ignore_index=True)
+    for col in ['first_touch', 'last_touch']:
+        cube[col] = cube[col].astype('category')
+    return cube.groupby(CUBE_KEYS, observed=True, as_index=False)[['converters', 'nonconverters', 'paths']].sum()
+
+
+# cube rows of the given channel counts (None for all of them). The cube
+# is sorted by channels_count, so every count is a contiguous bucket of
+# rows and a selection is the union of its buckets
+def cube_slice(cube, counts=None):
+    if counts is None:
+        return cube
+    keys = cube['channels_count'].to_numpy()
+    counts = np.unique(np.asarray(counts, dtype=keys.dtype))
+    starts = np.searchsorted(keys, counts, side='left')
+    stops = np.searchsorted(keys, counts, side='right')
+    return cube.iloc[np.concatenate([np.arange(a, b) for a, b in zip(starts, stops)] or [[]]).astype(np.int64)]
+
+
+# conversions and conversion rate per first or last touch channel
+def touch_stats(cube, touch):
+    stat_data = cube.groupby(touch, observed=True).agg(
+        conversion = pd.NamedAgg(column='converters', aggfunc='sum'),
+        non_conversion = pd.NamedAgg(column='nonconverters', aggfunc="sum")
+    )
+    stat_data['conversion_pct'] = stat_data.conversion/(stat_data.conversion + stat_data.non_conversion) *100
+    stat_data['non_conversion_pct'] = stat_data.non_conversion/(stat_data.conversion + stat_data.non_conversion)*100
+    return stat_data.reset_index().rename(columns={touch: 'channel'}).sort_values('conversion')
+
+
+# conversions and conversion rate per number of channels in the path
+def channel_count_stats(cube):
+    df = cube.groupby('channels_count').agg(
+        converters = pd.NamedAgg(column='converters', aggfunc='sum'),
+        nonconverters = pd.NamedAgg(column='nonconverters', aggfunc="sum"),
+        ).reset_index()
+    df['conversion_pct'] = df.converters/(df.converters + df.nonconverters) *100
+    df['non_conversion_pct'] = df.nonconverters/(df.converters + df.nonconverters)*100
+    return df
+
+
+# first/last touch links for the Sankey, built once per cube slice: every
+# observed (first_touch, last_touch) pair with its sums and integer node
+# codes (first touch nodes 0..n-1, last touch nodes n..2n-1, both in name
+# order). The First/Last checklists and the conversion radio only mask
+# the links and pick a value column.
+class SankeyTable:
+    def __init__(self, cube):
+        df = cube.groupby(['first_touch', 'last_touch'], observed=True)[['converters', 'nonconverters']].sum()
+        df = df.reset_index()
+        self.first = df['first_touch'].to_numpy(dtype=object)
+        self.last = df['last_touch'].to_numpy(dtype=object)
+        self.nodes = np.array(sorted(set(self.first) | set(self.last)), dtype=object)
+        self.source = np.searchsorted(self.nodes, self.first)
+        self.target = np.searchsorted(self.nodes, self.last) + len(self.nodes)
+        self.conv = df['converters'].to_numpy()
+        self.nonconv = df['nonconverters'].to_numpy()
+        self.cnt = self.conv + self.nonconv
+
+    @property
+    def labels(self):
+        return [*self.nodes, *self.nodes]
+
+    # (source, target, value) of the links between the selected touches
+    def links(self, First, Last, conv):
+        keep = np.isin(self.first, list(First or [])) & np.isin(self.last, list(Last or []))
+        value = self.conv if conv == 'Converters' else self.nonconv if conv == 'Non Converters' else self.cnt
+        return self.source[keep], self.target[keep], value[keep]
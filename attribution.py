@@ -0,0 +1,686 @@
+import time
+import warnings
+import tracemalloc
+import numpy as np
+import pandas as pd
+from math import comb
+
+### ----- ----- ----- ----- -----
+### ----- native attribution engine -----
+### ----- ----- ----- ----- -----
+# NumPy re-implementation of the ChannelAttribution models used by the
+# dashboard. Paths are integer encoded once, order-k states and their
+# transitions are counted with array operations and the Markov removal
+# effects are solved exactly from the absorbing chain instead of being
+# simulated. Function names and outputs mirror ChannelAttribution so the
+# two engines can be swapped in models.run_models.
+
+START, CONVERSION, NULL = '(start)', '(conversion)', '(null)'
+
+# above this many states the absorption probabilities are solved by sparse
+# fixed-point iteration instead of one dense batched solve
+DENSE_MAX_STATES = 1500
+# the iteration stops once no probability changes by more than SPARSE_TOL,
+# and warns if that takes more than SPARSE_MAX_ITER sweeps
+SPARSE_TOL = 1e-13
+SPARSE_MAX_ITER = 10_000
+
+
+# unique paths of a dataset in CSR form: the channels of path i are
+# codes[offsets[i]:offsets[i+1]] (0-based ids into channels), with the
+# converters / nonconverters of all rows sharing that path summed
+class PathTable:
+    def __init__(self, channels, codes, offsets, converters, nonconverters):
+        self.channels = channels
+        self.codes = codes
+        self.offsets = offsets
+        self.converters = converters
+        self.nonconverters = nonconverters
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+# channel ids follow the order in which channels first appear in the data,
+# like ChannelAttribution does
+def encode_paths(Data, var_path='path_clean', var_conv='converters', var_null='nonconverters', sep='>'):
+    path_id, paths = pd.factorize(Data[var_path], sort=False)
+    converters = np.bincount(path_id, weights=Data[var_conv], minlength=len(paths)).astype(np.int64)
+    if var_null is None:
+        nonconverters = np.zeros(len(paths), dtype=np.int64)
+    else:
+        nonconverters = np.bincount(path_id, weights=Data[var_null], minlength=len(paths)).astype(np.int64)
+
+    paths = list(paths)
+    lengths = np.fromiter((p.count(sep) for p in paths), np.int64, len(paths)) + 1
+    tokens = pd.Series(sep.join(paths).split(sep)).str.strip()
+    codes, channels = pd.factorize(tokens, sort=False)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    return PathTable(np.asarray(channels, dtype=object), codes.astype(np.int16), offsets,
+                     converters, nonconverters)
+
+
+### ----- order-k states -----
+
+# order-k states of every path: sliding windows of k consecutive channels
+# (the whole path when it is shorter than k). Each window is packed into one
+# int64 key, base (n channels + 1) with 1-based digits, so keys of different
+# lengths never collide. Repeated consecutive states are dropped unless
+# keep_repeats is set (ChannelAttribution's flg_equal).
+# returns (key per state step, path id per state step)
+def path_states(paths, order=1, keep_repeats=False):
+    base = len(paths.channels) + 1
+    if order * np.log2(base) >= 63:
+        raise ValueError("order {} is too high for {} channels".format(order, base - 1))
+    lengths = paths.lengths
+    n_win = np.maximum(lengths - order + 1, 1)
+    path_of = np.repeat(np.arange(len(paths)), n_win)
+    win_offsets = np.concatenate([[0], np.cumsum(n_win)])
+    start = paths.offsets[path_of] + np.arange(len(path_of)) - win_offsets[path_of]
+    width = np.minimum(order, lengths[path_of])
+
+    key = np.zeros(len(path_of), dtype=np.int64)
+    last = max(len(paths.codes) - 1, 0)
+    for j in range(order):
+        inside = j < width
+        digit = paths.codes[np.minimum(start + j, last)].astype(np.int64) + 1
+        key = np.where(inside, key * base + digit, key)
+
+    if not keep_repeats:
+        keep = np.ones(len(key), dtype=bool)
+        keep[1:] = (key[1:] != key[:-1]) | (path_of[1:] != path_of[:-1])
+        key, path_of = key[keep], path_of[keep]
+    return key, path_of
+
+
+# variable-order (context tree) states: after every touch the state is the
+# longest run of at most max_order channels ending at that touch that was
+# seen at least min_count times (summed path counts) across the data; rarer
+# contexts back off to their shorter suffix, down to the single channel.
+# Keys are packed like path_states, so only contexts that actually occur
+# are ever stored. returns (key per state step, path id per state step)
+def context_states(paths, max_order=4, min_count=100, keep_repeats=False):
+    base = len(paths.channels) + 1
+    if max_order * np.log2(base) >= 63:
+        raise ValueError("order {} is too high for {} channels".format(max_order, base - 1))
+    lengths = paths.lengths
+    path_of = np.repeat(np.arange(len(paths)), lengths)
+    pos = np.arange(len(path_of)) - paths.offsets[path_of]
+    total = (paths.converters + paths.nonconverters)[path_of]
+    digits = paths.codes.astype(np.int64) + 1
+
+    context = digits.copy()
+    key = digits.copy()
+    for j in range(2, max_order + 1):
+        inside = pos >= j - 1
+        if not inside.any():
+            break
+        # extend every context one channel to the left
+        context = np.where(inside, context + digits[np.maximum(np.arange(len(digits)) - j + 1, 0)] * base ** (j - 1), 0)
+        ids, uniq = pd.factorize(context, sort=False)
+        support = np.bincount(ids, weights=np.where(inside, total, 0))
+        keep = inside & (support[ids] >= min_count)
+        if not keep.any():
+            break
+        key = np.where(keep, context, key)
+
+    if not keep_repeats:
+        keep = np.ones(len(key), dtype=bool)
+        keep[1:] = (key[1:] != key[:-1]) | (path_of[1:] != path_of[:-1])
+        key, path_of = key[keep], path_of[keep]
+    return key, path_of
+
+
+# channel ids (0-based) inside a packed state key
+def state_channels(key, order, n_channels):
+    base = n_channels + 1
+    out = []
+    while key:
+        key, digit = divmod(int(key), base)
+        out.append(digit - 1)
+    return out[::-1]
+
+
+# sparse transition counts between states.
+# state 0 is (start), 1..n_states the observed states (in order of first
+# appearance), then (conversion) and (null).
+class TransitionCounts:
+    def __init__(self, keys, src, dst, weight, order, n_channels):
+        self.keys = keys
+        self.src = src
+        self.dst = dst
+        self.weight = weight
+        self.order = order
+        self.n_channels = n_channels
+
+    @property
+    def n_states(self):
+        return len(self.keys)
+
+    @property
+    def conversion(self):
+        return self.n_states + 1
+
+    @property
+    def null(self):
+        return self.n_states + 2
+
+    # transition probabilities per stored (src, dst) pair
+    def probabilities(self):
+        total = np.bincount(self.src, weights=self.weight, minlength=self.n_states + 3)
+        return self.weight / total[self.src]
+
+
+# min_count switches to the variable-order states of context_states, with
+# order as the longest context
+def count_transitions(paths, order=1, keep_repeats=False, min_count=None):
+    if min_count is None:
+        key, path_of = path_states(paths, order, keep_repeats)
+    else:
+        key, path_of = context_states(paths, order, min_count, keep_repeats)
+    keys, src, dst, step_path, outcome = _steps(key, path_of)
+    n_states = len(keys)
+    weight = _step_weights(paths.converters, paths.nonconverters, step_path, outcome)
+
+    used = weight > 0
+    pair = src[used].astype(np.int64) * (n_states + 3) + dst[used]
+    pair_uniq, inverse = np.unique(pair, return_inverse=True)
+    weight = np.bincount(inverse.ravel(), weights=weight[used])
+    return TransitionCounts(np.asarray(keys, dtype=np.int64),
+                            pair_uniq // (n_states + 3), pair_uniq % (n_states + 3),
+                            weight, order, len(paths.channels))
+
+
+# every transition step of the state sequences, before summing over paths:
+# (start) -> first state, state -> next state, last state -> conversion / null.
+# returns (state keys, src, dst, path of the step, outcome) where outcome
+# is 0 for steps taken by every user of the path, 1 / 2 for the final
+# step of its converters / nonconverters
+def _steps(key, path_of):
+    state, keys = pd.factorize(key, sort=False)
+    state = state + 1
+    n_states = len(keys)
+    first = np.ones(len(state), dtype=bool)
+    first[1:] = path_of[1:] != path_of[:-1]
+    last = np.ones(len(state), dtype=bool)
+    last[:-1] = path_of[1:] != path_of[:-1]
+
+    prev = np.where(first, 0, np.concatenate([[0], state[:-1]]))
+    n_last = last.sum()
+    src = np.concatenate([prev, state[last], state[last]])
+    dst = np.concatenate([state, np.full(n_last, n_states + 1), np.full(n_last, n_states + 2)])
+    step_path = np.concatenate([path_of, path_of[last], path_of[last]])
+    outcome = np.concatenate([np.zeros(len(state), dtype=np.int8), np.ones(n_last, dtype=np.int8),
+                              np.full(n_last, 2, dtype=np.int8)])
+    return keys, src, dst, step_path, outcome
+
+
+def _step_weights(converters, nonconverters, step_path, outcome):
+    return np.choose(outcome, [(converters + nonconverters)[step_path], converters[step_path],
+                               nonconverters[step_path]])
+
+
+# counts are additive: the transitions of two batches of paths are the
+# transitions of both batches together. Channel ids of b are mapped onto
+# the channels of a, channels new in b are appended.
+# returns (merged counts, merged channels)
+def merge_transitions(a, a_channels, b, b_channels):
+    if a.order != b.order:
+        raise ValueError("cannot merge order {} and order {} transitions".format(a.order, b.order))
+    known = set(a_channels)
+    channels = np.concatenate([np.asarray(a_channels, dtype=object),
+                               np.asarray([c for c in b_channels if c not in known], dtype=object)])
+    index = {c: i for i, c in enumerate(channels)}
+    keys_a = _repack(a, np.arange(len(a_channels)), len(channels))
+    keys_b = _repack(b, np.array([index[c] for c in b_channels], dtype=np.int64), len(channels))
+    state, keys = pd.factorize(np.concatenate([keys_a, keys_b]), sort=False)
+    n_states = len(keys)
+
+    src, dst = [], []
+    for counts, ids in ((a, state[:a.n_states]), (b, state[a.n_states:])):
+        lookup = np.concatenate([[0], ids + 1, [n_states + 1, n_states + 2]])
+        src.append(lookup[counts.src])
+        dst.append(lookup[counts.dst])
+    pair = np.concatenate(src).astype(np.int64) * (n_states + 3) + np.concatenate(dst)
+    pair_uniq, inverse = np.unique(pair, return_inverse=True)
+    weight = np.bincount(inverse.ravel(), weights=np.concatenate([a.weight, b.weight]))
+    merged = TransitionCounts(np.asarray(keys, dtype=np.int64),
+                              pair_uniq // (n_states + 3), pair_uniq % (n_states + 3),
+                              weight, a.order, len(channels))
+    return merged, channels
+
+
+# state keys of counts re-packed for new channel ids (id_map[old id]) and n_channels
+def _repack(counts, id_map, n_channels):
+    base = n_channels + 1
+    keys = np.empty(counts.n_states, dtype=np.int64)
+    for i, key in enumerate(counts.keys):
+        packed = 0
+        for c in state_channels(key, counts.order, counts.n_channels):
+            packed = packed * base + int(id_map[c]) + 1
+        keys[i] = packed
+    return keys
+
+
+### ----- absorption probabilities -----
+
+# (states x channels) mask of which states contain which channel
+def state_membership(counts):
+    member = np.zeros((counts.n_states + 3, counts.n_channels), dtype=bool)
+    for i, key in enumerate(counts.keys):
+        member[i + 1, state_channels(key, counts.order, counts.n_channels)] = True
+    return member
+
+
+# probability of reaching (conversion) from (start), first for the full chain
+# and then with each channel removed (its states sending everything to (null)).
+# All len(channels)+1 chains are solved together.
+def conversion_probabilities(counts):
+    member = state_membership(counts)
+    # alive[s, c]: state s still transient when channel c is removed (c = -1: nothing removed)
+    alive = np.concatenate([np.ones((len(member), 1), dtype=bool), ~member], axis=1)
+    p = counts.probabilities()
+    to_conv = counts.dst == counts.conversion
+    inner = counts.dst <= counts.n_states
+    n = counts.n_states + 1
+
+    if n <= DENSE_MAX_STATES:
+        T = np.zeros((n, n))
+        T[counts.src[inner], counts.dst[inner]] = p[inner]
+        r = np.bincount(counts.src[to_conv], weights=p[to_conv], minlength=n)
+        mask = alive[:n].T.astype(float)                      # (scenarios, n)
+        A = np.eye(n)[None] - mask[:, :, None] * T[None]
+        x = np.linalg.solve(A, (mask * r[None])[:, :, None])[:, :, 0]
+        return x[:, 0]
+
+    # sparse: iterate x <- alive * (T x + r) until the absorption probabilities settle
+    src, dst, w = counts.src[inner], counts.dst[inner], p[inner]
+    r = np.bincount(counts.src[to_conv], weights=p[to_conv], minlength=n)
+    mask = alive[:n].astype(float)                            # (n, scenarios)
+    x = mask * r[:, None]
+    for _ in range(SPARSE_MAX_ITER):
+        Tx = np.zeros_like(x)
+        np.add.at(Tx, src, w[:, None] * x[dst])
+        x_new = mask * (Tx + r[:, None])
+        residual = np.abs(x_new - x).max()
+        x = x_new
+        if residual < SPARSE_TOL:
+            break
+    else:
+        warnings.warn("absorption probabilities of {} states did not converge in {} iterations "
+                      "(largest change {:.2e}); the Markov attribution is approximate".format(
+                          counts.n_states, SPARSE_MAX_ITER, residual), RuntimeWarning)
+    return x[0]
+
+
+### ----- models -----
+
+# first / last / linear touch from an encoded PathTable. Linear touch gives
+# every touchpoint an equal share, repeated channels counting once per touch.
+def heuristic_conversions(paths):
+    n_ch = len(paths.channels)
+    conv = paths.converters.astype(float)
+    lengths = paths.lengths
+    first = np.bincount(paths.codes[paths.offsets[:-1]], weights=conv, minlength=n_ch)
+    last = np.bincount(paths.codes[paths.offsets[1:] - 1], weights=conv, minlength=n_ch)
+    linear = np.bincount(paths.codes, weights=np.repeat(conv / lengths, lengths), minlength=n_ch)
+    return first, last, linear
+
+
+def heuristic_models(Data, var_path, var_conv, sep='>'):
+    paths = encode_paths(Data, var_path, var_conv, None, sep)
+    first, last, linear = heuristic_conversions(paths)
+    return pd.DataFrame({'channel_name': paths.channels, 'first_touch': first,
+                         'last_touch': last, 'linear_touch': linear})
+
+
+# Markov attributed conversions and removal effects from an encoded PathTable;
+# with min_count a variable-order model with contexts of up to order channels
+def markov_conversions(paths, order=1, min_count=None):
+    counts = count_transitions(paths, order, min_count=min_count)
+    removal = removal_effects(conversion_probabilities(counts))
+    return removal_conversions(paths.converters.sum(), removal), removal, counts
+
+
+# removal effect of every channel from the conversion_probabilities output;
+# all zero when nothing converts (no chain reaches (conversion))
+def removal_effects(p_conv):
+    if p_conv[0] <= 0:
+        return np.zeros(len(p_conv) - 1)
+    return (p_conv[0] - p_conv[1:]) / p_conv[0]
+
+
+# total conversions split in proportion to the removal effects; zeros when
+# they are all zero, like ChannelAttribution attributes nothing then
+def removal_conversions(total, removal):
+    if removal.sum() <= 0:
+        return np.zeros(len(removal))
+    return total * removal / removal.sum()
+
+
+def markov_model(Data, var_path, var_conv, var_null=None, order=1, out_more=False, sep='>', min_count=None):
+    paths = encode_paths(Data, var_path, var_conv, var_null, sep)
+    total_conversions, removal, counts = markov_conversions(paths, order, min_count)
+
+    result = pd.DataFrame({'channel_name': paths.channels, 'total_conversions': total_conversions})
+    if not out_more:
+        return result
+    return {'result': result,
+            'transition_matrix': _transition_table(counts),
+            'removal_effects': pd.DataFrame({'channel_name': paths.channels, 'removal_effect': removal})}
+
+
+def transition_matrix(Data, var_path, var_conv, var_null, order=1, sep='>', flg_equal=True):
+    paths = encode_paths(Data, var_path, var_conv, var_null, sep)
+    counts = count_transitions(paths, order, keep_repeats=flg_equal)
+    return transition_tables(counts, paths.channels)
+
+
+# transition_matrix output from already counted transitions
+def transition_tables(counts, channels):
+    return {'channels': pd.DataFrame({'id_channel': range(1, len(channels) + 1),
+                                      'channel_name': channels}),
+            'transition_matrix': _transition_table(counts)}
+
+
+# states labelled like ChannelAttribution: 1-based channel ids joined by spaces
+def _transition_table(counts):
+    labels = [START] + [" ".join(str(c + 1) for c in state_channels(k, counts.order, counts.n_channels))
+                        for k in counts.keys] + [CONVERSION, NULL]
+    labels = np.array(labels, dtype=object)
+    return pd.DataFrame({'channel_from': labels[counts.src],
+                         'channel_to': labels[counts.dst],
+                         'transition_probability': counts.probabilities()})
+
+
+# order selection as in ChannelAttribution.choose_order: every order is
+# scored by the penalized ROC AUC of the one-step conversion probability
+# of each path's last state; orders with more possible states than paths
+# are skipped
+def choose_order(Data, var_path, var_conv, var_null, max_order=10, sep='>', roc_npt=100):
+    paths = encode_paths(Data, var_path, var_conv, var_null, sep)
+    vc, vn = paths.converters, paths.nonconverters
+    n_paths = (vc + vn).sum()
+    n_ch = len(paths.channels)
+
+    res = []
+    for order in range(1, max_order + 1):
+        nnodes = comb(n_ch + order - 1, order)
+        if nnodes >= n_paths:
+            res.append((order, 0.0, 0.0))
+            continue
+        counts = count_transitions(paths, order)
+        key, path_of = path_states(paths, order)
+        last_state = np.zeros(len(paths), dtype=np.int64)
+        last_state[path_of] = pd.Index(counts.keys).get_indexer(key) + 1
+
+        conv = np.bincount(counts.src[counts.dst == counts.conversion], counts.weight[counts.dst == counts.conversion],
+                           minlength=counts.n_states + 1)
+        null = np.bincount(counts.src[counts.dst == counts.null], counts.weight[counts.dst == counts.null],
+                           minlength=counts.n_states + 1)
+        end = conv + null
+        prev = np.divide(conv, end, out=np.zeros_like(conv), where=end > 0)[last_state]
+        auc = _roc_auc(prev, vc, vn, roc_npt)
+        pauc = 1 - (1 - auc) * ((n_paths - 1) / (n_paths - nnodes - 1))
+        res.append((order, auc, pauc if 0 <= pauc <= 1 else 0.0))
+
+    res = pd.DataFrame(res, columns=['order', 'auc', 'pauc'])
+    best_order = int(res.pauc.idxmax()) + 1
+    return {'auc': res[res.order <= best_order + 1], 'suggested_order': best_order}
+
+
+# ROC AUC over roc_npt evenly spaced thresholds, converters as positives
+# and nonconverters as negatives, integrated like ChannelAttribution
+def _roc_auc(prev, vc, vn, roc_npt):
+    th = np.linspace(prev.min(), prev.max(), roc_npt)[::-1]
+    order = np.argsort(prev)
+    sorted_prev = prev[order]
+    conv_cum = np.concatenate([[0], np.cumsum(vc[order])])
+    null_cum = np.concatenate([[0], np.cumsum(vn[order])])
+    below = np.searchsorted(sorted_prev, th, side='left')     # rows with prev < th
+    tpr = (conv_cum[-1] - conv_cum[below]) / conv_cum[-1]
+    fpr = (null_cum[-1] - null_cum[below]) / null_cum[-1]
+    tpr = np.concatenate([[0], tpr, [1]])
+    fpr = np.concatenate([[0], fpr, [1]])
+    return float(np.sum(np.diff(fpr) * tpr[:-1] + np.diff(fpr) * np.diff(tpr) / 2))
+
+
+def auto_markov_model(Data, var_path, var_conv, var_null, max_order=10, roc_npt=100, out_more=False, sep='>'):
+    best_order = choose_order(Data, var_path, var_conv, var_null, max_order, sep, roc_npt)['suggested_order']
+    return markov_model(Data, var_path, var_conv, var_null, order=best_order, out_more=out_more, sep=sep)
+
+
+### ----- held-out order selection -----
+# Every user (a converter or nonconverter of a path) goes to the held-out
+# set with probability holdout. Each candidate is counted on the training
+# users and scored by the log-likelihood of the held-out users' complete
+# journeys, channels and outcome, per held-out user. Repeated states are
+# kept here so every order models the same events. Next states are
+# predicted over a fixed alphabet: the states seen in training, (conversion),
+# (null) and one bucket standing for every state never seen in training,
+# with additive smoothing alpha on each, so every row is a proper
+# distribution and orders that only memorise the training journeys score low.
+
+def split_users(paths, holdout=0.2, seed=0):
+    rng = np.random.default_rng(seed)
+    test_conv = rng.binomial(paths.converters, holdout)
+    test_null = rng.binomial(paths.nonconverters, holdout)
+    return (paths.converters - test_conv, paths.nonconverters - test_null), (test_conv, test_null)
+
+
+def heldout_loglik(paths, train, test, order=1, min_count=None, alpha=0.5):
+    if min_count is None:
+        key, path_of = path_states(paths, order, keep_repeats=True)
+    else:
+        key, path_of = context_states(paths, order, min_count, keep_repeats=True)
+    keys, src, dst, step_path, outcome = _steps(key, path_of)
+    n_states = len(keys)
+    w_train = _step_weights(*train, step_path, outcome).astype(float)
+    w_test = _step_weights(*test, step_path, outcome).astype(float)
+
+    # outcomes: training states, (conversion), (null) and the unseen bucket
+    seen = np.bincount(dst, weights=w_train, minlength=n_states + 3) > 0
+    seen[n_states + 1:] = True
+    dst = np.where(seen[dst], dst, n_states + 3)
+    n_out = seen[1:n_states + 1].sum() + 3
+
+    pair, inverse = np.unique(src.astype(np.int64) * (n_states + 4) + dst, return_inverse=True)
+    n_pair = np.bincount(inverse, weights=w_train, minlength=len(pair))
+    n_test = np.bincount(inverse, weights=w_test, minlength=len(pair))
+    n_src = np.bincount(src, weights=w_train, minlength=n_states + 3)
+    p = (n_pair + alpha) / (n_src[pair // (n_states + 4)] + alpha * n_out)
+    users = test[0].sum() + test[1].sum()
+    return float(np.sum(n_test * np.log(p)) / max(users, 1))
+
+
+# best order by held-out log-likelihood among 1..max_order
+def choose_order_heldout(Data, var_path, var_conv, var_null, max_order=10, sep='>', holdout=0.2, seed=0):
+    paths = encode_paths(Data, var_path, var_conv, var_null, sep)
+    train, test = split_users(paths, holdout, seed)
+    max_order = min(max_order, int(paths.lengths.max()))
+    res = pd.DataFrame({'order': range(1, max_order + 1)})
+    res['loglik'] = [heldout_loglik(paths, train, test, k) for k in res.order]
+    return {'loglik': res, 'suggested_order': int(res.order[res.loglik.idxmax()])}
+
+
+# per candidate model: states and transitions stored, held-out log-likelihood,
+# seconds and peak traced memory of the full fit (counting plus the removal
+# effects), and the states a dense order-k table would need. Candidates
+# are the fixed orders 1..max_order and, with min_count, the variable-order
+# model with contexts of up to max_order channels. Peak memory comes from
+# tracemalloc, which slows the fits down while it runs.
+def order_report(Data, var_path, var_conv, var_null, max_order=6, min_count=None, sep='>',
+                 holdout=0.2, seed=0):
+    paths = encode_paths(Data, var_path, var_conv, var_null, sep)
+    train, test = split_users(paths, holdout, seed)
+    n_ch = len(paths.channels)
+    candidates = [(k, None) for k in range(1, min(max_order, int(paths.lengths.max())) + 1)]
+    if min_count is not None:
+        candidates.append((max_order, min_count))
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    rows = []
+    try:
+        for order, mc in candidates:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            _, _, counts = markov_conversions(paths, order, mc)
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] - base
+            rows.append({'model': 'order {}'.format(order) if mc is None else
+                                  'variable {} (min_count {})'.format(order, mc),
+                         'order': order, 'min_count': mc,
+                         'states': counts.n_states, 'transitions': len(counts.src),
+                         'dense_states': sum(n_ch ** j for j in range(1, order + 1)),
+                         'count_bytes': counts.keys.nbytes + counts.src.nbytes + counts.dst.nbytes + counts.weight.nbytes,
+                         'heldout_loglik': heldout_loglik(paths, train, test, order, mc),
+                         'fit_seconds': seconds, 'peak_bytes': peak})
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    return pd.DataFrame(rows)
+
+
+# (order, min_count) for markov_model under an order setting: 'auto'
+# (ChannelAttribution's penalized ROC AUC), 'heldout' (held-out
+# log-likelihood), 'variable' (contexts of up to max_order channels seen
+# min_count times) or a fixed order
+def select_order(Data, var_path, var_conv, var_null, order='auto', max_order=10, min_count=100, sep='>'):
+    if order == 'auto':
+        return choose_order(Data, var_path, var_conv, var_null, max_order, sep)['suggested_order'], None
+    if order == 'heldout':
+        return choose_order_heldout(Data, var_path, var_conv, var_null, max_order, sep)['suggested_order'], None
+    if order == 'variable':
+        return max_order, min_count
+    return int(order), None
+
+
+# variable-order Markov model, output like markov_model
+def variable_markov_model(Data, var_path, var_conv, var_null, max_order=4, min_count=100, out_more=False, sep='>'):
+    return markov_model(Data, var_path, var_conv, var_null, order=max_order, out_more=out_more,
+                        sep=sep, min_count=min_count)
+
+
+### ----- shapley -----
+# Channels are the players and v(S) is the number of conversions of paths
+# whose set of channels is a subset of S. Paths are reduced to a bitmask of
+# their channels, conversions are summed per bitmask and the subset sums
+# v(S) for all 2^n coalitions come from one zeta transform.
+
+# more channels than this would need a lattice of 2^n coalitions too big to hold
+SHAPLEY_MAX_CHANNELS = 20
+
+
+def coalition_values(paths):
+    masks, conv = path_coalitions(paths)
+    return subset_sums(masks, conv, len(paths.channels))
+
+
+# (bitmask of channels, conversions) summed per distinct channel set of the paths
+def path_coalitions(paths):
+    bits = np.left_shift(1, paths.codes.astype(np.int64))
+    masks, inverse = np.unique(np.bitwise_or.reduceat(bits, paths.offsets[:-1]), return_inverse=True)
+    return masks, np.bincount(inverse.ravel(), weights=paths.converters.astype(float), minlength=len(masks))
+
+
+# v(S) of every coalition S from the conversions per channel set
+def subset_sums(masks, conv, n_ch):
+    if n_ch > SHAPLEY_MAX_CHANNELS:
+        raise ValueError("shapley attribution supports at most {} channels, got {}".format(SHAPLEY_MAX_CHANNELS, n_ch))
+    v = np.bincount(masks, weights=conv, minlength=1 << n_ch)
+    # zeta transform: after the pass over channel i, v[S] sums every T <= S
+    # that differs from S only in the channels handled so far
+    for i in range(n_ch):
+        v = v.reshape(-1, 2, 1 << i)
+        v[:, 1] += v[:, 0]
+    return v.reshape(-1)
+
+
+def shapley_conversions(paths):
+    return shapley_values(coalition_values(paths), len(paths.channels))
+
+
+def shapley_values(v, n_ch):
+    S = np.arange(1 << n_ch)
+    size = sum((S >> i) & 1 for i in range(n_ch))
+    # |S|! (n - |S| - 1)! / n! for coalitions S without the player
+    weight = np.array([1 / (n_ch * comb(n_ch - 1, k)) if k < n_ch else 0 for k in range(n_ch + 1)])
+    out = np.empty(n_ch)
+    for i in range(n_ch):
+        without = S[(S >> i) & 1 == 0]
+        out[i] = np.sum(weight[size[without]] * (v[without | (1 << i)] - v[without]))
+    return out
+
+
+def shapley_model(Data, var_path, var_conv, sep='>'):
+    paths = encode_paths(Data, var_path, var_conv, None, sep)
+    return pd.DataFrame({'channel_name': paths.channels, 'shapley': shapley_conversions(paths)})
+
+
+### ----- additive model counts -----
+# With a fixed Markov order every native model reads sums over the paths
+# only: the order-k transition counts, the first / last / linear touch
+# conversions per channel and the conversions per channel set (the
+# coalitions of the Shapley model). ModelCounts holds them for one batch
+# of paths; the counts of two batches merge into the counts of both (like
+# merge_transitions, channels new in the other batch are appended), so the
+# models of appended data are solved from the merged counts without going
+# back to the paths. The order selection ('auto', 'heldout') and the
+# variable-order contexts depend on all paths at once and are not additive.
+
+class ModelCounts:
+    def __init__(self, channels, transitions, heuristics, masks, coalitions):
+        self.channels = channels
+        self.transitions = transitions
+        self.heuristics = heuristics
+        self.masks = masks
+        self.coalitions = coalitions
+
+    @classmethod
+    def from_paths(cls, paths, order=1):
+        masks, conv = path_coalitions(paths)
+        return cls(np.asarray(paths.channels, dtype=object), count_transitions(paths, order),
+                   np.vstack(heuristic_conversions(paths)), masks, conv)
+
+    @property
+    def order(self):
+        return self.transitions.order
+
+    def merge(self, other):
+        transitions, channels = merge_transitions(self.transitions, self.channels,
+                                                  other.transitions, other.channels)
+        index = {c: i for i, c in enumerate(channels)}
+        ids = np.array([index[c] for c in other.channels], dtype=np.int64)
+        heuristics = np.zeros((3, len(channels)))
+        heuristics[:, :len(self.channels)] = self.heuristics
+        heuristics[:, ids] += other.heuristics
+        masks, inverse = np.unique(np.concatenate([self.masks, _remap_masks(other.masks, ids)]),
+                                   return_inverse=True)
+        coalitions = np.bincount(inverse.ravel(), weights=np.concatenate([self.coalitions, other.coalitions]))
+        return ModelCounts(channels, transitions, heuristics, masks, coalitions)
+
+    # (first, last, linear, markov, shapley) conversions per channel and the
+    # Markov removal effects, as heuristic_conversions / markov_conversions /
+    # shapley_conversions give them on the paths
+    def conversions(self):
+        n_ch = len(self.channels)
+        removal = removal_effects(conversion_probabilities(self.transitions))
+        first, last, linear = self.heuristics
+        markov = removal_conversions(first.sum(), removal)
+        shapley = shapley_values(subset_sums(self.masks, self.coalitions, n_ch), n_ch)
+        return np.vstack([first, last, linear, markov, shapley]), removal
+
+
+# channel set bitmasks with channel i renumbered ids[i]
+def _remap_masks(masks, ids):
+    out = np.zeros(len(masks), dtype=np.int64)
+    for i, c in enumerate(ids):
+        out |= ((masks >> i) & 1) << c
+    return out
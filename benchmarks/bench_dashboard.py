@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+import statistics
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+FILTERS = ['full', 'One', 'Two']
+
+
+# Dashboard.py end to end on synthetic data: module load (cold, building the
+# Feather cache, and warm, reading it), str_to_path, every callback per
+# filter, the first render (every figure callback the page load fires,
+# with only the Summary tab open) and the peak RSS. Every size runs in fresh processes started in a
+# folder holding the synthetic MTA_Input.csv, so module state, caches and
+# peak memory never leak from one measurement into the next.
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed(fn, *args, repeat=1):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+# runs inside the data folder; prints one JSON object
+def child(stage, repeat):
+    start = time.perf_counter()
+    import Dashboard as D
+    row = {'module_load_s': time.perf_counter() - start, 'peak_rss_load_mb': peak_rss_mb()}
+    if stage == 'load':
+        print(json.dumps(row))
+        return
+
+    import pandas as pd
+    from preprocess import str_to_path, paths_to_clean
+    str_path = pd.read_csv('MTA_Input.csv', usecols=['str_path']).str_path
+    row['str_to_path_s'] = timed(lambda: str_path.apply(str_to_path))
+    row['paths_to_clean_s'] = timed(paths_to_clean, str_path)
+    del str_path
+
+    from dash.exceptions import PreventUpdate
+    first, last = D.first_touch_names, D.last_touch_names
+    # the channel counts the checklist holds for each preset filter
+    counts = {f: D.data_store.current.filter_counts(f) or D.data_store.current.counts for f in FILTERS}
+    # each callback with its tab open and nothing drawn yet
+    callbacks = {
+        'update_sankey': lambda c, tab='sankey': D.update_sankey(c, first, last, 'Converters', tab, None),
+        'Update_first_Last_graph': lambda c, tab='touch': D.Update_first_Last_graph(c, tab, None),
+        'update_pie_fig': lambda c, tab='summary': D.update_pie_fig(c, tab, None),
+        'update_channel_cnt_fig': lambda c, tab='summary': D.update_channel_cnt_fig(c, tab, None),
+        'plot_model_conv': lambda c, tab='model': D.plot_model_conv(c, [], None, tab, None),
+    }
+
+    # page load: every callback fires with the Summary tab selected, the
+    # other tabs' callbacks return at once (and no model fit starts)
+    def first_render():
+        for fn in callbacks.values():
+            try:
+                fn(counts['full'], tab='summary')
+            except PreventUpdate:
+                pass
+    row['first_render_s'] = timed(first_render, repeat=repeat)
+
+    model = callbacks.pop('plot_model_conv')
+    for name, fn in callbacks.items():
+        row[name + '_s'] = {f: timed(fn, counts[f], repeat=repeat) for f in FILTERS}
+
+    # first call fits the models, the second one is answered from the model cache
+    row['plot_model_conv_fit_s'] = {f: timed(model, counts[f]) for f in FILTERS}
+    row['plot_model_conv_cached_s'] = {f: timed(model, counts[f], repeat=repeat) for f in FILTERS}
+    row['peak_rss_mb'] = peak_rss_mb()
+    print(json.dumps(row))
+
+
+def run_child(folder, stage, args):
+    env = dict(os.environ, PYTHONPATH=REPO, MODEL_ENGINE=args.engine,
+               MODEL_BACKGROUND='0', MODEL_CACHE_WARMUP='0')
+    env.pop('MODEL_CACHE_DIR', None)
+    env.pop('MTA_CACHE_PATH', None)
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', stage, '--repeat', str(args.repeat)],
+                         cwd=folder, env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def bench(n, args):
+    from synthetic import make_paths
+    folder = os.path.join(args.data_dir, 'rows_{}'.format(n))
+    os.makedirs(folder, exist_ok=True)
+    csv_path = os.path.join(folder, 'MTA_Input.csv')
+    if not os.path.exists(csv_path):
+        make_paths(n, seed=args.seed).to_csv(csv_path, index=False)
+    cache_path = os.path.join(folder, 'MTA_Input.feather')
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+
+    row = {'rows': n, 'engine': args.engine}
+    cold = run_child(folder, 'load', args)
+    row['module_load_cold_s'] = cold['module_load_s']
+    row['peak_rss_load_cold_mb'] = cold['peak_rss_load_mb']
+    row.update(run_child(folder, 'all', args))
+    return row
+
+
+# flat {name: seconds} of a result row, nested per-filter timings as name[filter]
+def timings(row):
+    out = {}
+    for k, v in row.items():
+        if isinstance(v, dict):
+            out.update({'{}[{}]'.format(k, f): t for f, t in v.items()})
+        elif k.endswith('_s'):
+            out[k] = v
+    return out
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {row['rows']: row for row in json.load(f)}
+    for row in results:
+        if row['rows'] not in baseline:
+            continue
+        old = timings(baseline[row['rows']])
+        for k, t in timings(row).items():
+            if k in old and old[k] > 0:
+                print("{:>10,} rows  {:<40} {:>9.3f}s  baseline {:>9.3f}s  x{:.2f}".format(
+                    row['rows'], k, t, old[k], t / old[k]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dashboard.py load, preprocessing, callback and memory benchmark")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 1_000_000, 10_000_000])
+    parser.add_argument("--engine", default="native", help="MODEL_ENGINE used by plot_model_conv")
+    parser.add_argument("--repeat", type=int, default=3, help="median of this many calls per callback")
+    parser.add_argument("--data-dir", default=os.path.join(REPO, "benchmarks", "data"),
+                        help="folder for the synthetic datasets, reused between runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.repeat)
+        sys.exit()
+
+    results = []
+    for n in args.rows:
+        row = bench(n, args)
+        results.append(row)
+        print(json.dumps(row))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        compare(results, args.baseline)
@@ -0,0 +1,56 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import attribution
+from preprocess import paths_to_clean
+from synthetic import make_paths
+
+
+# native auto_markov_model against ChannelAttribution.auto_markov_model.
+# ChannelAttribution simulates random walks capped at the longest observed
+# path, the native engine solves the absorbing chain exactly, so results
+# agree up to simulation noise and the effect of that step cap.
+def compare(Data, reference=True):
+    row = {'rows': len(Data)}
+    start = time.perf_counter()
+    native = attribution.auto_markov_model(Data, 'path_clean', 'converters', 'nonconverters', out_more=True)
+    row['native_s'] = time.perf_counter() - start
+
+    if reference:
+        import ChannelAttribution as CA
+        start = time.perf_counter()
+        ref = CA.auto_markov_model(Data, 'path_clean', 'converters', 'nonconverters',
+                                   out_more=True, verbose=False, flg_adv=False)
+        row['channelattribution_s'] = time.perf_counter() - start
+        row['speedup'] = row['channelattribution_s'] / row['native_s']
+
+        res = ref['result'].merge(native['result'], on='channel_name', suffixes=('_ref', '_native'))
+        rel = (res.total_conversions_native / res.total_conversions_ref - 1).abs()
+        row['max_rel_diff_conversions'] = float(rel.max())
+        re = ref['removal_effects'].merge(native['removal_effects'], on='channel_name', suffixes=('_ref', '_native'))
+        row['max_abs_diff_removal_effect'] = float((re.removal_effect_native - re.removal_effect_ref).abs().max())
+    return row
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="native vs ChannelAttribution Markov attribution")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000_000, 10_000_000, 50_000_000])
+    parser.add_argument("--no-reference", action="store_true", help="only time the native engine")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for n in args.rows:
+        Data = make_paths(n)
+        Data['path_clean'] = paths_to_clean(Data.str_path)
+        row = compare(Data, reference=not args.no_reference)
+        results.append(row)
+        print(json.dumps(row))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
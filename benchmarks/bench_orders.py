@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pandas as pd
+
+import attribution
+from preprocess import paths_to_clean
+from synthetic import make_paths
+
+
+# fit time, peak memory, stored states and held-out log-likelihood of every
+# Markov order (and of the variable-order model) on synthetic data or on a
+# CSV with path_clean / converters / nonconverters or str_path columns, to
+# pick MODEL_MARKOV_ORDER for production
+def report(Data, args):
+    res = attribution.order_report(Data, 'path_clean', 'converters', 'nonconverters', max_order=args.max_order,
+                                   min_count=args.min_count, holdout=args.holdout, seed=args.seed)
+    res.insert(0, 'rows', len(Data))
+    return res
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Markov model order: time, memory and held-out likelihood")
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--csv", help="use this dataset instead of synthetic paths")
+    parser.add_argument("--max-order", type=int, default=6)
+    parser.add_argument("--min-count", type=int, default=100, help="context support of the variable-order model")
+    parser.add_argument("--holdout", type=float, default=0.2, help="share of users held out for the likelihood")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.csv:
+        datasets = [pd.read_csv(args.csv)]
+    else:
+        datasets = (make_paths(n, seed=args.seed) for n in args.rows)
+
+    results = []
+    for Data in datasets:
+        if 'path_clean' not in Data:
+            Data['path_clean'] = paths_to_clean(Data.str_path)
+        res = report(Data, args)
+        print(res.to_string(index=False))
+        results.extend(res.to_dict('records'))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, default=float)
@@ -0,0 +1,66 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from compact import CompactPaths
+from aggregates import build_cube
+from parallel import compact_from_frame, cube_from_paths
+from synthetic import make_paths
+
+
+# serial CompactPaths.from_frame + build_cube against parallel.py with 1,
+# 2, 4, ... workers: seconds, speedup, and a check that every derived
+# array, the cube and the fingerprint are identical to the serial ones.
+# The speedup is bounded by the cores of the machine (os.cpu_count()).
+
+ARRAYS = ['codes', 'offsets', 'converters', 'nonconverters', 'users_count', 'first_touch', 'last_touch']
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - start
+
+
+def bench(n, workers, seed=0):
+    Data = make_paths(n, seed=seed)
+    paths, t_parse = timed(CompactPaths.from_frame, Data)
+    cube, t_cube = timed(build_cube, paths.frame())
+    fingerprint = paths.fingerprint()
+    rows = [{'rows': n, 'workers': 'serial', 'parse_s': t_parse, 'cube_s': t_cube, 'speedup': 1.0}]
+    for w in workers:
+        p_paths, p_parse = timed(compact_from_frame, Data, w)
+        p_cube, p_cube_t = timed(cube_from_paths, p_paths, w)
+        identical = all(np.array_equal(getattr(paths, a), getattr(p_paths, a)) and
+                        getattr(paths, a).dtype == getattr(p_paths, a).dtype for a in ARRAYS) \
+            and cube.equals(p_cube) and (cube.dtypes == p_cube.dtypes).all() \
+            and p_paths.fingerprint() == fingerprint
+        if not identical:
+            raise AssertionError('{} workers on {} rows differ from the serial result'.format(w, n))
+        rows.append({'rows': n, 'workers': w, 'parse_s': p_parse, 'cube_s': p_cube_t,
+                     'speedup': (t_parse + t_cube) / (p_parse + p_cube_t)})
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="parallel preprocessing scaling and determinism")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000_000])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    print('cores: {}'.format(os.cpu_count()))
+    results = []
+    for n in args.rows:
+        for row in bench(n, args.workers, args.seed):
+            print(json.dumps(row))
+            results.append(row)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import gzip
+import argparse
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+# payload settings of each run, see payload.py
+MODES = {
+    'before': dict(FIGURE_TYPED_ARRAYS='0', FIGURE_TEMPLATE='plotly', RESPONSE_COMPRESSION='0'),
+    'lists': dict(FIGURE_TYPED_ARRAYS='0', FIGURE_TEMPLATE='adflow', RESPONSE_COMPRESSION='1'),
+    'typed': dict(FIGURE_TYPED_ARRAYS='1', FIGURE_TEMPLATE='adflow', RESPONSE_COMPRESSION='1'),
+}
+# the tab each figure is drawn on
+TABS = {'fig_conv_count': 'summary', 'fig_group_channel_cnt': 'summary', 'fig-Sankey': 'sankey',
+        'fig-first_last_count': 'touch', 'fig-model': 'model', 'fig-explorer': 'explorer',
+        'fig-budget': 'budget', 'fig-cohort': 'cohort'}
+
+
+# Bytes of every figure callback of Dashboard.py on synthetic data, as the
+# browser receives them through /_dash-update-component (the full response
+# of the callback, every figure it returns) for the full dataset:
+#   before   numeric arrays as JSON lists and the default 'plotly' template
+#            (what Dash sends with plotly < 6), no compression
+#   lists    lists, the slim 'adflow' template, gzip / brotli responses
+#   typed    base64 typed arrays (plotly.js 2.28+), 'adflow', compressed
+# `json` is the uncompressed body, `gzip` / `br` the bytes on the wire.
+# Every mode runs in a fresh process in the data folder; the typed bodies
+# are decoded and checked against the lists ones (the same figures).
+
+def child(mode):
+    import pandas as pd
+    import Dashboard as D
+    import payload
+
+    client = D.server.test_client()
+    client.get('/')
+    snapshot = D.data_store.current
+    users = ' '.join(pd.read_csv('MTA_Input.csv', nrows=200).user_id.str.split(' ').str[0])
+    values = {'filter_channel_cnt.value': snapshot.counts, 'filter-First.value': D.first_touch_names,
+              'filter-Last.value': D.last_touch_names, 'filter-convert.value': 'Converters',
+              'model-ci.value': [], 'explorer-prefix.data': [], 'explorer-top.value': 10,
+              'explorer-sort.value': 'converters', 'cohort-lookup.n_clicks': 1, 'cohort-users.value': users}
+    encodings = ['gzip'] + (['br'] if payload.brotli is not None else [])
+
+    def props(deps, tab):
+        out = []
+        for dep in deps:
+            if dep['id'].startswith('{'):
+                ids = [{'type': 'budget-scale', 'channel': name} for name in D.channel_names]
+                out.append([{'id': i, 'property': dep['property'],
+                             'value': i if dep['property'] == 'id' else 1} for i in ids])
+            else:
+                key = '{}.{}'.format(dep['id'], dep['property'])
+                out.append({'id': dep['id'], 'property': dep['property'],
+                            'value': tab if key == 'tabs.value' else values.get(key)})
+        return out
+
+    def post(dep, tab, changed, encoding=None):
+        outputs = [{'id': o.split('.')[0], 'property': o.split('.')[1]}
+                   for o in dep['output'].strip('.').split('...')]
+        body = {'output': dep['output'], 'outputs': outputs if len(outputs) > 1 else outputs[0],
+                'inputs': props(dep['inputs'], tab), 'state': props(dep['state'], tab),
+                'changedPropIds': [changed]}
+        r = client.post('/_dash-update-component', json=body,
+                        headers={'Accept-Encoding': encoding or 'identity'})
+        if r.status_code != 200:
+            raise RuntimeError('{} answered {}: {}'.format(dep['output'], r.status_code, r.data[:300]))
+        return r.data, r.headers.get('Content-Encoding')
+
+    results = {}
+    for dep in client.get('/_dash-dependencies').json:
+        figure = next((o.split('.')[0] for o in dep['output'].strip('.').split('...')
+                       if o.endswith('.figure') and o.split('.')[0] in TABS), None)
+        if figure is None:
+            continue
+        runs = {figure: 'tabs.value'}
+        if figure == 'fig-Sankey':
+            runs['fig-Sankey (patch)'] = 'filter-convert.value'
+        for name, changed in runs.items():
+            data, _ = post(dep, TABS[figure], changed)
+            row = results[name] = {'json': len(data), 'body': data.decode()}
+            for encoding in encodings:
+                wire, used = post(dep, TABS[figure], changed, encoding)
+                row[encoding] = len(wire) if used == encoding else None
+    print(json.dumps(results))
+
+
+def run_child(folder, mode, args):
+    env = dict(os.environ, PYTHONPATH=REPO, MODEL_ENGINE=args.engine, MODEL_BACKGROUND='0',
+               MODEL_CACHE_WARMUP='0', USER_INDEX='1', **MODES[mode])
+    env.pop('MODEL_CACHE_DIR', None)
+    env.pop('MTA_CACHE_PATH', None)
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode],
+                         cwd=folder, env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+# a response body with every typed array decoded to a list
+def decoded(body):
+    from payload import decode_array, list_array
+
+    def walk(value):
+        if isinstance(value, dict):
+            if 'bdata' in value and 'dtype' in value:
+                return list_array(decode_array(value))
+            return {k: walk(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [walk(v) for v in value]
+        return value
+    return walk(json.loads(body))
+
+
+def bench(n, args):
+    from synthetic import make_paths
+    folder = os.path.join(args.data_dir, 'rows_{}'.format(n))
+    os.makedirs(folder, exist_ok=True)
+    csv_path = os.path.join(folder, 'MTA_Input.csv')
+    if not os.path.exists(csv_path):
+        make_paths(n, seed=args.seed).to_csv(csv_path, index=False)
+
+    runs = {mode: run_child(folder, mode, args) for mode in MODES}
+    rows = []
+    for figure, before in runs['before'].items():
+        lists, typed = runs['lists'][figure], runs['typed'][figure]
+        if decoded(typed['body']) != decoded(lists['body']):
+            raise AssertionError('the typed and list payloads of {} differ'.format(figure))
+        row = {'rows': n, 'figure': figure}
+        for mode, result in runs.items():
+            row[mode] = {k: v for k, v in result[figure].items() if k != 'body'}
+        best = min(v for v in [typed['json'], typed.get('gzip'), typed.get('br')] if v)
+        row['reduction'] = before['json'] / best
+        row['gzip_only'] = len(gzip.compress(before['body'].encode()))
+        rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="payload bytes of every figure callback, before and after")
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000])
+    parser.add_argument("--engine", default="native", help="MODEL_ENGINE used by plot_model_conv")
+    parser.add_argument("--data-dir", default=os.path.join(REPO, "benchmarks", "data"),
+                        help="folder for the synthetic datasets, reused between runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        sys.exit()
+
+    results = []
+    for n in args.rows:
+        for row in bench(n, args):
+            print(json.dumps(row))
+            results.append(row)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
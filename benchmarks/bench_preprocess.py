@@ -0,0 +1,55 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from preprocess import str_to_path, paths_to_clean, channels_count, users_count
+from synthetic import make_paths
+
+
+# row by row preprocessing as done originally in Dashboard.py
+def legacy(Data):
+    Data['channels_count'] = Data.str_path.apply(lambda x: x.count("&"))
+    Data['users_count'] = Data.user_id.apply(lambda x: x.count(" ")+1)
+    Data["path_clean"] = Data.str_path.apply(str_to_path)
+    return Data
+
+
+def vectorized(Data):
+    Data['channels_count'] = channels_count(Data.str_path)
+    Data['users_count'] = users_count(Data.user_id)
+    Data['path_clean'] = paths_to_clean(Data.str_path)
+    return Data
+
+
+def timed(fn, Data):
+    start = time.perf_counter()
+    out = fn(Data.copy())
+    return out, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="rows/second of the path preprocessing")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for n in args.rows:
+        Data = make_paths(n)
+        old, t_old = timed(legacy, Data)
+        new, t_new = timed(vectorized, Data)
+        for col in ['channels_count', 'users_count', 'path_clean']:
+            assert (old[col] == new[col]).all(), col
+        results.append({'rows': n,
+                        'legacy_rows_per_s': n / t_old,
+                        'vectorized_rows_per_s': n / t_new,
+                        'speedup': t_old / t_new})
+        print("{:>10,} rows   legacy {:>12,.0f} rows/s   vectorized {:>12,.0f} rows/s   x{:.1f}".format(
+            n, n / t_old, n / t_new, t_old / t_new))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,112 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from compact import CompactPaths
+from aggregates import build_cube, touch_stats
+from models import run_models
+from preview import PreviewSample, preview_models, replicate_bounds
+from synthetic import make_paths
+
+MODELS = ['first_touch', 'last_touch', 'linear_touch', 'markov_model', 'shapley']
+
+
+# preview.py against the exact results on synthetic data, per sample size:
+# seconds, weighted and max relative error of the preview estimates and
+# the share of exact values inside their 95% bounds, for
+#   touch     first / last touch conversions by channel (Touch Points tab)
+#   sankey    converters by first -> last touch link (Sankey tab)
+#   models    every model column of run_models (model tab)
+# The exact touch and Sankey values are sums over the aggregate cube and
+# take milliseconds whatever the size, so the dashboard previews only the
+# models; the first two rows show what a sample would cost them.
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+
+def touch_values(cube):
+    return pd.concat([touch_stats(cube, touch).set_index('channel').conversion.rename(lambda c: touch + ':' + c)
+                      for touch in ['first_touch', 'last_touch']])
+
+
+def sankey_values(cube):
+    return cube.groupby(['first_touch', 'last_touch'], observed=True).converters.sum()
+
+
+def model_values(R):
+    return R.set_index('channel')[MODELS].stack().rename_axis(['channel', 'model'])
+
+
+# errors of the preview (mean) against exact, and the share of exact values
+# inside the bounds; all arrays aligned with the index of exact
+def accuracy(exact, mean, lower, upper):
+    x = exact.to_numpy(float)
+    pos = x > 0
+    return {'wape': float(np.abs(mean - x).sum() / max(x.sum(), 1)),
+            'max_rel_err': float(np.max(np.abs(mean[pos] / x[pos] - 1))) if pos.any() else 0.0,
+            'coverage': float(np.mean((lower <= x) & (x <= upper)))}
+
+
+def replicate_accuracy(exact, estimates):
+    return accuracy(exact, *replicate_bounds([e.reindex(exact.index, fill_value=0).to_numpy() for e in estimates]))
+
+
+def bench(n, args):
+    paths = CompactPaths.from_frame(make_paths(n, seed=args.seed))
+    cube, cube_s = timed(build_cube, paths.frame())
+    exact_touch, touch_s = timed(touch_values, cube)
+    exact_sankey, sankey_s = timed(sankey_values, cube)
+    markov = dict(order=args.markov_order)
+    (R, _, _, _), model_s = timed(run_models, paths.model_input(), args.engine, markov=markov)
+    exact_models = model_values(R)
+    total = int(paths.converters.sum())
+
+    rows = [{'rows': n, 'sample': 'exact', 'cube_s': cube_s, 'touch_s': touch_s, 'sankey_s': sankey_s,
+             'models_s': model_s}]
+    for size in args.sample:
+        sample, build_s = timed(PreviewSample.build, paths, size, args.replicates, args.seed)
+        cubes, cubes_s = timed(sample.cubes)
+        touch, t_s = timed(lambda: [touch_values(c) for c in cubes])
+        sankey, s_s = timed(lambda: [sankey_values(c) for c in cubes])
+        inputs, inputs_s = timed(sample.model_inputs)
+        (_, intervals), m_s = timed(preview_models, inputs, total, markov, max_order=args.max_order)
+        bounds = intervals.set_index(['channel', 'model']).reindex(exact_models.index)
+        rows.append({'rows': n, 'sample': size, 'replicates': args.replicates, 'build_s': build_s,
+                     'touch_s': cubes_s + t_s, 'sankey_s': cubes_s + s_s, 'models_s': inputs_s + m_s,
+                     'touch': replicate_accuracy(exact_touch, touch),
+                     'sankey': replicate_accuracy(exact_sankey, sankey),
+                     'models': accuracy(exact_models, bounds.estimate.fillna(0).to_numpy(),
+                                        bounds.lower.to_numpy(), bounds.upper.to_numpy())})
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="preview sample accuracy and time against the exact results")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000_000])
+    parser.add_argument("--sample", type=int, nargs="+", default=[10_000, 50_000, 200_000],
+                        help="journeys in the preview sample")
+    parser.add_argument("--replicates", type=int, default=5)
+    parser.add_argument("--max-order", type=int, default=3, help="highest Markov order of the preview fits")
+    parser.add_argument("--engine", default="native", help="MODEL_ENGINE of the exact models")
+    parser.add_argument("--markov-order", default="heldout")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for n in args.rows:
+        for row in bench(n, args):
+            print(json.dumps(row))
+            results.append(row)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,64 @@
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+
+# stream.stream_aggregate on a synthetic CSV: seconds and peak RSS per
+# chunk size, each run in a fresh process so peak memory is its own.
+# Peak RSS should follow the chunk size, not the number of rows.
+
+def child(csv_path, chunksize, order):
+    from stream import stream_aggregate
+    start = time.perf_counter()
+    result = stream_aggregate(csv_path, chunksize, order)
+    print(json.dumps({'chunksize': chunksize, 'order': order, 'rows': result.rows,
+                      'seconds': time.perf_counter() - start,
+                      'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+
+
+def bench(n, args):
+    from synthetic import make_paths
+    folder = os.path.join(args.data_dir, 'rows_{}'.format(n))
+    os.makedirs(folder, exist_ok=True)
+    csv_path = os.path.join(folder, 'MTA_Input.csv')
+    if not os.path.exists(csv_path):
+        make_paths(n, seed=args.seed).to_csv(csv_path, index=False)
+    rows = []
+    for chunksize in args.chunksize:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', csv_path,
+                              '--chunksize', str(chunksize), '--order', str(args.order)],
+                             env=dict(os.environ, PYTHONPATH=REPO), check=True, capture_output=True, text=True).stdout
+        rows.append(json.loads(out.strip().splitlines()[-1]))
+        print(json.dumps(rows[-1]))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="streaming aggregation time and peak memory per chunk size")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000_000, 10_000_000])
+    parser.add_argument("--chunksize", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--order", type=int, default=1)
+    parser.add_argument("--data-dir", default=os.path.join(REPO, "benchmarks", "data"),
+                        help="folder for the synthetic datasets, reused between runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.chunksize[0], args.order)
+        sys.exit()
+
+    results = []
+    for n in args.rows:
+        results.extend(bench(n, args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
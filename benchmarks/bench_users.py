@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from compact import CompactPaths
+from data_loader import build_users, read_users
+from models import run_models
+from users import UserIndex, Cohort
+from synthetic import make_paths
+
+
+# users.UserIndex on synthetic data (~1.7 user IDs per row, so 6M rows hold
+# ~10M IDs): building it, writing it next to a cache and memory-mapping it
+# back, then per cohort size the lookup, the cohort journeys and the
+# attribution models, against the full string scan of user_id a lookup
+# needed before (split every row, match the IDs). The rows found are checked
+# against the scan for the smallest cohort.
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+
+# rows listing any of user_ids, by splitting every user_id string
+def scan(user_id, user_ids):
+    tokens = user_id.str.split(' ').explode()
+    return np.unique(tokens.index[tokens.isin(set(user_ids))].to_numpy())
+
+
+def bench(n, args):
+    Data = make_paths(n, seed=args.seed)
+    paths = CompactPaths.from_frame(Data)
+    user_id = pa.array(Data.user_id, pa.string())
+    index, build_s = timed(UserIndex.from_user_ids, user_id)
+    with tempfile.TemporaryDirectory() as folder:
+        users_path = os.path.join(folder, 'MTA_Input.users.feather')
+        table = pa.table({'user_id': user_id}).replace_schema_metadata({b'mta_source': b'{}'})
+        _, write_s = timed(build_users, table, users_path)
+        index, open_s = timed(read_users, users_path)
+        size = os.path.getsize(users_path)
+
+        # cohorts drawn from the indexed IDs
+        rng = np.random.default_rng(args.seed)
+        ids = Data.user_id.iloc[rng.integers(0, n, max(args.cohort))].str.split(' ').str[0].tolist()
+        rows = [{'rows': n, 'user_ids': len(index), 'build_s': build_s, 'build_write_s': write_s,
+                 'open_s': open_s, 'file_mb': size / 2**20}]
+        for k in args.cohort:
+            cohort_ids = list(dict.fromkeys(ids[:k]))
+            (found_rows, users, found), lookup_s = timed(index.lookup, cohort_ids)
+            cohort = Cohort.from_rows(paths, found_rows, users, len(cohort_ids), found)
+            journeys, journeys_s = timed(cohort.journeys, paths)
+            row = {'rows': n, 'cohort': len(cohort_ids), 'found': found, 'journeys': int(journeys.journeys.sum()),
+                   'lookup_s': lookup_s, 'journeys_s': journeys_s}
+            if journeys.converters.sum() > 0:
+                _, row['models_s'] = timed(run_models, journeys[['path_clean', 'converters', 'nonconverters']],
+                                           args.engine, markov=dict(order=args.markov_order))
+            if k == min(args.cohort):
+                expected, row['scan_s'] = timed(scan, Data.user_id, cohort_ids)
+                if not np.array_equal(expected, found_rows):
+                    raise AssertionError('the index and the scan find different rows for {} users'.format(k))
+            rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="user ID index build, load and cohort lookup times")
+    parser.add_argument("--rows", type=int, nargs="+", default=[6_000_000])
+    parser.add_argument("--cohort", type=int, nargs="+", default=[1, 100, 10_000, 100_000],
+                        help="user IDs per cohort")
+    parser.add_argument("--engine", default="native", help="COHORT_ENGINE of the cohort models")
+    parser.add_argument("--markov-order", default="heldout")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for n in args.rows:
+        for row in bench(n, args):
+            print(json.dumps(row))
+            results.append(row)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,68 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from preprocess import CHANNEL_MAP
+
+CODES = np.array(list(CHANNEL_MAP.keys()), dtype=object)
+NAMES = np.array(list(CHANNEL_MAP.values()), dtype=object)
+
+
+# join the tokens of each row (rows given by a lengths array) with sep,
+# vectorized per path length
+def _join_rows(tokens, lengths, sep):
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    out = np.empty(len(lengths), dtype=object)
+    for L in np.unique(lengths):
+        rows = np.flatnonzero(lengths == L)
+        joined = tokens[offsets[rows]]
+        for j in range(1, L):
+            joined = joined + sep + tokens[offsets[rows] + j]
+        out[rows] = joined
+    return out
+
+
+# synthetic MTA_Input.csv rows: str_path like "1&A_SA@2&P_SP", with
+# touchpoints shuffled in a share of the rows, space separated user_id,
+# converters / nonconverters and first_touch / last_touch channel names
+def make_paths(n_rows, max_len=8, shuffle_share=0.3, conv_rate=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = np.minimum(rng.geometric(0.45, n_rows), max_len)
+    row = np.repeat(np.arange(n_rows), lengths)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    position = np.arange(len(row)) - offsets[row] + 1
+    channel = rng.integers(0, len(CODES), len(row))
+
+    tokens = position.astype(str).astype(object) + "&" + CODES[channel]
+    shuffled = rng.random(n_rows) < shuffle_share
+    key = np.where(shuffled[row], rng.random(len(row)), position)
+    order = np.lexsort((key, row))
+    str_path = _join_rows(tokens[order], lengths, "@")
+
+    users = 1 + rng.poisson(0.7, n_rows)
+    user_tokens = "u" + rng.integers(0, max(n_rows * 2, 10), users.sum()).astype(str).astype(object)
+    user_id = _join_rows(user_tokens, users, " ")
+    converters = rng.binomial(users, conv_rate)
+
+    return pd.DataFrame({
+        'path_id': np.arange(n_rows),
+        'str_path': str_path,
+        'user_id': user_id,
+        'converters': converters,
+        'nonconverters': users - converters,
+        'first_touch': NAMES[channel[offsets[:-1]]],
+        'last_touch': NAMES[channel[offsets[1:] - 1]],
+    })
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="write a synthetic MTA_Input.csv")
+    parser.add_argument("rows", type=int)
+    parser.add_argument("--out", default="MTA_Input.csv")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    make_paths(args.rows, seed=args.seed).to_csv(args.out, index=False)
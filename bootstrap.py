@@ -0,0 +1,141 @@
+import os
+import time
+import multiprocessing
+from functools import partial
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import attribution
+
+MODELS = ['first_touch', 'last_touch', 'linear_touch', 'markov_model', 'shapley']
+
+
+### ----- ----- ----- ----- -----
+### ----- bootstrap intervals -----
+### ----- ----- ----- ----- -----
+# Every user of the dataset is one draw (path, converted or not); a resample
+# redraws the same number of users with probabilities proportional to the
+# converters / nonconverters of each path. All models of the model tab are
+# refitted per resample with the native engine across a process pool.
+# The encoded paths and the draw probabilities of the (path, outcome) pairs
+# live in shared memory; a task carries the segment names and the seed of
+# its resample (SeedSequence.spawn, so the resamples are independent and
+# reproducible) and draws its own counts, so no resample x paths matrix is
+# ever held in one process.
+# The pool belongs to one bootstrap_intervals call and is terminated when it
+# returns, so no resample outlives the time limit. Called from a JobManager
+# worker, every bootstrap job adds max_workers processes of its own.
+
+def _share(arr):
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def _attach(spec, segments):
+    name, shape, dtype = spec
+    # workers share the parent's resource tracker, the parent unlinks the segment
+    shm = shared_memory.SharedMemory(name=name)
+    segments.append(shm)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _fit_resample(specs, channels, order, min_count, n_users, seed):
+    segments = []
+    try:
+        return _fit(specs, channels, order, min_count, n_users, seed, segments)
+    finally:
+        for shm in segments:
+            shm.close()
+
+
+def _fit(specs, channels, order, min_count, n_users, seed, segments):
+    codes = _attach(specs['codes'], segments)
+    offsets = _attach(specs['offsets'], segments)
+    counts = resample_counts(_attach(specs['probabilities'], segments), n_users, seed)
+    paths = attribution.PathTable(channels, codes, offsets, counts[0], counts[1])
+    first, last, linear = attribution.heuristic_conversions(paths)
+    markov, _, _ = attribution.markov_conversions(paths, order, min_count)
+    return np.vstack([first, last, linear, markov, attribution.shapley_conversions(paths)])
+
+
+# draw probabilities of the (path, outcome) pairs, converters first, and the number of users
+def draw_probabilities(paths):
+    weights = np.concatenate([paths.converters, paths.nonconverters]).astype(float)
+    n_users = int(weights.sum())
+    return weights / max(n_users, 1), n_users
+
+
+# one multinomial resample of the (path, outcome) counts, shape (2, paths)
+def resample_counts(probabilities, n_users, seed):
+    draws = np.random.default_rng(seed).multinomial(n_users, probabilities)
+    return draws.reshape(2, -1)
+
+
+# per-channel percentile intervals for every model column of R.
+# n_resamples is the resample budget; time_limit (seconds) stops waiting for
+# outstanding resamples, the intervals then use the ones that finished.
+# order fixes the Markov order; without it the order comes from the markov
+# setting of run_models (attribution.select_order), chosen once on Data.
+# returns a frame with channel, model, estimate, lower, upper and the number
+# of resamples the interval is based on
+def bootstrap_intervals(Data, n_resamples=200, time_limit=60, alpha=0.05, order=None,
+                        max_workers=None, seed=0, progress=None, markov=None):
+    progress = progress or (lambda step, total, label: None)
+    paths = attribution.encode_paths(Data, 'path_clean', 'converters', 'nonconverters')
+    probabilities, n_users = draw_probabilities(paths)
+    if n_users == 0:
+        return _intervals(paths.channels, np.zeros((len(MODELS), len(paths.channels))), [], alpha)
+    min_count = None
+    if order is None:
+        order, min_count = attribution.select_order(Data, 'path_clean', 'converters', 'nonconverters',
+                                                    **(markov or {}))
+
+    first, last, linear = attribution.heuristic_conversions(paths)
+    markov_conv, _, _ = attribution.markov_conversions(paths, order, min_count)
+    estimate = np.vstack([first, last, linear, markov_conv, attribution.shapley_conversions(paths)])
+
+    shared = [_share(paths.codes), _share(paths.offsets), _share(probabilities)]
+    specs = dict(zip(['codes', 'offsets', 'probabilities'], [spec for _, spec in shared]))
+    seeds = np.random.SeedSequence(seed).spawn(n_resamples)
+    progress(0, n_resamples, 'bootstrap resamples')
+    fits = []
+    deadline = time.monotonic() + time_limit
+    pool = multiprocessing.Pool(max_workers or os.cpu_count())
+    try:
+        results = pool.imap_unordered(partial(_fit_resample, specs, paths.channels, order, min_count, n_users),
+                                      seeds)
+        while len(fits) < n_resamples:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                fits.append(results.next(timeout=remaining))
+            except multiprocessing.TimeoutError:
+                break
+            progress(len(fits), n_resamples, 'bootstrap resamples')
+    finally:
+        # resamples still running past the time limit are killed with the pool
+        pool.terminate()
+        pool.join()
+        for shm, _ in shared:
+            shm.close()
+            shm.unlink()
+
+    return _intervals(paths.channels, estimate, fits, alpha)
+
+
+# the bootstrap_intervals frame of the estimates (models x channels) and the
+# resample fits; no bounds without fits
+def _intervals(channels, estimate, fits, alpha):
+    if fits:
+        lower = np.percentile(fits, 100 * alpha / 2, axis=0)
+        upper = np.percentile(fits, 100 * (1 - alpha / 2), axis=0)
+    else:
+        lower = upper = np.full(estimate.shape, np.nan)
+    rows = [pd.DataFrame({'channel': channels, 'model': model, 'estimate': estimate[m],
+                          'lower': lower[m], 'upper': upper[m], 'n_resamples': len(fits)})
+            for m, model in enumerate(MODELS)]
+    return pd.concat(rows, ignore_index=True)
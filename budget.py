@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+
+from attribution import START, CONVERSION, NULL
+
+
+### ----- ----- ----- ----- -----
+### ----- budget what-if simulator -----
+### ----- ----- ----- ----- -----
+# What-if scenarios on the order 1 transition matrix (the transition_matrix
+# output in the model results, or Snapshot.transition_matrix). A scenario
+# gives every channel a scale: the transitions into the channel are
+# multiplied by it, the probability taken away goes to (null) and a boost
+# is taken from (null) (as much as there is in each row, so every row still
+# sums to 1). Scale 0 removes the channel exactly like the Markov removal
+# effect, 1 keeps it as it is.
+#
+# For a scenario the projected conversions are the conversions of the
+# filter times P(conversion | scenario) / P(conversion | data), split over
+# the channels by their removal effects within the scenario. A removal
+# effect is one more scenario (the same scales, that channel at 0), so S
+# scenarios of n channels are S * (n + 1) absorbing chains of n + 1
+# transient states, all solved in one batched np.linalg.solve.
+# Snapshot.simulator keeps one BudgetSimulator per filter: the dense
+# system is parsed from the tables once and every slider move only solves.
+
+class BudgetSimulator:
+    def __init__(self, channels, T, to_conv, to_null, total_conversions):
+        self.channels = channels
+        self.T = T
+        self.to_conv = to_conv
+        self.to_null = to_null
+        self.total_conversions = total_conversions
+        self.base_probability = self.conversion_probability(np.ones((1, len(channels))))[0]
+        self.base_conversions = self.solve(np.ones(len(channels)))[0][0]
+
+    # from a transition_matrix output ({'channels', 'transition_matrix'}),
+    # with the conversions of the same paths
+    @classmethod
+    def from_tables(cls, tables, total_conversions):
+        channels = tables['channels'].sort_values('id_channel')
+        n = len(channels) + 1
+        # states: (start) = 0, channel id i = i, (conversion) = n, (null) = n + 1
+        index = {START: 0, **{str(i): i for i in channels.id_channel}, CONVERSION: n, NULL: n + 1}
+        tm = tables['transition_matrix']
+        src = tm.channel_from.map(index).to_numpy(int)
+        dst = tm.channel_to.map(index).to_numpy(int)
+        p = tm.transition_probability.to_numpy(float)
+        T = np.zeros((n, n + 2))
+        T[src, dst] = p
+        return cls(list(channels.channel_name), T[:, :n], T[:, n], T[:, n + 1], total_conversions)
+
+    # P(conversion) from (start) of every scenario, scales: (S, n channels)
+    def conversion_probability(self, scales):
+        scales = np.asarray(scales, dtype=float)
+        w = np.concatenate([np.ones((len(scales), 1)), scales], axis=1)    # (start) is never entered
+        up, down = np.maximum(w - 1, 0), np.maximum(1 - w, 0)
+        boost = up @ self.T.T                                             # (S, states) taken from (null)
+        room = self.to_null + down @ self.T.T
+        share = np.divide(room, boost, out=np.ones_like(boost), where=boost > room)
+        T = self.T[None] * (1 - down[:, None, :] + up[:, None, :] * share[:, :, None])
+        A = np.eye(len(self.T))[None] - T
+        x = np.linalg.solve(A, np.broadcast_to(self.to_conv[:, None], (len(scales), len(self.T), 1)))
+        return x[:, 0, 0]
+
+    # projected conversions per channel of every scenario: (S, n channels)
+    # attributed conversions, and the (S,) totals
+    def solve(self, scales):
+        scales = np.atleast_2d(np.asarray(scales, dtype=float))
+        S, n = scales.shape
+        variants = np.repeat(scales[:, None, :], n + 1, axis=1)          # (S, 1 + n, n)
+        variants[:, np.arange(1, n + 1), np.arange(n)] = 0
+        p = self.conversion_probability(variants.reshape(-1, n)).reshape(S, n + 1)
+        total = self.projected_total(p[:, 0])
+        p0 = p[:, :1]
+        removal = np.divide(p0 - p[:, 1:], p0, out=np.zeros((S, n)), where=p0 > 0)
+        weight = removal.sum(axis=1, keepdims=True)
+        share = np.divide(removal, weight, out=np.zeros((S, n)), where=weight > 0)
+        return total[:, None] * share, total
+
+    # conversions of the filter scaled by P(conversion) relative to the data
+    def projected_total(self, probability):
+        if self.base_probability <= 0:
+            return np.zeros_like(probability)
+        return self.total_conversions * probability / self.base_probability
+
+    # one scenario per row of scales as a DataFrame: channel, scale, base and
+    # projected conversions and their change
+    def project(self, scales):
+        scales = np.atleast_2d(np.asarray(scales, dtype=float))
+        conversions, _ = self.solve(scales)
+        S, n = conversions.shape
+        return pd.DataFrame({'scenario': np.repeat(np.arange(S), n), 'channel': np.tile(self.channels, S),
+                             'scale': scales.ravel(), 'base': np.tile(self.base_conversions, S),
+                             'projected': conversions.ravel(),
+                             'change': (conversions - self.base_conversions).ravel()})
+
+    # scales as an array in channel order from {channel name: scale}; channels
+    # not given keep scale 1
+    def scales(self, settings):
+        return np.array([float(settings.get(c, 1)) for c in self.channels])
+
+    # total projected conversions while each channel in turn goes through
+    # grid, the other channels at scales: one batched solve of
+    # n channels * len(grid) scenarios
+    def response(self, scales, grid):
+        n, grid = len(self.channels), np.asarray(grid, dtype=float)
+        variants = np.repeat(np.asarray(scales, dtype=float)[None], n * len(grid), axis=0)
+        variants[np.arange(n * len(grid)), np.repeat(np.arange(n), len(grid))] = np.tile(grid, n)
+        p = self.conversion_probability(variants)
+        return pd.DataFrame({'channel': np.repeat(self.channels, len(grid)), 'scale': np.tile(grid, n),
+                             'conversions': self.projected_total(p)})
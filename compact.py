@@ -0,0 +1,200 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+import attribution
+from preprocess import CHANNEL_NAMES, PATH_SEP, encode_str_paths, users_count, unique_rows
+
+
+### ----- ----- ----- ----- -----
+### ----- compact paths -----
+### ----- ----- ----- ----- -----
+# One row per MTA_Input.csv row, without any python strings:
+#   codes / offsets    the channels of row i in position order are
+#                      codes[offsets[i]:offsets[i+1]] (int8 codes into CHANNEL_NAMES)
+#   converters, nonconverters, users_count    int32
+#   first_touch, last_touch                   int8 codes into CHANNEL_NAMES
+# Filtered views are arrays of row indices; path_clean strings are only
+# built for the distinct paths handed to the attribution models.
+
+class CompactPaths:
+    def __init__(self, codes, offsets, converters, nonconverters, users_count, first_touch, last_touch):
+        self.codes = codes
+        self.offsets = offsets
+        self.converters = converters
+        self.nonconverters = nonconverters
+        self.users_count = users_count
+        self.first_touch = first_touch
+        self.last_touch = last_touch
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def channels_count(self):
+        return np.diff(self.offsets)
+
+    # rows sorted by channel count, see CountIndex
+    def count_index(self):
+        return CountIndex(self.channels_count)
+
+    # mark every array read-only: arrays shared with forked workers must
+    # never be written to (and so copied)
+    def freeze(self):
+        for arr in (self.codes, self.offsets, self.converters, self.nonconverters,
+                    self.users_count, self.first_touch, self.last_touch):
+            arr.flags.writeable = False
+        return self
+
+    @classmethod
+    def from_frame(cls, Data, batch_size=1_000_000):
+        n_tp = np.empty(len(Data), dtype=np.int64)
+        parts = []
+        for start in range(0, len(Data), batch_size):
+            grid, n = encode_str_paths(Data.str_path.iloc[start:start + batch_size].tolist())
+            parts.append(grid[np.arange(grid.shape[1]) < n[:, None]])
+            n_tp[start:start + batch_size] = n
+        codes = np.concatenate(parts) if parts else np.empty(0, dtype=np.int8)
+        return cls(codes, np.concatenate([[0], np.cumsum(n_tp)]),
+                   Data.converters.to_numpy(np.int32), Data.nonconverters.to_numpy(np.int32),
+                   users_count(Data.user_id).to_numpy(np.int32),
+                   touch_codes(Data.first_touch), touch_codes(Data.last_touch))
+
+    def append(self, other):
+        return CompactPaths.concat([self, other])
+
+    # the rows of all parts, in order
+    @classmethod
+    def concat(cls, parts):
+        ends = np.cumsum([p.offsets[-1] for p in parts])
+        return cls(np.concatenate([p.codes for p in parts]),
+                   np.concatenate([parts[0].offsets[:1]] + [p.offsets[1:] + end - p.offsets[-1]
+                                                            for p, end in zip(parts, ends)]),
+                   *(np.concatenate([getattr(p, col) for p in parts])
+                     for col in ['converters', 'nonconverters', 'users_count', 'first_touch', 'last_touch']))
+
+    # the columns the cube needs, for the given rows (an index array or a
+    # slice; counts as int64 so sums cannot overflow)
+    def frame(self, rows=None):
+        take = (lambda a: a) if rows is None else (lambda a: a[rows])
+        return pd.DataFrame({
+            'channels_count': take(self.channels_count),
+            'first_touch': touch_names(take(self.first_touch)),
+            'last_touch': touch_names(take(self.last_touch)),
+            'converters': take(self.converters).astype(np.int64),
+            'nonconverters': take(self.nonconverters).astype(np.int64),
+        })
+
+    # distinct paths of the given rows in order of first appearance, as
+    # (CSR codes, offsets, converters, nonconverters) summed per path;
+    # converters / nonconverters replace the counts of the rows (e.g.
+    # sampled counts, one per row of rows)
+    def distinct(self, rows=None, converters=None, nonconverters=None):
+        if rows is None:
+            rows = np.arange(len(self))
+        lengths = self.offsets[rows + 1] - self.offsets[rows]
+        path_of = np.empty(len(rows), dtype=np.int64)
+        groups, first_row, n_paths = [], [], 0
+        for L in np.unique(lengths):
+            sel = np.flatnonzero(lengths == L)
+            uniq, inverse = unique_rows(self.codes[self.offsets[rows[sel]][:, None] + np.arange(L)])
+            path_of[sel] = inverse + n_paths
+            first = np.empty(len(uniq), dtype=np.int64)
+            first[inverse[::-1]] = sel[::-1]
+            first_row.append(first)
+            groups.append((np.arange(n_paths, n_paths + len(uniq)), uniq))
+            n_paths += len(uniq)
+
+        # renumber the paths by their first row, like pd.factorize would
+        rank = np.empty(n_paths, dtype=np.int64)
+        if n_paths:
+            rank[np.argsort(np.concatenate(first_row), kind='stable')] = np.arange(n_paths)
+        path_lengths = np.zeros(n_paths, dtype=np.int64)
+        for ids, uniq in groups:
+            path_lengths[rank[ids]] = uniq.shape[1]
+        offsets = np.concatenate([[0], np.cumsum(path_lengths)])
+        codes = np.empty(offsets[-1], dtype=np.int8)
+        for ids, uniq in groups:
+            codes[offsets[rank[ids]][:, None] + np.arange(uniq.shape[1])] = uniq
+        path_of = rank[path_of]
+        conv = np.bincount(path_of, weights=self.converters[rows] if converters is None else converters,
+                           minlength=n_paths).astype(np.int64)
+        null = np.bincount(path_of, weights=self.nonconverters[rows] if nonconverters is None else nonconverters,
+                           minlength=n_paths).astype(np.int64)
+        return codes, offsets, conv, null
+
+    # attribution.PathTable of the given rows, channel ids by first appearance
+    def path_table(self, rows=None):
+        codes, offsets, conv, null = self.distinct(rows)
+        ids, channels = pd.factorize(codes, sort=False)
+        return attribution.PathTable(CHANNEL_NAMES[channels], ids.astype(np.int16), offsets, conv, null)
+
+    # path_clean / converters / nonconverters with one row per distinct path,
+    # the input of models.run_models and the bootstrap
+    def model_input(self, rows=None, converters=None, nonconverters=None):
+        codes, offsets, conv, null = self.distinct(rows, converters, nonconverters)
+        lengths = np.diff(offsets)
+        path_clean = np.empty(len(lengths), dtype=object)
+        for L in np.unique(lengths):
+            sel = np.flatnonzero(lengths == L)
+            names = CHANNEL_NAMES[codes[offsets[sel][:, None] + np.arange(L)]]
+            joined = names[:, 0]
+            for j in range(1, L):
+                joined = joined + PATH_SEP + names[:, j]
+            path_clean[sel] = joined
+        return pd.DataFrame({'path_clean': path_clean, 'converters': conv, 'nonconverters': null})
+
+    def fingerprint(self):
+        h = hashlib.sha1()
+        for arr in (self.codes, self.offsets, self.converters, self.nonconverters):
+            h.update(np.ascontiguousarray(arr).data)
+        return h.hexdigest()[:16]
+
+
+### ----- channel count index -----
+# The rows sorted by channels_count (stably, so every bucket keeps row
+# order): the rows with channel count counts[i] are
+# order[bounds[i]:bounds[i+1]]. The rows of any set of counts are a merge
+# of their buckets, without a pass over all the rows.
+
+class CountIndex:
+    def __init__(self, channels_count):
+        order = np.argsort(channels_count, kind='stable')
+        self.order = order.astype(np.int32) if len(order) < 2**31 else order
+        self.counts, starts = np.unique(channels_count[order], return_index=True)
+        self.bounds = np.append(starts, len(order))
+        self.order.flags.writeable = False
+
+    # number of rows per channel count
+    @property
+    def sizes(self):
+        return np.diff(self.bounds)
+
+    # rows with one of the given channel counts, in row order
+    def rows(self, counts):
+        counts = np.unique(np.asarray(counts, dtype=np.int64))
+        pos = np.searchsorted(self.counts, counts)
+        pos = pos[(pos < len(self.counts)) & (self.counts[np.minimum(pos, len(self.counts) - 1)] == counts)]
+        if len(pos) == 1:
+            return self.order[self.bounds[pos[0]]:self.bounds[pos[0] + 1]]
+        return np.sort(np.concatenate([self.order[self.bounds[i]:self.bounds[i + 1]] for i in pos]
+                                      or [self.order[:0]]))
+
+
+# int8 codes into CHANNEL_NAMES of a column of channel names
+def touch_codes(names):
+    codes = pd.Categorical(names, categories=CHANNEL_NAMES).codes
+    if (codes < 0).any():
+        raise KeyError(pd.Series(names)[codes < 0].iloc[0])
+    return codes.astype(np.int8)
+
+
+# categorical of channel names from int8 codes, categories in name order
+# like astype('category') gives them
+_BY_NAME = np.argsort(CHANNEL_NAMES)
+_RANK = np.argsort(_BY_NAME).astype(np.int8)
+
+
+def touch_names(codes):
+    return pd.Categorical.from_codes(_RANK[codes], CHANNEL_NAMES[_BY_NAME])
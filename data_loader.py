@@ -0,0 +1,177 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from preprocess import paths_to_clean
+from compact import CompactPaths, touch_names
+from parallel import compact_from_frame
+from users import UserIndex
+
+# bump when the derived columns change so old cache files are rebuilt
+CACHE_VERSION = 2
+CATEGORY_COLUMNS = ['first_touch', 'last_touch']
+
+
+### ----- ----- ----- ----- -----
+### ----- columnar data cache -----
+### ----- ----- ----- ----- -----
+# The CSV is parsed once and written as an uncompressed Feather (Arrow IPC)
+# file next to it, holding the compact columns of compact.CompactPaths
+# (path_codes as one list<int8> column, int8 first/last touch codes, int32
+# counts) next to the original str_path / user_id. Later starts memory-map
+# that file; load_compact reads the compact columns zero-copy from the map,
+# so they are shared through the page cache between workers and the
+# strings are never loaded.
+
+def default_cache_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.feather'
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def source_stamp(csv_path, with_hash=True):
+    st = os.stat(csv_path)
+    stamp = {'version': CACHE_VERSION, 'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+    if with_hash:
+        stamp['sha1'] = file_sha1(csv_path)
+    return stamp
+
+
+def read_stamp(cache_path):
+    try:
+        metadata = feather.read_table(cache_path, memory_map=True).schema.metadata or {}
+        return json.loads(metadata[b'mta_source'])
+    except (OSError, KeyError, ValueError, pa.ArrowInvalid):
+        return None
+
+
+# a cache file is reused when it was built by this CACHE_VERSION from a
+# source with the same mtime and size; a touched but unchanged source is
+# recognised by its hash
+def cache_is_valid(csv_path, cache_path):
+    cached = read_stamp(cache_path)
+    if cached is None or cached.get('version') != CACHE_VERSION:
+        return False
+    current = source_stamp(csv_path, with_hash=False)
+    if (cached['mtime_ns'], cached['size']) == (current['mtime_ns'], current['size']):
+        return True
+    return cached['size'] == current['size'] and cached.get('sha1') == file_sha1(csv_path)
+
+
+# workers > 1 derives the compact columns in that many processes (parallel.py)
+def build_cache(csv_path, cache_path, workers=1):
+    stamp = source_stamp(csv_path)
+    Data = pd.read_csv(csv_path)
+    paths = compact_from_frame(Data, workers)
+    table = pa.table({
+        'path_id': Data.path_id.to_numpy(),
+        'str_path': pa.array(Data.str_path, pa.string()),
+        'user_id': pa.array(Data.user_id, pa.string()),
+        'converters': paths.converters,
+        'nonconverters': paths.nonconverters,
+        'users_count': paths.users_count,
+        'first_touch': paths.first_touch,
+        'last_touch': paths.last_touch,
+        'path_codes': pa.LargeListArray.from_arrays(paths.offsets, paths.codes),
+    })
+    table = table.replace_schema_metadata({b'mta_source': json.dumps(stamp).encode()})
+    # write next to the target and rename so concurrent workers never see a partial file.
+    # One record batch, so every column maps to one contiguous buffer
+    tmp = '{}.{}.tmp'.format(cache_path, os.getpid())
+    feather.write_feather(table, tmp, compression='uncompressed', chunksize=max(len(table), 1))
+    os.replace(tmp, cache_path)
+
+
+# the cache of csv_path as a memory-mapped table, (re)built when stale
+def load_table(csv_path='MTA_Input.csv', cache_path=None, workers=1):
+    cache_path = cache_path or default_cache_path(csv_path)
+    if not (os.path.exists(cache_path) and cache_is_valid(csv_path, cache_path)):
+        build_cache(csv_path, cache_path, workers)
+    return feather.read_table(cache_path, memory_map=True)
+
+
+# one column as a single arrow array, without a copy when it has one chunk
+def _array(table, name):
+    column = table.column(name)
+    return column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+
+
+def read_compact(table):
+    path_codes = _array(table, 'path_codes')
+    offsets = path_codes.offsets.to_numpy()
+    codes = path_codes.values.to_numpy()
+    return CompactPaths(codes[offsets[0]:offsets[-1]], offsets - offsets[0],
+                        *(_array(table, col).to_numpy() for col in
+                          ['converters', 'nonconverters', 'users_count', 'first_touch', 'last_touch']))
+
+
+# MTA_Input.csv as compact.CompactPaths, going through the cache file
+def load_compact(csv_path='MTA_Input.csv', cache_path=None, workers=1):
+    return read_compact(load_table(csv_path, cache_path, workers))
+
+
+### ----- user ID index -----
+# users.UserIndex of the user_id column, in a second Feather file next to
+# the cache (<cache>.users.feather: user_key / row columns, one record batch)
+# stamped with the source stamp of the cache it was built from, so it is
+# rebuilt together with the cache and memory-mapped like it otherwise
+
+def default_users_path(cache_path):
+    return os.path.splitext(cache_path)[0] + '.users.feather'
+
+
+def build_users(table, users_path):
+    users = UserIndex.from_user_ids(table.column('user_id'))
+    index = pa.table({'user_key': users.keys, 'row': users.rows})
+    index = index.replace_schema_metadata({b'mta_source': table.schema.metadata[b'mta_source']})
+    tmp = '{}.{}.tmp'.format(users_path, os.getpid())
+    feather.write_feather(index, tmp, compression='uncompressed', chunksize=max(len(index), 1))
+    os.replace(tmp, users_path)
+
+
+# the UserIndex of MTA_Input.csv, going through the cache file
+def load_users(csv_path='MTA_Input.csv', cache_path=None):
+    cache_path = cache_path or default_cache_path(csv_path)
+    table = load_table(csv_path, cache_path)
+    users_path = default_users_path(cache_path)
+    if not (os.path.exists(users_path) and read_stamp(users_path) == read_stamp(cache_path)):
+        build_users(table, users_path)
+    return read_users(users_path)
+
+
+def read_users(users_path):
+    index = feather.read_table(users_path, memory_map=True)
+    return UserIndex(_array(index, 'user_key').to_numpy(), _array(index, 'row').to_numpy())
+
+
+# load MTA_Input.csv with all derived columns as one DataFrame, going
+# through the cache file (path_clean is rebuilt from str_path)
+def load_data(csv_path='MTA_Input.csv', cache_path=None):
+    table = load_table(csv_path, cache_path)
+    Data = table.drop(['path_codes']).to_pandas(split_blocks=True, self_destruct=True)
+    for col in CATEGORY_COLUMNS:
+        Data[col] = touch_names(Data[col].to_numpy())
+    Data['channels_count'] = np.diff(_array(table, 'path_codes').offsets.to_numpy())
+    Data['path_clean'] = paths_to_clean(Data.str_path)
+    return Data
+
+
+### ----- batches -----
+
+# read one CSV with the MTA_Input.csv layout as compact.CompactPaths, without
+# caching; with users=True as (paths, users.UserIndex of its rows)
+def read_batch(csv_path, users=False):
+    Data = pd.read_csv(csv_path)
+    paths = CompactPaths.from_frame(Data)
+    return (paths, UserIndex.from_user_ids(Data.user_id)) if users else paths
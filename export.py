@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import pandas as pd
+import pyarrow.feather as feather
+
+from data_loader import load_compact, source_stamp
+from ingest import FILTERS, Snapshot
+from parallel import worker_count
+from aggregates import touch_stats, channel_count_stats
+from models import RESULT_VERSION, run_models, markov_tag
+from bootstrap import bootstrap_intervals
+
+# bump when the layout of the exported files changes
+EXPORT_VERSION = 1
+
+
+### ----- ----- ----- ----- -----
+### ----- headless export -----
+### ----- ----- ----- ----- -----
+# python export.py MTA_Input.csv --out artifacts
+#
+# Everything the dashboard shows, computed without Dash or Plotly: the CSV
+# is loaded once (through the Feather cache), every filter is a view of the
+# same snapshot (cube slices, distinct paths, per-channel-count transition
+# counts merged per filter) and the models run once per filter. Results are
+# written as Feather files:
+#   cube.feather, channel_counts.feather           whole dataset
+#   <filter>/touch_stats.feather                   first / last touch conversions
+#   <filter>/sankey_links.feather                  first -> last touch sums
+#   <filter>/attribution.feather                   R of run_models
+#   <filter>/removal_effects.feather
+#   <filter>/transition_matrix.feather             Markov model order
+#   <filter>/transition_matrix_order1.feather, <filter>/channels_order1.feather
+#   <filter>/bootstrap.feather                     with --bootstrap
+#   manifest.json                                  source stamp, settings, fingerprint
+# manifest.json is written last, so a folder with a manifest is complete.
+# Dashboard.py starts from such a folder with MTA_ARTIFACTS.
+
+def _write(df, path):
+    feather.write_feather(df.reset_index(drop=True), path)
+
+
+def _read(path):
+    return feather.read_feather(path)
+
+
+def export(csv_path, out_dir, engine='ChannelAttribution', markov=None, filters=FILTERS,
+           bootstrap=0, bootstrap_time_limit=3600, cache_path=None, workers=1, log=None):
+    log = log or (lambda msg: None)
+    start = time.perf_counter()
+    snapshot = Snapshot.build(load_compact(csv_path, cache_path, workers), workers)
+    log('loaded {:,} rows in {:.1f}s'.format(len(snapshot.paths), time.perf_counter() - start))
+
+    os.makedirs(out_dir, exist_ok=True)
+    _write(snapshot.cube, os.path.join(out_dir, 'cube.feather'))
+    _write(channel_count_stats(snapshot.cube), os.path.join(out_dir, 'channel_counts.feather'))
+
+    for filter_key in filters:
+        start = time.perf_counter()
+        folder = os.path.join(out_dir, filter_key)
+        os.makedirs(folder, exist_ok=True)
+        cube = snapshot.cube_for(filter_key)
+        stats = pd.concat([touch_stats(cube, touch).assign(touch=touch) for touch in ['first_touch', 'last_touch']])
+        _write(stats, os.path.join(folder, 'touch_stats.feather'))
+        sankey = snapshot.sankey(filter_key)
+        _write(pd.DataFrame({'first_touch': sankey.first, 'last_touch': sankey.last,
+                             'converters': sankey.conv, 'nonconverters': sankey.nonconv}),
+               os.path.join(folder, 'sankey_links.feather'))
+
+        Data = snapshot.model_input(filter_key)
+        R, RE, TM, T = run_models(Data, engine, transitions=snapshot.transition_matrix(filter_key), markov=markov)
+        _write(R, os.path.join(folder, 'attribution.feather'))
+        _write(RE, os.path.join(folder, 'removal_effects.feather'))
+        _write(TM, os.path.join(folder, 'transition_matrix.feather'))
+        _write(T['transition_matrix'], os.path.join(folder, 'transition_matrix_order1.feather'))
+        _write(T['channels'], os.path.join(folder, 'channels_order1.feather'))
+        if bootstrap:
+            intervals = bootstrap_intervals(Data, n_resamples=bootstrap, time_limit=bootstrap_time_limit,
+                                            markov=markov)
+            _write(intervals, os.path.join(folder, 'bootstrap.feather'))
+        log('{}: {:,} distinct paths in {:.1f}s'.format(filter_key, len(Data), time.perf_counter() - start))
+
+    manifest = {'version': EXPORT_VERSION, 'result_version': RESULT_VERSION,
+                'source': source_stamp(csv_path, with_hash=False), 'fingerprint': snapshot.fingerprint,
+                'engine': engine, 'markov': markov or {}, 'filters': list(filters), 'bootstrap': bootstrap}
+    path = os.path.join(out_dir, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+    return manifest
+
+
+### ----- reading an export -----
+
+class Artifacts:
+    def __init__(self, out_dir, manifest):
+        self.out_dir = out_dir
+        self.manifest = manifest
+        self.fingerprint = manifest['fingerprint']
+        self.filters = manifest['filters']
+
+    # the export was made from csv_path as it is now
+    def matches_source(self, csv_path):
+        stamp = source_stamp(csv_path, with_hash=False)
+        return self.manifest['version'] == EXPORT_VERSION and \
+            all(self.manifest['source'].get(k) == v for k, v in stamp.items())
+
+    # the models were fitted like run_models(engine, markov=markov) would
+    def matches_models(self, engine, markov=None):
+        return self.manifest['result_version'] == RESULT_VERSION and self.manifest['engine'] == engine \
+            and markov_tag(self.manifest['markov']) == markov_tag(markov)
+
+    @property
+    def cube(self):
+        return _read(os.path.join(self.out_dir, 'cube.feather'))
+
+    # run_models output of a filter
+    def models(self, filter_key):
+        folder = os.path.join(self.out_dir, filter_key)
+        T = {'channels': _read(os.path.join(folder, 'channels_order1.feather')),
+             'transition_matrix': _read(os.path.join(folder, 'transition_matrix_order1.feather'))}
+        return (_read(os.path.join(folder, 'attribution.feather')),
+                _read(os.path.join(folder, 'removal_effects.feather')),
+                _read(os.path.join(folder, 'transition_matrix.feather')), T)
+
+    # bootstrap_intervals output of a filter, None when not exported
+    def intervals(self, filter_key):
+        path = os.path.join(self.out_dir, filter_key, 'bootstrap.feather')
+        return _read(path) if os.path.exists(path) else None
+
+
+# None when out_dir holds no complete export
+def load_artifacts(out_dir):
+    try:
+        with open(os.path.join(out_dir, 'manifest.json')) as f:
+            return Artifacts(out_dir, json.load(f))
+    except (OSError, ValueError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compute and export every dashboard output without Dash")
+    parser.add_argument("csv", nargs="?", default="MTA_Input.csv")
+    parser.add_argument("--out", default="artifacts", help="folder for the Feather files and manifest.json")
+    parser.add_argument("--cache-path", help="Feather cache of the CSV (defaults to next to it)")
+    parser.add_argument("--engine", default=os.environ.get('MODEL_ENGINE', 'ChannelAttribution'))
+    parser.add_argument("--markov-order", default=os.environ.get('MODEL_MARKOV_ORDER', 'heldout'),
+                        help="'auto', 'heldout', 'variable' or a fixed order")
+    parser.add_argument("--max-order", type=int, default=int(os.environ.get('MODEL_MARKOV_MAX_ORDER', 10)))
+    parser.add_argument("--min-count", type=int, default=int(os.environ.get('MODEL_MARKOV_MIN_COUNT', 100)))
+    parser.add_argument("--filters", nargs="+", default=list(FILTERS))
+    parser.add_argument("--bootstrap", type=int, default=0, metavar="N",
+                        help="also export bootstrap intervals from N resamples")
+    parser.add_argument("--bootstrap-time-limit", type=float, default=3600,
+                        help="seconds after which the intervals use the resamples done so far")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get('PREPROCESS_WORKERS', 1)),
+                        help="processes parsing the CSV and building the cube (0 = every core)")
+    args = parser.parse_args()
+
+    markov = dict(order=args.markov_order, max_order=args.max_order, min_count=args.min_count)
+    manifest = export(args.csv, args.out, engine=args.engine, markov=markov, filters=args.filters,
+                      bootstrap=args.bootstrap, bootstrap_time_limit=args.bootstrap_time_limit,
+                      cache_path=args.cache_path, workers=worker_count(args.workers),
+                      log=lambda msg: print(msg, file=sys.stderr))
+    print(json.dumps(manifest, indent=2))
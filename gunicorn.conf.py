@@ -0,0 +1,37 @@
+import gc
+import os
+import multiprocessing
+
+### ----- ----- ----- ----- -----
+### ----- gunicorn deployment -----
+### ----- ----- ----- ----- -----
+# gunicorn -c gunicorn.conf.py Dashboard:server
+#
+# The master imports Dashboard.py once (preload_app): it maps the Feather
+# cache, builds the aggregate cube and the filter indices and warms the
+# model cache. Workers are forked from it and share all of that copy-on-
+# write; the compact path arrays are read-only views of the mmap'd cache
+# file, so they stay shared even across restarts and new workers cost a
+# fork instead of a data load and three model fits.
+# Set MODEL_CACHE_DIR too: model fits started by the model tab are then
+# shared by all workers (one fits, the others read its result); without
+# it every worker a session lands on fits the filter again.
+#
+# GUNICORN_BIND: address to listen on
+# GUNICORN_WORKERS: number of worker processes (defaults to 2 x cores + 1)
+# GUNICORN_THREADS: threads per worker
+# GUNICORN_TIMEOUT: seconds before a silent worker is restarted
+# GUNICORN_PRELOAD: set to 0 to let every worker load the data itself
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8050')
+workers = int(os.environ.get('GUNICORN_WORKERS', 2 * multiprocessing.cpu_count() + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+
+# move everything the preloaded app allocated into the permanent generation,
+# so the garbage collector of the workers never writes to (and copies)
+# those pages
+def pre_fork(server, worker):
+    gc.freeze()
@@ -0,0 +1,274 @@
+import os
+import sys
+import glob
+import hashlib
+import threading
+import traceback
+
+import numpy as np
+
+import attribution
+from data_loader import read_batch
+from parallel import cube_from_paths
+from trie import PrefixTrie
+from budget import BudgetSimulator
+from preview import PreviewSample
+from users import Cohort
+from aggregates import SankeyTable, build_cube, cube_slice, merge_cubes
+
+FILTERS = ('full', 'One', 'Two')
+
+
+### ----- ----- ----- ----- -----
+### ----- data snapshots -----
+### ----- ----- ----- ----- -----
+# Everything the callbacks read from the data lives in one Snapshot: the
+# compact paths (compact.CompactPaths) with their channel count index,
+# the aggregate cube, the data fingerprint of the model cache, the
+# order 1 transition counts per channel count, the model counts of a fixed
+# Markov order per channel count (attribution.ModelCounts, the input of
+# models.models_from_counts) and the path prefix trie (trie.PrefixTrie,
+# rebuilt on first use after an append) and the optional index from user
+# ID to rows (users.UserIndex). A snapshot is never modified; appending a
+# batch builds a new one, reusing the old cube, transition and model counts
+# (all additive) and user index (merged with the batch's) so only the new
+# rows are parsed and counted. SnapshotStore swaps the current snapshot in one
+# assignment, so a callback that took `store.current` sees either the old
+# or the new data, never a mix.
+#
+# A filter is a set of channel counts. Its key is 'full', 'One' (only 1)
+# or 'Two' (all but 1) for the presets and 'cnt-<c1>-<c2>...' otherwise;
+# rows, cube rows and transition counts of any filter are merged from
+# the per-count buckets.
+
+def _transitions(paths, rows=None):
+    table = paths.path_table(rows)
+    return attribution.count_transitions(table, order=1, keep_repeats=True), table.channels
+
+
+class Snapshot:
+    def __init__(self, paths, cube, fingerprint, transitions=None, batches=(), users=None, model_counts=None):
+        self.paths = paths.freeze()
+        self.index = paths.count_index()
+        self.counts = [int(c) for c in self.index.counts]
+        self.cube = cube
+        self.fingerprint = fingerprint
+        self.batches = tuple(batches)
+        self.users = users
+        self._transitions = transitions
+        self._transition_tables = {}
+        self._model_counts = dict(model_counts or {})
+        self._model_inputs = {}
+        self._sankeys = {}
+        self._trie = None
+        self._trie_stats = {}
+        self._simulators = {}
+        self._previews = {}
+        self._lock = threading.Lock()
+
+    # workers > 1 sums the cube from partial cubes of that many processes
+    @classmethod
+    def build(cls, paths, workers=1, users=None):
+        return cls(paths, cube_from_paths(paths, workers), paths.fingerprint(), users=users)
+
+    # key of the filter selecting the given channel counts; selecting
+    # nothing is the same as selecting everything
+    def filter_key(self, counts):
+        counts = sorted(set(int(c) for c in counts or ()) & set(self.counts))
+        if not counts or counts == self.counts:
+            return 'full'
+        if counts == [1]:
+            return 'One'
+        if counts == [c for c in self.counts if c != 1]:
+            return 'Two'
+        return 'cnt-' + '-'.join(map(str, counts))
+
+    # channel counts of a filter key, None for 'full'
+    def filter_counts(self, filter_key):
+        if filter_key == 'One':
+            return [1]
+        if filter_key == 'Two':
+            return [c for c in self.counts if c != 1]
+        if filter_key.startswith('cnt-'):
+            return [int(c) for c in filter_key[4:].split('-')]
+        return None
+
+    # row indices of a filter, None for all rows
+    def rows(self, filter_key):
+        counts = self.filter_counts(filter_key)
+        return None if counts is None else self.index.rows(counts)
+
+    # aggregate cube rows of a filter
+    def cube_for(self, filter_key):
+        return cube_slice(self.cube, self.filter_counts(filter_key))
+
+    # cache[key], built by build() on a miss. The build runs outside the
+    # lock, so one slow build never holds up the other callbacks; two
+    # callers may build the same entry at once, the first one stored wins
+    def _cached(self, cache, key, build):
+        with self._lock:
+            if key in cache:
+                return cache[key]
+        value = build()
+        with self._lock:
+            return cache.setdefault(key, value)
+
+    # SankeyTable of a filter, built on first use
+    def sankey(self, filter_key):
+        return self._cached(self._sankeys, filter_key, lambda: SankeyTable(self.cube_for(filter_key)))
+
+    # trie.PrefixTrie of every path, built on first use
+    @property
+    def trie(self):
+        with self._lock:
+            if self._trie is not None:
+                return self._trie
+        trie = PrefixTrie.from_paths(self.paths)
+        with self._lock:
+            if self._trie is None:
+                self._trie = trie
+            return self._trie
+
+    # trie.TrieStats of a filter, summed on first use
+    def trie_stats(self, filter_key):
+        trie = self.trie
+        return self._cached(self._trie_stats, filter_key, lambda: trie.stats(self.filter_counts(filter_key)))
+
+    # {channel count: (order 1 TransitionCounts with repeats, channels)}, counted on first use
+    @property
+    def transitions(self):
+        with self._lock:
+            if self._transitions is not None:
+                return self._transitions
+        transitions = {c: _transitions(self.paths, self.index.rows([c])) for c in self.counts}
+        with self._lock:
+            if self._transitions is None:
+                self._transitions = transitions
+            return self._transitions
+
+    # ChannelAttribution.transition_matrix output for one filter, merged on first use
+    def transition_matrix(self, filter_key):
+        def build():
+            buckets = [self.transitions[c] for c in self.filter_counts(filter_key) or self.counts]
+            counts, channels = buckets[0]
+            for other in buckets[1:]:
+                counts, channels = attribution.merge_transitions(counts, channels, *other)
+            return attribution.transition_tables(counts, channels)
+        return self._cached(self._transition_tables, filter_key, build)
+
+    # attribution.ModelCounts of one filter at a fixed Markov order, merged
+    # from the per channel count buckets (counted on first use of the order)
+    def model_counts(self, filter_key, order):
+        buckets = self._cached(self._model_counts, order, lambda: {
+            c: attribution.ModelCounts.from_paths(self.paths.path_table(self.index.rows([c])), order)
+            for c in self.counts})
+        counts = [buckets[c] for c in self.filter_counts(filter_key) or self.counts]
+        merged = counts[0]
+        for other in counts[1:]:
+            merged = merged.merge(other)
+        return merged
+
+    # budget.BudgetSimulator of a filter on its order 1 transition matrix, built on first use
+    def simulator(self, filter_key):
+        return self._cached(self._simulators, filter_key, lambda: BudgetSimulator.from_tables(
+            self.transition_matrix(filter_key), int(self.cube_for(filter_key).converters.sum())))
+
+    # preview.PreviewSample of size journeys in replicates, drawn on first use
+    def preview_sample(self, size, replicates=5):
+        return self._cached(self._previews, (size, replicates),
+                            lambda: PreviewSample.build(self.paths, size, replicates))
+
+    # distinct paths of one filter with their summed counts, the model input
+    def model_input(self, filter_key):
+        return self._cached(self._model_inputs, filter_key, lambda: self.paths.model_input(self.rows(filter_key)))
+
+    # users.Cohort of the given user IDs within a filter, None without a user index
+    def cohort(self, user_ids, filter_key='full'):
+        if self.users is None:
+            return None
+        rows, users, found = self.users.lookup(user_ids)
+        counts = self.filter_counts(filter_key)
+        if counts is not None:
+            keep = np.isin(self.paths.channels_count[rows], counts)
+            rows, users = rows[keep], users[keep]
+        return Cohort.from_rows(self.paths, rows, users, len(set(user_ids)), found)
+
+    # a new snapshot with the rows of batch (a CompactPaths) appended; users
+    # is the UserIndex of the batch rows, merged into the index of the snapshot
+    def append(self, batch, name=None, users=None):
+        cube = merge_cubes(self.cube, build_cube(batch.frame()))
+        fingerprint = hashlib.sha1((self.fingerprint + batch.fingerprint()).encode()).hexdigest()[:16]
+
+        transitions = dict(self.transitions)
+        index = batch.count_index()
+        for c in index.counts:
+            counts = _transitions(batch, index.rows([c]))
+            if c in transitions:
+                counts = attribution.merge_transitions(*transitions[c], *counts)
+            transitions[int(c)] = counts
+        with self._lock:
+            model_counts = {order: dict(buckets) for order, buckets in self._model_counts.items()}
+        for order, buckets in model_counts.items():
+            for c in index.counts:
+                counts = attribution.ModelCounts.from_paths(batch.path_table(index.rows([c])), order)
+                buckets[int(c)] = buckets[c].merge(counts) if c in buckets else counts
+        users = self.users.append(users, len(self.paths)) if self.users is not None and users is not None else None
+        return Snapshot(self.paths.append(batch), cube, fingerprint, transitions, self.batches + (name or '',),
+                        users, model_counts)
+
+
+class SnapshotStore:
+    def __init__(self, snapshot):
+        self.current = snapshot
+        # (path, mtime, size) of the batch files that failed to parse; they
+        # are skipped until rewritten (a new mtime or size), so one bad file
+        # does not hold up the files after it
+        self.failed = set()
+        self._lock = threading.RLock()
+
+    # parse one batch file and publish the snapshot with its rows added
+    def ingest(self, csv_path):
+        if self.current.users is not None:
+            batch, users = read_batch(csv_path, users=True)
+        else:
+            batch, users = read_batch(csv_path), None
+        with self._lock:
+            self.current = self.current.append(batch, name=os.path.basename(csv_path), users=users)
+            return self.current
+
+    # ingest the *.csv files of a folder not ingested yet, in name order.
+    # Batch files should be moved into the folder complete (written elsewhere, then renamed).
+    # A file that fails is reported once and skipped, the others are still ingested
+    def ingest_new(self, folder):
+        with self._lock:
+            done = set(self.current.batches)
+            for csv_path in sorted(glob.glob(os.path.join(folder, '*.csv'))):
+                name = os.path.basename(csv_path)
+                if name in done:
+                    continue
+                try:
+                    st = os.stat(csv_path)
+                except OSError:
+                    continue
+                key = (csv_path, st.st_mtime, st.st_size)
+                if key in self.failed:
+                    continue
+                try:
+                    self.ingest(csv_path)
+                except Exception:
+                    self.failed.add(key)
+                    print('ingesting {} failed, skipped until it changes:\n{}'.format(
+                        csv_path, traceback.format_exc()), file=sys.stderr)
+            return self.current
+
+    # poll folder every interval seconds from a daemon thread
+    def watch(self, folder, interval=60):
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.ingest_new(folder)
+                except Exception as e:
+                    print('ingesting {} failed: {}'.format(folder, e), file=sys.stderr)
+        stop = threading.Event()
+        threading.Thread(target=run, name='mta-ingest', daemon=True).start()
+        return stop
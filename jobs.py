@@ -0,0 +1,115 @@
+import threading
+import functools
+import multiprocessing as mp
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+
+### ----- ----- ----- ----- -----
+### ----- background jobs -----
+### ----- ----- ----- ----- -----
+# Runs slow functions (the model fits) in a local process pool so a
+# callback can return right away and poll for the result. Jobs are keyed:
+# submitting a key that is already in flight returns the running job, so
+# concurrent requests for the same filter share one fit. A JobManager only
+# knows the jobs of its own process (each gunicorn worker has one); fits
+# are shared across workers through the model cache (Dashboard.model_job,
+# ModelCache.claim). Progress is reported by the job through a Manager
+# dict as (step, total, label). submit_prepared also builds the arguments
+# of a job off the caller's thread (in a thread of this process, where
+# they may be cached), so a callback gets the job back right away.
+# The pool is created on first use, i.e. after gunicorn has forked.
+
+def _run(fn, key, progress, args, kwargs):
+    def report(step, total, label):
+        progress[key] = (step, total, label)
+    return fn(*args, progress=report, **kwargs)
+
+
+# the outcome of the pool future inner copied onto job
+def _forward(job, inner):
+    if inner.cancelled():
+        job.cancel()
+    elif inner.exception() is not None:
+        job.set_exception(inner.exception())
+    else:
+        job.set_result(inner.result())
+
+
+class JobManager:
+    def __init__(self, max_workers=2):
+        self.max_workers = max_workers
+        self._pool = None
+        self._manager = None
+        self._progress = None
+        self._threads = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _ensure_pool(self):
+        if self._pool is None:
+            self._manager = mp.Manager()
+            self._progress = self._manager.dict()
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            self._threads = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job-inputs')
+
+    # fn must accept a progress=callable(step, total, label) keyword
+    def submit(self, key, fn, *args, **kwargs):
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None:
+                return job
+            self._ensure_pool()
+            self._progress[key] = (0, 1, 'queued')
+            job = self._pool.submit(_run, fn, key, self._progress, args, kwargs)
+            self._jobs[key] = job
+            return job
+
+    # like submit, with (fn, args, kwargs) returned by prepare(), which runs
+    # in a thread of this process; the job is returned before it is called
+    def submit_prepared(self, key, prepare):
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None:
+                return job
+            self._ensure_pool()
+            self._progress[key] = (0, 1, 'preparing the inputs')
+            job = self._jobs[key] = Future()
+            self._threads.submit(self._start, key, prepare, job)
+            return job
+
+    def _start(self, key, prepare, job):
+        try:
+            fn, args, kwargs = prepare()
+            with self._lock:
+                if self._pool is None:
+                    raise RuntimeError('the job manager was shut down')
+                inner = self._pool.submit(_run, fn, key, self._progress, args, kwargs)
+        except BaseException as e:
+            job.set_exception(e)
+            return
+        inner.add_done_callback(functools.partial(_forward, job))
+
+    def get(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    def progress(self, key):
+        if self._progress is None:
+            return (0, 1, 'queued')
+        return self._progress.get(key, (0, 1, 'queued'))
+
+    # forget a finished job once its result has been collected
+    def discard(self, key):
+        with self._lock:
+            self._jobs.pop(key, None)
+            if self._progress is not None:
+                self._progress.pop(key, None)
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._threads.shutdown(wait=False, cancel_futures=True)
+                self._manager.shutdown()
+                self._pool = self._threads = self._manager = self._progress = None
+            self._jobs.clear()
@@ -0,0 +1,226 @@
+import sys
+import hmac
+import time
+import bisect
+import threading
+import functools
+import tracemalloc
+from collections import Counter
+
+from flask import abort, g, has_request_context, request, Response
+
+# upper bounds of the histogram buckets, +Inf is added when rendering
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+
+
+### ----- ----- ----- ----- -----
+### ----- callback metrics -----
+### ----- ----- ----- ----- -----
+# Histograms per (callback, filter) of
+#   dash_callback_seconds{phase="compute"}    callback body up to metrics.mark()
+#   dash_callback_seconds{phase="figure"}     from metrics.mark() to the return
+#   dash_callback_seconds{phase="serialize"}  from the return to the response,
+#                                             i.e. Dash's JSON encoding of the figure
+#   dash_callback_payload_bytes               size of the response body
+#   dash_callback_peak_alloc_bytes            peak traced allocation during the call
+#                                             (only with track_memory, tracemalloc
+#                                             slows every allocation)
+# served in the Prometheus text format on /metrics. Every gunicorn worker
+# keeps its own registry, a scrape sees the worker that answered it.
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self, track_memory=False, profile=False, profile_seconds=10, profile_token=None):
+        self.track_memory = track_memory
+        self.profile = profile
+        self.profile_seconds = profile_seconds
+        self.profile_token = profile_token
+        self._profiles = {}
+        self._series = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def observe(self, name, labels, value, buckets=SECONDS_BUCKETS):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._series.get(key)
+            if hist is None:
+                hist = self._series[key] = Histogram(buckets)
+            hist.observe(value)
+
+    # called inside a callback where the computation ends and the figure starts
+    def mark(self):
+        call = getattr(self._local, 'call', None)
+        if call is not None:
+            call['mark'] = time.perf_counter()
+
+    # decorator for Dash callbacks, below @app.callback; the filter label is
+    # taken from positional argument filter_arg
+    def instrument(self, filter_arg=0):
+        def wrap(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                labels = {'callback': fn.__name__,
+                          'filter': _label(args[filter_arg]) if len(args) > filter_arg else ''}
+                call = self._local.call = {'mark': None}
+                if self.track_memory:
+                    tracemalloc.reset_peak()
+                    base = tracemalloc.get_traced_memory()[0]
+                sampler = StackSampler(self.profile_seconds) if self._profile_requested() else None
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    end = time.perf_counter()
+                    if sampler is not None:
+                        with self._lock:
+                            self._profiles[fn.__name__] = sampler.stop()
+                    mark = call['mark'] or end
+                    self._local.call = None
+                    self.observe('dash_callback_seconds', dict(labels, phase='compute'), mark - start)
+                    self.observe('dash_callback_seconds', dict(labels, phase='figure'), end - mark)
+                    if self.track_memory:
+                        peak = tracemalloc.get_traced_memory()[1] - base
+                        self.observe('dash_callback_peak_alloc_bytes', labels, max(peak, 0), BYTES_BUCKETS)
+                    if has_request_context():
+                        g.dash_callback = (labels, end)
+            return wrapper
+        return wrap
+
+    # whether the current request asks for a profile of its callback
+    # (X-Profile: 1 header or ?profile=1) and may have one
+    def _profile_requested(self):
+        if not self.profile or not has_request_context():
+            return False
+        asked = request.headers.get('X-Profile') or request.args.get('profile')
+        return asked == '1' and self._authorized()
+
+    def _authorized(self):
+        if not self.profile_token:
+            return True
+        return hmac.compare_digest(request.headers.get('X-Profile-Token', ''), self.profile_token)
+
+    def _after_request(self, response):
+        done = g.pop('dash_callback', None)
+        if done is not None and not response.direct_passthrough:
+            labels, end = done
+            self.observe('dash_callback_seconds', dict(labels, phase='serialize'), time.perf_counter() - end)
+            self.observe('dash_callback_payload_bytes', labels, len(response.get_data()), BYTES_BUCKETS)
+        return response
+
+    def render(self):
+        lines, typed = [], set()
+        with self._lock:
+            series = sorted(self._series.items())
+            for (name, labels), hist in series:
+                if name not in typed:
+                    lines.append('# TYPE {} histogram'.format(name))
+                    typed.add(name)
+                label_str = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels)
+                cumulative = 0
+                for bound, count in zip(list(hist.buckets) + ['+Inf'], hist.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label_str, bound, cumulative))
+                lines.append('{}_sum{{{}}} {}'.format(name, label_str, hist.sum))
+                lines.append('{}_count{{{}}} {}'.format(name, label_str, hist.count))
+        return '\n'.join(lines) + '\n'
+
+    # /metrics on the Flask server, and /metrics/profile when profile is set
+    def init_app(self, server):
+        server.after_request(self._after_request)
+        server.add_url_rule('/metrics', 'metrics', lambda: Response(
+            self.render(), mimetype='text/plain; version=0.0.4'))
+        if self.profile:
+            server.add_url_rule('/metrics/profile', 'metrics_profile', self.profile_view)
+
+    def profile_view(self):
+        if not self._authorized():
+            abort(403)
+        callback = request.args.get('callback')
+        if callback is not None:
+            with self._lock:
+                stacks = self._profiles.get(callback)
+            if stacks is None:
+                abort(404)
+        else:
+            seconds = min(float(request.args.get('seconds', self.profile_seconds)), self.profile_seconds)
+            interval = max(float(request.args.get('interval', 0.005)), 0.001)
+            stacks = sample_stacks(seconds, interval)
+        body = '\n'.join('{} {}'.format(stack, n) for stack, n in stacks.most_common())
+        return Response(body + '\n', mimetype='text/plain')
+
+
+# a channel count selection (list) as "1,2,3"
+def _label(value):
+    if isinstance(value, (list, tuple)):
+        return ','.join(map(str, sorted(value)))
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+### ----- sampling profiler -----
+# Only with profile set (METRICS_PROFILE=1), and only for requests carrying
+# the X-Profile-Token header when a profile_token is configured:
+#   a callback request with an X-Profile: 1 header (or ?profile=1) samples
+#   the stacks of its own thread while the callback runs, for at most
+#   profile_seconds; /metrics/profile?callback=<name> answers with the last
+#   such profile of that callback
+#   /metrics/profile?seconds=5&interval=0.005 samples every other thread of
+#   this worker for `seconds` (at most profile_seconds, keep it well below
+#   the gunicorn timeout); load the slow page while the request runs
+# Profiles are collapsed stacks ("frame;frame;frame count"), the input of
+# flamegraph.pl and speedscope.
+
+# stacks of the threads in `threads` (every other thread by default) every
+# interval for `seconds`, or until `stop` is set
+def sample_stacks(seconds, interval=0.005, threads=None, stop=None):
+    me = threading.get_ident()
+    stacks = Counter()
+    stop = stop or threading.Event()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline and not stop.is_set():
+        for ident, frame in sys._current_frames().items():
+            if ident == me or (threads is not None and ident not in threads):
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(code.co_filename.rsplit('/', 1)[-1], code.co_name))
+                frame = frame.f_back
+            stacks[';'.join(reversed(stack))] += 1
+        stop.wait(interval)
+    return stacks
+
+
+# samples the calling thread from a background thread until stop()
+class StackSampler:
+    def __init__(self, seconds, interval=0.005):
+        self._stop = threading.Event()
+        self._stacks = Counter()
+        target = threading.get_ident()
+        self._thread = threading.Thread(target=lambda: self._stacks.update(
+            sample_stacks(seconds, interval, {target}, self._stop)), name='mta-profile', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self._stacks
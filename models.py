@@ -0,0 +1,247 @@
+import os
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+import ChannelAttribution as CA
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import attribution
+
+# 'ChannelAttribution' runs the external package, 'native' the NumPy engine
+# in attribution.py for the Markov model and transition matrices.
+# The Shapley model always comes from attribution.py
+ENGINES = ('ChannelAttribution', 'native')
+
+# Markov model order settings besides a fixed order, see attribution.select_order;
+# 'variable' is only available with the native engine
+MARKOV_ORDERS = ('auto', 'heldout', 'variable')
+
+# bump when the layout of the run_models result changes, so pickled results
+# of an older layout in MODEL_CACHE_DIR are not picked up
+RESULT_VERSION = 2
+
+
+### ----- ----- ----- ----- -----
+### ----- attribution models -----
+### ----- ----- ----- ----- -----
+
+# run every model shown in the "Conversions in the models" tab
+# returns (R, removal effects, markov transition matrix, order 1 transition matrix)
+# progress, if given, is called as progress(step, total, label) before each fit
+# transitions, if given, is the transition matrix already counted for Data
+# (ingest.Snapshot.transition_matrix) and is returned instead of a new one
+# markov, if given, is a dict of order / max_order / min_count for the
+# Markov model (attribution.select_order); by default the order is chosen
+# like ChannelAttribution.auto_markov_model does
+def run_models(Data, engine='ChannelAttribution', progress=None, transitions=None, markov=None):
+    if engine not in ENGINES:
+        raise ValueError("unknown model engine: {}".format(engine))
+    markov = markov or {}
+    order = markov.get('order', 'auto')
+    if order == 'variable' and engine != 'native':
+        raise ValueError("the variable-order Markov model needs the native engine")
+    progress = progress or (lambda step, total, label: None)
+
+    progress(0, 3, 'heuristic models')
+    #ESTIMATE HEURISTIC MODELS (first-/last-/linear- touch models)
+    H = CA.heuristic_models(Data,"path_clean","converters",
+                        #var_value = "total_conv_values",
+                        flg_adv = False)
+
+    #ESTIMATE MARKOV MODEL
+    progress(1, 3, 'Markov model')
+    if engine == 'native':
+        k, min_count = attribution.select_order(Data, "path_clean", "converters", "nonconverters", **markov)
+        Auto_M = attribution.markov_model(Data, "path_clean", "converters", var_null = "nonconverters",
+                                          order = k, min_count = min_count, out_more = True)
+    elif order == 'auto':
+        Auto_M = CA.auto_markov_model(Data,
+                                "path_clean",
+                                "converters",
+                                #var_value = "total_conv_values",
+                                var_null = "nonconverters",
+                                max_order = markov.get('max_order', 10),
+                                out_more = True,
+                                flg_adv = False)
+    else:
+        k, _ = attribution.select_order(Data, "path_clean", "converters", "nonconverters", **markov)
+        Auto_M = CA.markov_model(Data, "path_clean", "converters", var_null = "nonconverters",
+                                 order = k, out_more = True, verbose = False, flg_adv = False)
+
+    #ESTIMATE SHAPLEY MODEL (native only, ChannelAttribution has no Shapley model)
+    S = attribution.shapley_model(Data, "path_clean", "converters")
+
+    # COMBINE HEURITSTIC, MARKOV & SHAPLEY
+    R = pd.merge(H,Auto_M['result'],on="channel_name",how="inner")
+    R = pd.merge(R,S,on="channel_name",how="inner")
+    R.columns=["channel","first_touch","last_touch","linear_touch","markov_model","shapley"]
+    R = R.sort_values('markov_model', ascending=True)
+
+    # ESTIMATE TRANSITION MATRIX in ORDER = 1
+    progress(2, 3, 'transition matrix')
+    if transitions is not None:
+        T = transitions
+    elif engine == 'native':
+        T = attribution.transition_matrix(Data, "path_clean", "converters", var_null = "nonconverters")
+    else:
+        T = CA.transition_matrix(Data, "path_clean", "converters", var_null = "nonconverters", flg_adv = False)
+
+    progress(3, 3, 'done')
+    return R, Auto_M['removal_effects'].sort_values('removal_effect'), Auto_M['transition_matrix'], T
+
+
+# run_models output for the native engine and a fixed Markov order from
+# attribution.ModelCounts (ingest.Snapshot.model_counts) instead of the paths:
+# the counts are additive, so after an ingest nothing is refitted on the
+# distinct paths. transitions is the order 1 transition matrix run_models returns
+def models_from_counts(counts, transitions, progress=None):
+    progress = progress or (lambda step, total, label: None)
+    progress(0, 1, 'models from counts')
+    fit, removal = counts.conversions()
+    R = pd.DataFrame(fit.T, columns=["first_touch","last_touch","linear_touch","markov_model","shapley"])
+    R.insert(0, "channel", counts.channels)
+    R = R.sort_values('markov_model', ascending=True)
+    RE = pd.DataFrame({'channel_name': counts.channels, 'removal_effect': removal})
+    TM = attribution.transition_tables(counts.transitions, counts.channels)['transition_matrix']
+    progress(1, 1, 'done')
+    return R, RE.sort_values('removal_effect'), TM, transitions
+
+
+# short hash of the columns the models read, so cached results are
+# dropped as soon as the underlying data changes
+def data_fingerprint(Data, columns=("path_clean", "converters", "nonconverters")):
+    hashed = pd.util.hash_pandas_object(Data[list(columns)], index=False).values
+    return hashlib.sha1(hashed.tobytes()).hexdigest()[:16]
+
+
+### ----- ----- ----- ----- -----
+### ----- model result cache -----
+### ----- ----- ----- ----- -----
+
+# LRU cache of run_models results keyed by (data fingerprint, filter) for
+# one model engine and Markov order setting.
+# With cache_dir set, results are also pickled to disk so that gunicorn
+# workers and restarts pick up what another process already fitted, and
+# claim() lets one process at a time fit an entry: an exclusive flock on a
+# .claim file next to the pickle, held until release() and dropped by the
+# OS if the process dies. Without cache_dir (or fcntl) every process fits
+# on its own.
+class ModelCache:
+    def __init__(self, maxsize=8, cache_dir=None, engine='ChannelAttribution', markov=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.engine = engine
+        self.markov = markov
+        self._entries = OrderedDict()
+        self._claims = {}
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        fingerprint, filter_key = key
+        return os.path.join(self.cache_dir, "models_v{}_{}_{}_{}_{}.pkl".format(
+            RESULT_VERSION, self.engine, markov_tag(self.markov), fingerprint, filter_key))
+
+    def _load(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _save(self, key, value):
+        if not self.cache_dir:
+            return
+        # write to a temp file first so other workers never read a partial pickle
+        path = self._path(key)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def _put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def lookup(self, fingerprint, filter_key):
+        key = (fingerprint, filter_key)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = self._load(key)
+        if value is not None:
+            self._put(key, value)
+        return value
+
+    def store(self, fingerprint, filter_key, value):
+        key = (fingerprint, filter_key)
+        self._put(key, value)
+        self._save(key, value)
+
+    # True when this process may fit the entry: it holds the claim (now or
+    # already), False while another process does
+    def claim(self, fingerprint, filter_key):
+        key = (fingerprint, filter_key)
+        if not self.cache_dir or fcntl is None:
+            return True
+        with self._lock:
+            if key in self._claims:
+                return True
+            fd = os.open(self._path(key) + ".claim", os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            self._claims[key] = fd
+            return True
+
+    # give up the claim once the entry is stored (or the fit failed); the
+    # file stays, removing it could let two processes lock different files
+    def release(self, fingerprint, filter_key):
+        with self._lock:
+            fd = self._claims.pop((fingerprint, filter_key), None)
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    # return the cached result, fitting the models only on a miss
+    def get(self, fingerprint, filter_key, Data):
+        value = self.lookup(fingerprint, filter_key)
+        if value is None:
+            value = run_models(Data, self.engine, markov=self.markov)
+            self.store(fingerprint, filter_key, value)
+        return value
+
+    def warm_up(self, fingerprint, datasets):
+        for filter_key, Data in datasets.items():
+            self.get(fingerprint, filter_key, Data)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# short name of a Markov order setting for cache file names, e.g. auto10, k3, variable4m100
+def markov_tag(markov=None):
+    markov = markov or {}
+    order = markov.get('order', 'auto')
+    if order == 'variable':
+        return 'variable{}m{}'.format(markov.get('max_order', 10), markov.get('min_count', 100))
+    if order in MARKOV_ORDERS:
+        return '{}{}'.format(order, markov.get('max_order', 10))
+    return 'k{}'.format(int(order))
@@ -0,0 +1,76 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from compact import CompactPaths
+from aggregates import build_cube, merge_cubes
+
+
+### ----- ----- ----- ----- -----
+### ----- parallel preprocessing -----
+### ----- ----- ----- ----- -----
+# The rows are cut into `workers` contiguous partitions and every partition
+# is processed by a forked worker, which reads the parent's data through
+# fork's copy-on-write pages; tasks only carry the row range and only the
+# compact results travel back. Partition results are merged in row order:
+# the derived columns are concatenated and the partial cubes summed with
+# merge_cubes (integer sums, sorted groups), so everything is bit-identical
+# to the serial computation whatever the number of workers.
+# Without the fork start method (or with workers <= 1) everything runs
+# serially in this process.
+
+_shared = {}
+_lock = threading.Lock()
+
+
+def _bounds(n, parts):
+    edges = np.linspace(0, n, parts + 1).astype(np.int64)
+    return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
+def _compact_part(bounds):
+    start, stop = bounds
+    return CompactPaths.from_frame(_shared['source'].iloc[start:stop])
+
+
+def _cube_part(bounds):
+    start, stop = bounds
+    return build_cube(_shared['source'].frame(slice(start, stop)))
+
+
+# fn over the partitions of source in worker processes, results in row order
+def _map(fn, source, n, workers):
+    bounds = _bounds(n, workers)
+    parallel = workers > 1 and len(bounds) > 1 and 'fork' in multiprocessing.get_all_start_methods()
+    with _lock:
+        _shared['source'] = source
+        try:
+            if not parallel:
+                return [fn(b) for b in bounds]
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                return list(pool.map(fn, bounds))
+        finally:
+            _shared.clear()
+
+
+# workers from a PREPROCESS_WORKERS-style setting: 0 means every core
+def worker_count(value):
+    value = int(value)
+    return value if value > 0 else os.cpu_count() or 1
+
+
+# CompactPaths.from_frame(Data), one partition per worker
+def compact_from_frame(Data, workers=1):
+    if workers <= 1 or len(Data) == 0:
+        return CompactPaths.from_frame(Data)
+    return CompactPaths.concat(_map(_compact_part, Data, len(Data), workers))
+
+
+# build_cube(paths.frame()), one partial cube per worker
+def cube_from_paths(paths, workers=1):
+    if workers <= 1 or len(paths) == 0:
+        return build_cube(paths.frame())
+    return merge_cubes(*_map(_cube_part, paths, len(paths), workers))
@@ -0,0 +1,226 @@
+import os
+import re
+import gzip
+import json
+import base64
+import functools
+
+import numpy as np
+import plotly.io as pio
+import plotly.graph_objects as go
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# plotly.js reads base64 typed arrays ({'dtype', 'bdata'}) since 2.28.0
+TYPED_ARRAYS_SINCE = (2, 28, 0)
+_SHORT = {'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'uint16': 'u2',
+          'int32': 'i4', 'uint32': 'u4', 'float32': 'f4', 'float64': 'f8'}
+_DTYPE = {short: np.dtype(name) for name, short in _SHORT.items()}
+# attributes that are never data arrays (plotly skips the same ones)
+_NOT_DATA = ('range', 'domain', 'geojson', 'layer', 'layers')
+# python lists this long or longer are data arrays (info arrays like
+# [x0, x1] stay lists)
+_MIN_LIST = 16
+
+
+### ----- ----- ----- ----- -----
+### ----- figure payloads -----
+### ----- ----- ----- ----- -----
+# The callbacks return plotly figures, which Dash sends as JSON. Two things
+# make that JSON larger than the figure:
+#   numbers      every numeric array as a JSON list; plotly.js 2.28+ also
+#                reads base64 typed arrays (plotly >= 6 writes them for
+#                numpy arrays whatever plotly.js dcc.Graph bundles)
+#   template     every figure carries its layout.template, ~7 kB for the
+#                default 'plotly' one, mostly defaults of trace types the
+#                dashboard never draws
+# FigureCompactor turns the figures of a callback into plain dicts with
+# every numeric data array either a typed array in the narrowest dtype
+# holding it exactly (integral floats as integers) or, for a plotly.js
+# without them, a list; and slim_template is the 'plotly' template cut
+# down to the trace types and layout parts the dashboard figures use,
+# registered once and set as the default of every figure.
+
+class FigureCompactor:
+    def __init__(self, typed_arrays=True):
+        self.typed_arrays = typed_arrays
+
+    # a figure as the dict dcc.Graph receives
+    def figure(self, fig):
+        fig = fig.to_plotly_json() if isinstance(fig, go.Figure) else fig
+        out = {'data': [self.arrays(trace) for trace in fig.get('data', [])],
+               'layout': _walk(fig.get('layout', {}), False)}
+        if fig.get('frames'):
+            out['frames'] = _walk(fig['frames'], False)
+        return out
+
+    # the numeric arrays of any value (a trace, a Patch value) encoded
+    def arrays(self, value):
+        return _walk(value, self.typed_arrays)
+
+    # decorator for Dash callbacks, below @metrics.instrument(): every
+    # go.Figure in the return value is sent through figure()
+    def compact(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            out = fn(*args, **kwargs)
+            if isinstance(out, tuple):
+                return tuple(self.figure(v) if isinstance(v, go.Figure) else v for v in out)
+            return self.figure(out) if isinstance(out, go.Figure) else out
+        return wrapper
+
+
+# a numeric array as a typed array spec, or as a list when that is shorter
+def encode_array(values):
+    v = _integral(np.asarray(values))
+    if v.dtype.kind in 'iu':
+        v = v.astype(_narrowest(v))
+    elif v.dtype.kind != 'f':
+        return v.tolist()
+    v = np.ascontiguousarray(v, dtype=v.dtype.newbyteorder('<'))
+    spec = {'dtype': _SHORT[str(v.dtype.newbyteorder('='))], 'bdata': base64.b64encode(v).decode('ascii')}
+    if v.ndim > 1:
+        spec['shape'] = ','.join(map(str, v.shape))
+    if v.size < 16 and len(json.dumps(spec)) >= len(json.dumps(v.tolist())):
+        return v.tolist()
+    return spec
+
+
+# a typed array spec as an ndarray
+def decode_array(spec):
+    v = np.frombuffer(base64.b64decode(spec['bdata']), dtype=_DTYPE[spec['dtype']].newbyteorder('<'))
+    if 'shape' in spec:
+        v = v.reshape([int(n) for n in str(spec['shape']).split(',')])
+    return v
+
+
+# a numeric array as a list, integral floats as integers
+def list_array(values):
+    return _integral(np.asarray(values)).tolist()
+
+
+# float arrays holding only whole numbers as int64
+def _integral(v):
+    if v.dtype.kind == 'f' and v.size and np.isfinite(v).all() and (v == np.round(v)).all() \
+            and np.abs(v).max() < 2**53:
+        return v.astype(np.int64)
+    return v
+
+
+def _narrowest(v):
+    lo, hi = (int(v.min()), int(v.max())) if v.size else (0, 0)
+    for dtype in ([np.uint8, np.uint16, np.uint32] if lo >= 0 else []) + [np.int8, np.int16, np.int32]:
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return dtype
+    return np.float64
+
+
+def _is_numbers(values):
+    return all(isinstance(x, (int, float, np.number)) and not isinstance(x, (bool, np.bool_))
+                                   for x in values)
+
+
+# typed: encode the numeric arrays (ndarrays and lists of numbers), else
+# make them lists, decoding typed arrays plotly wrote
+def _walk(value, typed):
+    if isinstance(value, dict):
+        if 'bdata' in value and 'dtype' in value:
+            return encode_array(decode_array(value)) if typed else list_array(decode_array(value))
+        return {k: _walk(v, typed and k not in _NOT_DATA) for k, v in value.items()}
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind in 'iuf':
+            return encode_array(value) if typed else list_array(value)
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        if typed and len(value) >= _MIN_LIST and _is_numbers(value):
+            return encode_array(value)
+        return [_walk(v, typed) for v in value]
+    return value
+
+
+# (major, minor, patch) of the plotly.js dash serves to dcc.Graph, None when unknown
+def bundled_plotlyjs_version():
+    from dash import dcc
+    try:
+        with open(os.path.join(os.path.dirname(dcc.__file__), 'plotly.min.js'), 'rb') as f:
+            head = f.read(512).decode('ascii', 'replace')
+    except OSError:
+        return None
+    match = re.search(r'plotly\.js v(\d+)\.(\d+)\.(\d+)', head)
+    return tuple(int(n) for n in match.groups()) if match else None
+
+
+# FIGURE_TYPED_ARRAYS setting: 'auto' when the bundled plotly.js reads them
+def typed_arrays_enabled(setting='auto'):
+    if setting != 'auto':
+        return setting != '0'
+    version = bundled_plotlyjs_version()
+    return version is not None and version >= TYPED_ARRAYS_SINCE
+
+
+### ----- slim template -----
+# the 'plotly' template with the defaults of these trace types and these
+# layout parts only (cartesian axes, colors, fonts, hover, shapes and
+# annotations); the figures look the same, the template shrinks ~8x
+TEMPLATE_TRACES = ('bar', 'scatter', 'pie', 'sankey')
+TEMPLATE_LAYOUT = ('autotypenumbers', 'colorway', 'font', 'hovermode', 'hoverlabel', 'paper_bgcolor',
+                   'plot_bgcolor', 'xaxis', 'yaxis', 'shapedefaults', 'annotationdefaults', 'title')
+
+
+def slim_template(base='plotly'):
+    full = pio.templates[base].to_plotly_json()
+    return go.layout.Template(
+        data={k: v for k, v in full.get('data', {}).items() if k in TEMPLATE_TRACES},
+        layout={k: v for k, v in full.get('layout', {}).items() if k in TEMPLATE_LAYOUT})
+
+
+### ----- ----- ----- ----- -----
+### ----- response compression -----
+### ----- ----- ----- ----- -----
+# after_request hook of the Flask server: responses of a compressible type
+# over min_size bytes are sent brotli (when the brotli package is
+# installed) or gzip encoded, whichever the client accepts first in that
+# order. The Dash component bundles (plotly.min.js is ~3.5 MB) never change
+# for a given URL, so they are compressed once per encoding and kept.
+COMPRESSIBLE = ('application/json', 'application/javascript', 'text/javascript', 'text/css', 'text/html',
+                'text/plain', 'image/svg+xml')
+STATIC_PREFIX = '/_dash-component-suites/'
+
+
+def compress_responses(server, level=6, min_size=1024, encodings=('br', 'gzip')):
+    encodings = [e for e in encodings if e == 'gzip' or (e == 'br' and brotli is not None)]
+    static = {}
+
+    @server.after_request
+    def compress(response):
+        encoding = next((e for e in encodings if request.accept_encodings[e]), None)
+        if (encoding is None or response.direct_passthrough or response.status_code != 200
+                or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE):
+            return response
+        body = response.get_data()
+        if len(body) < min_size:
+            return response
+        if request.path.startswith(STATIC_PREFIX):
+            key = (request.path, encoding)
+            if key not in static:
+                static[key] = _compress(body, encoding, level)
+            data = static[key]
+        else:
+            data = _compress(body, encoding, level)
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+    return compress
+
+
+# brotli quality 0-11, gzip level 1-9: level is mapped to the same share of the range
+def _compress(body, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(body, quality=min(11, round(level * 11 / 9)))
+    return gzip.compress(body, compresslevel=level)
@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+
+## creat mapping for channel names
+CHANNEL_MAP = {'A_FTV-DIS':'Awareness Fire TV Display Ads',
+    'A_SA': 'Awareness Search Ads',
+    'C_OLV': 'Consideration Online Video Ads',
+    'C_DSP-DIS': 'Consideration DSP Display Ads',
+    'P_DSP-DIS': 'Purchase DSP Display Ads',
+    'P_SP': 'Purchase Sponsored Products Ads',
+    'P_OO-SA': 'Purchase O&O Search Ads'}
+
+PATH_SEP = " > "
+
+
+# function to convert str_path to the required format for ChannelAttribute
+# (row by row version, kept as the reference for paths_to_clean)
+def str_to_path(str_path):
+    touchpoints = str_path.split("@")
+    arr = [None] * len(touchpoints)
+    for tp in touchpoints:
+        i, ch = tp.split('&')
+        i = int(i) - 1
+        arr[i] = CHANNEL_MAP[ch]
+    return " > ".join(str(x) for x in arr)
+
+
+CHANNEL_CODES = {code: i for i, code in enumerate(CHANNEL_MAP)}
+# external names by code, with the "None" str_to_path prints for a missing position last
+CHANNEL_NAMES = np.array(list(CHANNEL_MAP.values()) + ["None"], dtype=object)
+_MISSING = len(CHANNEL_MAP)
+
+
+# vectorized str_to_path over a whole column.
+# the column is parsed as one byte buffer (see encode_str_paths) and the
+# channels are scattered into a (rows x max path length) grid of channel
+# codes, so out-of-order, repeated or missing positions end up exactly where
+# str_to_path puts them. Output strings are only built once per distinct
+# coded path. Rows are processed in batches to bound the grid.
+def paths_to_clean(str_path, batch_size=1_000_000):
+    str_path = pd.Series(str_path)
+    out = np.empty(len(str_path), dtype=object)
+    for start in range(0, len(str_path), batch_size):
+        out[start:start + batch_size] = _paths_to_clean_batch(str_path.iloc[start:start + batch_size].tolist())
+    return pd.Series(out, index=str_path.index, name='path_clean')
+
+
+def _paths_to_clean_batch(str_path):
+    if not str_path:
+        return np.empty(0, dtype=object)
+    grid, n_tp = encode_str_paths(str_path)
+    out = np.empty(len(str_path), dtype=object)
+    for L in np.unique(n_tp):
+        rows = np.flatnonzero(n_tp == L)
+        uniq, inverse = unique_rows(grid[rows, :L])
+        names = np.array([PATH_SEP.join(CHANNEL_NAMES[u]) for u in uniq], dtype=object)
+        out[rows] = names[inverse]
+    return out
+
+
+# distinct rows of a code grid; rows short enough are packed into one
+# base-9 int64 key so a 1-d unique can be used
+def unique_rows(codes):
+    if codes.shape[1] > 19:
+        uniq, inverse = np.unique(codes, axis=0, return_inverse=True)
+        return uniq, inverse.ravel()
+    key = np.zeros(len(codes), dtype=np.int64)
+    for j in range(codes.shape[1]):
+        key = key * 9 + codes[:, j]
+    inverse, key_uniq = pd.factorize(key)
+    first = np.zeros(len(key_uniq), dtype=np.int64)
+    first[inverse[::-1]] = np.arange(len(key) - 1, -1, -1)
+    return codes[first], inverse
+
+
+# all values as one uint8 buffer, one row per line, and the offset of each
+# row's closing "\n"
+def _byte_rows(values):
+    if not values:
+        return np.empty(0, dtype=np.uint8), np.empty(0, dtype=np.int64)
+    buf = np.frombuffer(("\n".join(values) + "\n").encode(), dtype=np.uint8)
+    return buf, np.flatnonzero(buf == ord("\n"))
+
+
+# occurrences of a single character in each value
+def _count(values, char):
+    buf, row_ends = _byte_rows(values)
+    hits = np.flatnonzero(buf == ord(char))
+    return np.diff(np.searchsorted(hits, row_ends), prepend=0)
+
+
+# parse a list of str_path into a (rows x max length) int8 grid of channel
+# codes in position order (missing positions get len(CHANNEL_MAP)) and the
+# number of touchpoints per row.
+# touchpoint boundaries, positions and channel codes are all located with
+# array operations on the raw bytes; only the handful of distinct channel
+# codes (and positions that are not plain digits) go through python.
+def encode_str_paths(str_path):
+    buf, row_ends = _byte_rows(str_path)
+    tp_end = np.flatnonzero((buf == ord("@")) | (buf == ord("\n")))
+    tp_start = np.concatenate([[0], tp_end[:-1] + 1])
+    amp = np.flatnonzero(buf == ord("&"))
+    if len(amp) != len(tp_end) or ((amp < tp_start) | (amp >= tp_end)).any():
+        raise ValueError("every touchpoint must look like '<position>&<channel>'")
+
+    row = np.searchsorted(row_ends, tp_end)
+    n_tp = np.bincount(row, minlength=len(str_path))
+    position = _parse_positions(buf, tp_start, amp) - 1
+    channel = _parse_channels(buf, amp + 1, tp_end)
+
+    # negative positions wrap around like a python list index
+    length = n_tp[row]
+    position = np.where(position < 0, position + length, position)
+    if ((position < 0) | (position >= length)).any():
+        raise IndexError("touchpoint position out of range")
+
+    grid = np.full((len(str_path), n_tp.max()), _MISSING, dtype=np.int8)
+    grid[row, position] = channel
+    return grid, n_tp
+
+
+# integer value of buf[start:end] for every touchpoint
+def _parse_positions(buf, start, end):
+    width = end - start
+    value = np.zeros(len(start), dtype=np.int64)
+    plain = width > 0
+    for k in range(width.max()):
+        inside = k < width
+        digit = buf[np.where(inside, start + k, 0)].astype(np.int64) - ord("0")
+        plain &= ~inside | ((digit >= 0) & (digit <= 9))
+        value = np.where(inside, value * 10 + digit, value)
+    # signs, spaces, ... are left to int() like in str_to_path
+    for i in np.flatnonzero(~plain):
+        value[i] = int(buf[start[i]:end[i]].tobytes().decode())
+    return value
+
+
+# channel code of buf[start:end] for every touchpoint: the code bytes are
+# packed into two uint64 words and compared against the known codes
+def _parse_channels(buf, start, end):
+    width = end - start
+    chars = np.zeros((len(start), 16), dtype=np.uint8)
+    for k in range(min(width.max(), 16)):
+        chars[:, k] = np.where(k < width, buf[np.minimum(start + k, len(buf) - 1)], 0)
+    words = chars.view(np.uint64)
+
+    channel = np.full(len(start), -1, dtype=np.int8)
+    for code, idx in CHANNEL_CODES.items():
+        packed = np.frombuffer(code.encode().ljust(16, b"\0"), dtype=np.uint64)
+        channel[(words[:, 0] == packed[0]) & (words[:, 1] == packed[1]) & (width == len(code))] = idx
+    unknown = np.flatnonzero(channel < 0)
+    if len(unknown):
+        i = unknown[0]
+        raise KeyError(buf[start[i]:end[i]].tobytes().decode())
+    return channel
+
+
+# number of touchpoints in each path
+def channels_count(str_path):
+    str_path = pd.Series(str_path)
+    return pd.Series(_count(str_path.tolist(), "&"), index=str_path.index)
+
+
+# number of users aggregated on each path row
+def users_count(user_id):
+    user_id = pd.Series(user_id)
+    return pd.Series(_count(user_id.tolist(), " ") + 1, index=user_id.index)
+
+
+# add all derived columns used by the dashboard
+def preprocess(Data):
+    Data['channels_count'] = channels_count(Data.str_path)
+    Data['users_count'] = users_count(Data.user_id)
+    Data['path_clean'] = paths_to_clean(Data.str_path)
+    return Data
@@ -0,0 +1,147 @@
+import numpy as np
+import pandas as pd
+
+import attribution
+from aggregates import build_cube
+from bootstrap import MODELS
+from preprocess import CHANNEL_NAMES
+
+# two-sided 95% Student t quantiles by degrees of freedom
+_T975 = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262, 10: 2.228}
+
+
+### ----- ----- ----- ----- -----
+### ----- stratified preview sample -----
+### ----- ----- ----- ----- -----
+# A sample of journeys (one converter or nonconverter of a path row) drawn
+# once at load time, stratified by the cube keys (channels_count,
+# first_touch, last_touch): every stratum gets a share of the `size`
+# journeys proportional to its journeys (at least one draw), and within a
+# stratum journeys are drawn uniformly, i.e. rows with probability
+# proportional to converters + nonconverters, converting as often as the
+# row does. The draws are split into `replicates` independent samples of
+# size / replicates journeys each.
+# A statistic is computed on every replicate and expanded to the data
+# (each draw of stratum h stands for journeys_h / draws_h journeys); the
+# preview is the mean over the replicates and its 95% bounds come from
+# their spread (mean +- t * sd / sqrt(replicates)). A channel count filter
+# is the strata of its counts, so one sample serves every filter.
+
+class PreviewSample:
+    def __init__(self, paths, rows, replicate, converters, nonconverters, weight, replicates):
+        self.paths = paths
+        self.rows = rows
+        self.replicate = replicate
+        self.converters = converters
+        self.nonconverters = nonconverters
+        self.weight = weight
+        self.replicates = replicates
+
+    @classmethod
+    def build(cls, paths, size=20_000, replicates=5, seed=0):
+        rng = np.random.default_rng(seed)
+        K = len(CHANNEL_NAMES)
+        key = (paths.channels_count.astype(np.int64) * K + paths.first_touch) * K + paths.last_touch
+        _, stratum = np.unique(key, return_inverse=True)
+        journeys = paths.converters.astype(np.int64) + paths.nonconverters
+        order = np.argsort(stratum, kind='stable')
+        ends = np.cumsum(journeys[order])
+        totals = np.bincount(stratum, weights=journeys).astype(np.int64)
+        starts = np.cumsum(totals) - totals
+        per_replicate = max(size // replicates, 1)
+        draws = np.where(totals > 0, np.maximum(np.rint(per_replicate * totals / max(totals.sum(), 1)), 1), 0)
+        draws = draws.astype(np.int64)
+
+        # every replicate draws draws[h] journeys of stratum h; journey j of
+        # the stratum is in row order[i] when ends[i-1] <= starts[h] + j < ends[i]
+        h = np.tile(np.repeat(np.arange(len(totals)), draws), replicates)
+        replicate = np.repeat(np.arange(replicates), draws.sum())
+        position = starts[h] + np.floor(rng.random(len(h)) * totals[h]).astype(np.int64)
+        i = np.searchsorted(ends, position, side='right')
+        row = order[i]
+        converted = position - (ends[i] - journeys[row]) < paths.converters[row]
+
+        # draws summed per (replicate, row)
+        uniq, inverse = np.unique(replicate.astype(np.int64) * len(paths) + row, return_inverse=True)
+        conv = np.bincount(inverse, weights=converted, minlength=len(uniq)).astype(np.int64)
+        null = np.bincount(inverse, weights=~converted, minlength=len(uniq)).astype(np.int64)
+        rows = uniq % len(paths)
+        weight = totals[stratum[rows]] / draws[stratum[rows]]
+        return cls(paths, rows, (uniq // len(paths)).astype(np.int16), conv, null, weight, replicates)
+
+    # journeys drawn per replicate
+    @property
+    def size(self):
+        return int(self.converters.sum() + self.nonconverters.sum()) // self.replicates
+
+    def _select(self, r, counts):
+        keep = self.replicate == r
+        if counts is not None:
+            keep &= np.isin(self.paths.channels_count[self.rows], np.asarray(counts))
+        return np.flatnonzero(keep)
+
+    # the aggregate cube of every replicate, counts expanded to the data
+    def cubes(self, counts=None):
+        out = []
+        for r in range(self.replicates):
+            sel = self._select(r, counts)
+            frame = self.paths.frame(self.rows[sel])
+            frame['converters'] = self.converters[sel] * self.weight[sel]
+            frame['nonconverters'] = self.nonconverters[sel] * self.weight[sel]
+            out.append(build_cube(frame))
+        return out
+
+    # the model input (distinct paths, sampled counts) of every replicate
+    def model_inputs(self, counts=None):
+        return [self.paths.model_input(self.rows[sel], self.converters[sel], self.nonconverters[sel])
+                for sel in (self._select(r, counts) for r in range(self.replicates))]
+
+
+# mean and 95% bounds over the replicate values (replicates x ...)
+def replicate_bounds(values):
+    values = np.asarray(values, dtype=float)
+    R = len(values)
+    mean = values.mean(axis=0)
+    if R < 2:
+        return mean, np.full(mean.shape, np.nan), np.full(mean.shape, np.nan)
+    t = _T975.get(R - 1, 1.96 + 2.84 / (R - 1))
+    half = t * values.std(axis=0, ddof=1) / np.sqrt(R)
+    return mean, mean - half, mean + half
+
+
+# preview of run_models' R from the replicate model inputs: the native
+# heuristic, Markov and Shapley models per replicate, scaled so every model
+# attributes total_conversions (the exact conversions of the filter, known
+# from the cube), with replicate bounds in the bootstrap_intervals format.
+# The Markov order is chosen once on the pooled sample, up to max_order
+# (sampling error dominates the error of a lower order, see
+# benchmarks/bench_preview.py, and the high orders cost the most)
+def preview_models(inputs, total_conversions, markov=None, max_order=3, progress=None):
+    progress = progress or (lambda step, total, label: None)
+    markov = dict(markov or {})
+    if str(markov.get('order', 'auto')).isdigit():
+        markov['order'] = min(int(markov['order']), max_order)
+    else:
+        markov['max_order'] = min(int(markov.get('max_order', 10)), max_order)
+    pooled = pd.concat(inputs).groupby('path_clean', as_index=False, sort=False)[['converters', 'nonconverters']].sum()
+    order, min_count = attribution.select_order(pooled, 'path_clean', 'converters', 'nonconverters', **markov)
+    encoded = [attribution.encode_paths(Data, 'path_clean', 'converters', 'nonconverters') for Data in inputs]
+    channels = sorted(set(ch for paths in encoded for ch in paths.channels))
+    fits = []
+    for r, paths in enumerate(encoded):
+        progress(r, len(inputs), 'preview replicates')
+        first, last, linear = attribution.heuristic_conversions(paths)
+        markov_conv, _, _ = attribution.markov_conversions(paths, order, min_count)
+        fit = np.vstack([first, last, linear, markov_conv, attribution.shapley_conversions(paths)])
+        fit *= total_conversions / max(paths.converters.sum(), 1)
+        fits.append(pd.DataFrame(fit.T, index=paths.channels, columns=MODELS).reindex(channels, fill_value=0))
+    progress(len(inputs), len(inputs), 'done')
+
+    mean, lower, upper = replicate_bounds([f.to_numpy() for f in fits])
+    R = pd.DataFrame(mean, columns=MODELS).assign(channel=channels)
+    R = R[['channel', 'first_touch', 'last_touch', 'linear_touch', 'markov_model', 'shapley']]
+    intervals = pd.concat([pd.DataFrame({'channel': channels, 'model': model, 'estimate': mean[:, m],
+                                         'lower': lower[:, m], 'upper': upper[:, m],
+                                         'n_resamples': len(fits)})
+                           for m, model in enumerate(MODELS)], ignore_index=True)
+    return R.sort_values('markov_model', ascending=True), intervals
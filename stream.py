@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import argparse
+
+import pandas as pd
+import pyarrow.feather as feather
+
+import attribution
+from compact import CompactPaths
+from aggregates import SankeyTable, build_cube, cube_slice, merge_cubes, touch_stats, channel_count_stats
+
+# the MTA_Input.csv columns CompactPaths.from_frame reads
+STREAM_COLUMNS = ['str_path', 'user_id', 'converters', 'nonconverters', 'first_touch', 'last_touch']
+
+
+### ----- ----- ----- ----- -----
+### ----- streaming aggregation -----
+### ----- ----- ----- ----- -----
+# For inputs that do not fit in memory: the CSV is read chunksize rows at a
+# time, every chunk is parsed into compact.CompactPaths (the vectorized
+# str_to_path) and reduced to a PartialResult, and the partial results are
+# merged as they come. A PartialResult holds
+#   cube          converters / nonconverters / paths by (channels_count,
+#                 first_touch, last_touch): the first/last touch stats, the
+#                 channel-count stats and the Sankey links are all sums over it
+#   transitions   {channel count: (TransitionCounts, channels)} of the
+#                 Markov model of the given order
+# Both are additive and their size depends on the channels, orders and
+# path lengths seen, not on the number of rows, so memory stays bounded by
+# one chunk plus the merged result. Merging is associative: chunks can be
+# reduced in any grouping (e.g. by several processes) and give the same sums.
+
+class PartialResult:
+    def __init__(self, rows, cube, transitions, order=1):
+        self.rows = rows
+        self.cube = cube
+        self.transitions = transitions
+        self.order = order
+
+    @classmethod
+    def from_paths(cls, paths, order=1):
+        index = paths.count_index()
+        transitions = {}
+        for c in index.counts:
+            table = paths.path_table(index.rows([c]))
+            transitions[int(c)] = (attribution.count_transitions(table, order), table.channels)
+        return cls(len(paths), build_cube(paths.frame()), transitions, order)
+
+    def merge(self, other):
+        if self.order != other.order:
+            raise ValueError("cannot merge order {} and order {} results".format(self.order, other.order))
+        transitions = dict(self.transitions)
+        for c, counts in other.transitions.items():
+            transitions[c] = attribution.merge_transitions(*transitions[c], *counts) if c in transitions else counts
+        return PartialResult(self.rows + other.rows, merge_cubes(self.cube, other.cube), transitions, self.order)
+
+    # transition counts of the given channel counts (None for all), merged
+    def merged_transitions(self, counts=None):
+        buckets = [self.transitions[c] for c in sorted(self.transitions) if counts is None or c in counts]
+        merged, channels = buckets[0]
+        for other in buckets[1:]:
+            merged, channels = attribution.merge_transitions(merged, channels, *other)
+        return merged, channels
+
+    def touch_stats(self, touch, counts=None):
+        return touch_stats(cube_slice(self.cube, counts), touch)
+
+    def channel_count_stats(self):
+        return channel_count_stats(self.cube)
+
+    def sankey(self, counts=None):
+        return SankeyTable(cube_slice(self.cube, counts))
+
+    # Markov attribution of the given channel counts, like markov_model
+    # with out_more: result, removal_effects and transition_matrix
+    def markov(self, counts=None):
+        merged, channels = self.merged_transitions(counts)
+        removal = attribution.removal_effects(attribution.conversion_probabilities(merged))
+        total = cube_slice(self.cube, counts)['converters'].sum()
+        return {'result': pd.DataFrame({'channel_name': channels,
+                                        'total_conversions': attribution.removal_conversions(total, removal)}),
+                'removal_effects': pd.DataFrame({'channel_name': channels, 'removal_effect': removal}),
+                'transition_matrix': attribution.transition_tables(merged, channels)['transition_matrix']}
+
+
+# compact.CompactPaths of every chunksize rows of csv_path
+def read_chunks(csv_path, chunksize=1_000_000):
+    with pd.read_csv(csv_path, usecols=STREAM_COLUMNS, chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield CompactPaths.from_frame(chunk)
+
+
+def stream_partials(csv_path, chunksize=1_000_000, order=1):
+    for paths in read_chunks(csv_path, chunksize):
+        yield PartialResult.from_paths(paths, order)
+
+
+# every chunk of csv_path merged into one PartialResult
+def stream_aggregate(csv_path, chunksize=1_000_000, order=1, progress=None):
+    result = None
+    for partial in stream_partials(csv_path, chunksize, order):
+        result = partial if result is None else result.merge(partial)
+        if progress:
+            progress(result.rows)
+    if result is None:
+        raise ValueError("{} has no rows".format(csv_path))
+    return result
+
+
+def _write(df, path):
+    feather.write_feather(df.reset_index(drop=True), path)
+
+
+# the aggregates of export.py that can be streamed, plus the fixed-order
+# Markov model, for the full set and the 'One' / 'Two' filters
+def write_result(result, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    _write(result.cube, os.path.join(out_dir, 'cube.feather'))
+    _write(result.channel_count_stats(), os.path.join(out_dir, 'channel_counts.feather'))
+    all_counts = sorted(result.transitions)
+    for filter_key, counts in [('full', None), ('One', [1]), ('Two', [c for c in all_counts if c != 1])]:
+        if counts is not None and not set(counts) & set(all_counts):
+            continue
+        folder = os.path.join(out_dir, filter_key)
+        os.makedirs(folder, exist_ok=True)
+        stats = pd.concat([result.touch_stats(touch, counts).assign(touch=touch)
+                           for touch in ['first_touch', 'last_touch']])
+        _write(stats, os.path.join(folder, 'touch_stats.feather'))
+        sankey = result.sankey(counts)
+        _write(pd.DataFrame({'first_touch': sankey.first, 'last_touch': sankey.last,
+                             'converters': sankey.conv, 'nonconverters': sankey.nonconv}),
+               os.path.join(folder, 'sankey_links.feather'))
+        markov = result.markov(counts)
+        _write(markov['result'].merge(markov['removal_effects'], on='channel_name'),
+               os.path.join(folder, 'markov.feather'))
+        _write(markov['transition_matrix'], os.path.join(folder, 'transition_matrix.feather'))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="aggregate a journey CSV chunk by chunk with bounded memory")
+    parser.add_argument("csv")
+    parser.add_argument("--out", default="artifacts_stream", help="folder for the Feather files")
+    parser.add_argument("--chunksize", type=int, default=1_000_000, help="rows parsed at a time")
+    parser.add_argument("--order", type=int, default=1, help="order of the Markov transition counts")
+    args = parser.parse_args()
+
+    result = stream_aggregate(args.csv, args.chunksize, args.order,
+                              progress=lambda rows: print('{:,} rows'.format(rows), file=sys.stderr))
+    write_result(result, args.out)
+    print(json.dumps({'rows': result.rows, 'channel_counts': sorted(result.transitions), 'order': args.order}))
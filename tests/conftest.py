@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.join(REPO, 'benchmarks'))
+
+from synthetic import make_paths
+
+
+# synthetic MTA_Input.csv rows (benchmarks/synthetic.py), a share of them
+# with shuffled touchpoint positions
+@pytest.fixture(scope='session')
+def raw():
+    return make_paths(5000, seed=0)
@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from compact import CompactPaths
+from users import UserIndex
+from models import run_models, models_from_counts
+from ingest import Snapshot, SnapshotStore
+
+ORDER = 2
+
+
+@pytest.fixture(scope='module')
+def snapshots(raw):
+    base, batch = raw.iloc[:4000], raw.iloc[4000:]
+    users = UserIndex.from_user_ids(base.user_id)
+    appended = Snapshot.build(CompactPaths.from_frame(base), users=users)
+    # counts of every order the comparison reads, merged on append
+    appended.model_counts('full', ORDER)
+    appended = appended.append(CompactPaths.from_frame(batch), 'batch.csv',
+                               UserIndex.from_user_ids(batch.user_id))
+    fresh = Snapshot.build(CompactPaths.from_frame(raw), users=UserIndex.from_user_ids(raw.user_id))
+    return appended, fresh
+
+
+def filters(snapshot):
+    return ['full', 'One', 'Two', snapshot.filter_key([2, 3])]
+
+
+def assert_models_equal(a, b):
+    R_a, RE_a, _, _ = a
+    R_b, RE_b, _, _ = b
+    R_a, R_b = R_a.set_index('channel').sort_index(), R_b.set_index('channel').sort_index()
+    assert not R_a.isna().any().any()
+    np.testing.assert_allclose(R_a.to_numpy(float), R_b[R_a.columns].to_numpy(float), atol=1e-6)
+    np.testing.assert_allclose(RE_a.set_index('channel_name').sort_index().removal_effect,
+                               RE_b.set_index('channel_name').sort_index().removal_effect, atol=1e-9)
+
+
+def test_append_matches_fresh_build(snapshots):
+    appended, fresh = snapshots
+    assert appended.counts == fresh.counts
+    pd.testing.assert_frame_equal(appended.cube, fresh.cube)
+    for f in filters(fresh):
+        for name, table in fresh.transition_matrix(f).items():
+            pd.testing.assert_frame_equal(appended.transition_matrix(f)[name], table)
+        a, b = appended.model_counts(f, ORDER), fresh.model_counts(f, ORDER)
+        assert list(a.channels) == list(b.channels)
+        for x, y in zip(a.conversions(), b.conversions()):
+            np.testing.assert_allclose(x, y)
+    assert np.array_equal(appended.users.keys, fresh.users.keys)
+    assert np.array_equal(appended.users.rows, fresh.users.rows)
+
+
+def test_models_from_counts_matches_run_models(snapshots):
+    _, fresh = snapshots
+    for f in filters(fresh):
+        counted = models_from_counts(fresh.model_counts(f, ORDER), fresh.transition_matrix(f))
+        fitted = run_models(fresh.model_input(f), 'native', markov={'order': ORDER})
+        assert_models_equal(counted, fitted)
+
+
+def test_empty_batch(snapshots, raw):
+    _, fresh = snapshots
+    empty = fresh.append(CompactPaths.from_frame(raw.iloc[:0]), 'empty.csv', UserIndex.from_user_ids(raw.user_id[:0]))
+    assert len(empty.paths) == len(fresh.paths)
+    pd.testing.assert_frame_equal(empty.cube, fresh.cube)
+    for x, y in zip(empty.model_counts('full', ORDER).conversions(), fresh.model_counts('full', ORDER).conversions()):
+        np.testing.assert_allclose(x, y)
+
+
+# a filter without conversions attributes zero conversions, not NaN
+def test_zero_conversion_filter(raw):
+    Data = raw.copy()
+    Data.loc[Data.str_path.str.count('@') == 0, 'converters'] = 0
+    snapshot = Snapshot.build(CompactPaths.from_frame(Data))
+    assert snapshot.cube_for('One').converters.sum() == 0
+    counted = models_from_counts(snapshot.model_counts('One', ORDER), snapshot.transition_matrix('One'))
+    fitted = run_models(snapshot.model_input('One'), 'native', markov={'order': ORDER})
+    assert_models_equal(counted, fitted)
+    R, RE, _, _ = counted
+    assert (R.drop(columns='channel').to_numpy() == 0).all()
+    assert (RE.removal_effect == 0).all()
+
+
+# a batch that fails to parse is skipped, and retried once it is rewritten
+def test_failed_batch_retried_when_rewritten(raw, tmp_path):
+    store = SnapshotStore(Snapshot.build(CompactPaths.from_frame(raw.iloc[:1000])))
+    csv_path = str(tmp_path / 'b1.csv')
+    with open(csv_path, 'w') as f:
+        f.write('not,a,batch\n')
+    mtime = os.stat(csv_path).st_mtime
+    assert store.ingest_new(str(tmp_path)).batches == ()
+    assert len(store.failed) == 1
+
+    raw.iloc[1000:1100].to_csv(csv_path, index=False)
+    os.utime(csv_path, (mtime, mtime))
+    snapshot = store.ingest_new(str(tmp_path))
+    assert snapshot.batches == ('b1.csv',)
+    assert len(snapshot.paths) == 1100
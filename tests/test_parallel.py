@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+
+from compact import CompactPaths
+from aggregates import build_cube
+from parallel import compact_from_frame, cube_from_paths
+
+ARRAYS = ('codes', 'offsets', 'converters', 'nonconverters', 'users_count', 'first_touch', 'last_touch')
+
+
+def test_compact_from_frame_matches_serial(raw):
+    serial = CompactPaths.from_frame(raw)
+    for workers in (2, 3):
+        parallel = compact_from_frame(raw, workers)
+        for name in ARRAYS:
+            assert np.array_equal(getattr(parallel, name), getattr(serial, name)), name
+
+
+def test_cube_from_paths_matches_serial(raw):
+    paths = CompactPaths.from_frame(raw)
+    serial = build_cube(paths.frame())
+    for workers in (2, 3, 7):
+        pd.testing.assert_frame_equal(cube_from_paths(paths, workers), serial)
+
+
+def test_more_workers_than_rows(raw):
+    few = raw.head(2)
+    pd.testing.assert_frame_equal(cube_from_paths(compact_from_frame(few, 4), 4),
+                                  build_cube(CompactPaths.from_frame(few).frame()))
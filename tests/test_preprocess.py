@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from preprocess import str_to_path, paths_to_clean, channels_count, users_count
+
+
+def test_paths_to_clean_matches_str_to_path(raw):
+    expected = [str_to_path(p) for p in raw.str_path]
+    assert paths_to_clean(raw.str_path).tolist() == expected
+
+
+# out-of-order, duplicate (the later one wins, the position it leaves
+# empty prints as None), negative and zero positions (python list indices)
+@pytest.mark.parametrize('str_path', [
+    '2&A_SA@1&P_SP',
+    '3&C_OLV@1&A_SA@2&P_SP',
+    '1&A_SA@1&P_SP',
+    '1&A_SA@3&P_SP@3&C_OLV',
+    '1&A_SA@-1&P_SP@3&C_OLV',
+    '0&A_SA@2&P_SP',
+    '1&P_OO-SA',
+])
+def test_paths_to_clean_edge_cases(str_path):
+    assert paths_to_clean([str_path]).tolist() == [str_to_path(str_path)]
+
+
+@pytest.mark.parametrize('str_path, error', [
+    ('1&A_SA@5&P_SP', IndexError),
+    ('1&A_SA@-3&P_SP', IndexError),
+    ('1&A_SA@2&NOPE', KeyError),
+])
+def test_paths_to_clean_errors(str_path, error):
+    with pytest.raises(error):
+        str_to_path(str_path)
+    with pytest.raises(error):
+        paths_to_clean([str_path])
+
+
+def test_empty_column():
+    assert len(paths_to_clean([])) == 0
+    assert len(channels_count([])) == 0
+    assert len(users_count([])) == 0
+
+
+def test_counts_match_split(raw):
+    assert np.array_equal(channels_count(raw.str_path), raw.str_path.str.split('@').str.len())
+    assert np.array_equal(users_count(raw.user_id), raw.user_id.str.split(' ').str.len())
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+
+from preprocess import CHANNEL_NAMES
+
+END = '(path ends here)'
+_CODE = {name: code for code, name in enumerate(CHANNEL_NAMES)}
+
+
+### ----- ----- ----- ----- -----
+### ----- path prefix trie -----
+### ----- ----- ----- ----- -----
+# Every prefix of every path is a node; node 0 is the empty prefix. Nodes
+# are numbered depth by depth and, within a depth, by (parent, channel),
+# so the children of a node are the contiguous ids children(node) and a
+# child is found by a binary search over their channel codes:
+#   parent, channel, depth    per node (channel: int8 code into CHANNEL_NAMES)
+#   child_bounds              children of node i are child_bounds[i]:child_bounds[i+1]
+# The sums are kept per (node, channel count of the path), as entries
+# sorted by node, so the statistics of any channel count filter are one
+# bincount over the entries (TrieStats); with those, expanding a node or
+# ranking its continuations only reads its children.
+# The trie is built from the distinct paths (compact.CompactPaths.distinct),
+# one vectorized np.unique per depth.
+
+class PrefixTrie:
+    def __init__(self, parent, channel, depth, entry_node, entry_count, entry_conv, entry_null):
+        self.parent = parent
+        self.channel = channel
+        self.depth = depth
+        self.child_bounds = np.append(np.searchsorted(parent[1:], np.arange(len(parent))) + 1, len(parent))
+        self.entry_node = entry_node
+        self.entry_count = entry_count
+        self.entry_conv = entry_conv
+        self.entry_null = entry_null
+
+    def __len__(self):
+        return len(self.parent)
+
+    @classmethod
+    def from_paths(cls, paths):
+        codes, offsets, conv, null = paths.distinct()
+        starts, lengths = offsets[:-1], np.diff(offsets)
+        K = len(CHANNEL_NAMES)
+        node_of = np.zeros(len(lengths), dtype=np.int64)
+        parents, channels, depths = [np.array([-1])], [np.array([-1])], [np.array([0])]
+        entries = [_entries(node_of, lengths, conv, null)]
+        rows, n_nodes, d = np.arange(len(lengths)), 1, 1
+        while True:
+            rows = rows[lengths[rows] >= d]
+            if not len(rows):
+                break
+            uniq, inverse = np.unique(node_of[rows] * K + codes[starts[rows] + d - 1], return_inverse=True)
+            parents.append(uniq // K)
+            channels.append(uniq % K)
+            depths.append(np.full(len(uniq), d))
+            node_of[rows] = n_nodes + inverse
+            entries.append(_entries(node_of[rows], lengths[rows], conv[rows], null[rows]))
+            n_nodes += len(uniq)
+            d += 1
+        node, count, e_conv, e_null = (np.concatenate(col) for col in zip(*entries))
+        return cls(np.concatenate(parents).astype(np.int32), np.concatenate(channels).astype(np.int8),
+                   np.concatenate(depths).astype(np.int16),
+                   node.astype(np.int32), count.astype(np.int16), e_conv, e_null)
+
+    def children(self, node):
+        return np.arange(self.child_bounds[node], self.child_bounds[node + 1])
+
+    # node of a prefix given as channel names, None when no path starts so
+    def find(self, prefix):
+        node = 0
+        for name in prefix:
+            if name not in _CODE:
+                return None
+            lo, hi = self.child_bounds[node], self.child_bounds[node + 1]
+            i = lo + np.searchsorted(self.channel[lo:hi], _CODE[name])
+            if i >= hi or self.channel[i] != _CODE[name]:
+                return None
+            node = int(i)
+        return node
+
+    # channel names from the root to node
+    def prefix(self, node):
+        names = []
+        while node > 0:
+            names.append(CHANNEL_NAMES[self.channel[node]])
+            node = self.parent[node]
+        return names[::-1]
+
+    # TrieStats of the paths with the given channel counts (None for all)
+    def stats(self, counts=None):
+        keep = slice(None) if counts is None else np.isin(self.entry_count, np.asarray(counts))
+        node, count = self.entry_node[keep], self.entry_count[keep]
+        conv, null = self.entry_conv[keep], self.entry_null[keep]
+        ends = count == self.depth[node]
+        n = len(self)
+        return TrieStats(_sum(node, conv, n), _sum(node, null, n),
+                         _sum(node[ends], conv[ends], n), _sum(node[ends], null[ends], n))
+
+    # the continuations of node under stats: one row per child with
+    # journeys, plus END for the journeys stopping at node, top n by `by`
+    # ('converters', 'journeys' or 'conversion_pct')
+    def continuations(self, node, stats, n=10, by='converters'):
+        kids = self.children(node)
+        df = pd.DataFrame({'node': np.append(kids, -1),
+                           'channel': np.append(CHANNEL_NAMES[self.channel[kids]], END),
+                           'converters': np.append(stats.conv[kids], stats.end_conv[node]),
+                           'nonconverters': np.append(stats.null[kids], stats.end_null[node])})
+        df['journeys'] = df.converters + df.nonconverters
+        df = df[df.journeys > 0].assign(conversion_pct = lambda d: d.converters / d.journeys * 100)
+        return df.sort_values([by, 'journeys'], ascending=False, kind='stable').head(n).reset_index(drop=True)
+
+
+### ----- statistics of one filter -----
+# conv / null: converters / nonconverters of the journeys through a node,
+# end_conv / end_null: of those stopping at it. Arrays indexed by node
+class TrieStats:
+    def __init__(self, conv, null, end_conv, end_null):
+        self.conv = conv
+        self.null = null
+        self.end_conv = end_conv
+        self.end_null = end_null
+
+    # converters, nonconverters, journeys of a node
+    def totals(self, node):
+        conv, null = int(self.conv[node]), int(self.null[node])
+        return conv, null, conv + null
+
+
+def _sum(node, values, n):
+    return np.bincount(node, weights=values, minlength=n).astype(np.int64)
+
+
+# (node, channel count, converters, nonconverters) summed per node and count
+def _entries(node, count, conv, null):
+    width = int(count.max()) + 1 if len(count) else 1
+    keys, inverse = np.unique(node * width + count, return_inverse=True)
+    return keys // width, keys % width, _sum(inverse, conv, len(keys)), _sum(inverse, null, len(keys))
@@ -0,0 +1,123 @@
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+### ----- ----- ----- ----- -----
+### ----- user ID index -----
+### ----- ----- ----- ----- -----
+# Inverted index from user ID to the path rows whose user_id lists it, one
+# entry per (user, row) pair in two parallel arrays sorted by key:
+#   keys    uint64 hash of the user ID (pandas hash_array)
+#   rows    int32 row of the pair, ascending within a key
+# The rows of a user are rows[lo:hi] between the searchsorted bounds of its
+# key, so a cohort of any size is one hash and two binary searches. The
+# index is built from the user_id strings in one vectorized pass (arrow
+# split, hash, stable argsort) and holds no python strings afterwards;
+# data_loader.load_users keeps it in a Feather file next to the data cache.
+# The IDs of 10M users share a 64 bit hash with probability ~3e-6; the rows
+# of two such users would be returned together.
+
+class UserIndex:
+    def __init__(self, keys, rows):
+        self.keys = keys
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.keys)
+
+    # from the user_id column (space separated IDs per row), an arrow or
+    # pandas column of strings; rows are numbered from 0
+    @classmethod
+    def from_user_ids(cls, user_id, batch_size=1_000_000):
+        if not isinstance(user_id, (pa.Array, pa.ChunkedArray)):
+            user_id = pa.array(pd.Series(user_id, dtype=object), pa.string())
+        keys, rows = [np.empty(0, dtype=np.uint64)], [np.empty(0, dtype=np.int64)]
+        for start in range(0, len(user_id), batch_size):
+            chunk = user_id.slice(start, batch_size)
+            lists = pc.split_pattern(chunk.combine_chunks() if isinstance(chunk, pa.ChunkedArray) else chunk, ' ')
+            keys.append(hash_user_ids(pc.list_flatten(lists).to_numpy(zero_copy_only=False)))
+            rows.append(pc.list_parent_indices(lists).to_numpy().astype(np.int64) + start)
+        keys, rows = np.concatenate(keys), np.concatenate(rows)
+        order = np.argsort(keys, kind='stable')
+        return cls(keys[order], _row_array(rows[order]))
+
+    # the pairs of other (a batch, rows numbered from offset on) merged in
+    # by one searchsorted, without sorting again
+    def append(self, other, offset):
+        n = len(self) + len(other)
+        pos = np.searchsorted(self.keys, other.keys, side='right') + np.arange(len(other))
+        mine = np.ones(n, dtype=bool)
+        mine[pos] = False
+        keys, rows = np.empty(n, dtype=np.uint64), np.empty(n, dtype=np.int64)
+        keys[pos], rows[pos] = other.keys, other.rows.astype(np.int64) + offset
+        keys[mine], rows[mine] = self.keys, self.rows
+        return UserIndex(keys, _row_array(rows))
+
+    # (rows, users, found): the rows listing any of user_ids in row order,
+    # the number of those users on each, and how many of user_ids are indexed
+    def lookup(self, user_ids):
+        keys = np.unique(hash_user_ids(user_ids))
+        lo = np.searchsorted(self.keys, keys, side='left')
+        hi = np.searchsorted(self.keys, keys, side='right')
+        n = hi - lo
+        take = np.repeat(lo - np.cumsum(n) + n, n) + np.arange(n.sum())
+        rows, users = np.unique(self.rows[take], return_counts=True)
+        return rows, users, int(np.count_nonzero(n))
+
+
+# uint64 keys of user IDs (strings)
+def hash_user_ids(user_ids):
+    return pd.util.hash_array(np.asarray(user_ids, dtype=object), categorize=False)
+
+
+# user IDs typed or pasted as text: separated by spaces, commas, semicolons or new lines
+def parse_user_ids(text):
+    return list(dict.fromkeys(u for u in re.split(r'[\s,;]+', text or '') if u))
+
+
+def _row_array(rows):
+    return rows.astype(np.int32) if len(rows) and rows.max() < 2**31 else rows
+
+
+### ----- cohorts -----
+# The journeys of a cohort are the path rows listing any of its users. A
+# row aggregates users_count users and only says how many of them
+# converted, so its cohort users take their share users / users_count of
+# its journeys, split with the conversion rate of the row (rounded, the
+# models need whole journeys); all of the row when every one of its users
+# is in the cohort.
+
+class Cohort:
+    def __init__(self, rows, users, converters, nonconverters, requested, found):
+        self.rows = rows
+        self.users = users
+        self.converters = converters
+        self.nonconverters = nonconverters
+        self.requested = requested
+        self.found = found
+
+    # rows and users as returned by UserIndex.lookup (possibly filtered)
+    @classmethod
+    def from_rows(cls, paths, rows, users, requested, found):
+        share = users / np.maximum(paths.users_count[rows], 1)
+        conv, null = paths.converters[rows].astype(np.int64), paths.nonconverters[rows].astype(np.int64)
+        journeys = np.rint((conv + null) * share).astype(np.int64)
+        conv = np.minimum(np.rint(conv * share).astype(np.int64), journeys)
+        return cls(rows, users, conv, journeys - conv, requested, found)
+
+    # path_clean / converters / nonconverters per distinct path of the
+    # cohort, the input of models.run_models
+    def model_input(self, paths):
+        return paths.model_input(self.rows, self.converters, self.nonconverters)
+
+    # the model input with journeys and conversion rate, most journeys first
+    # (paths rounded to no journey left out)
+    def journeys(self, paths):
+        df = self.model_input(paths)
+        df['journeys'] = df.converters + df.nonconverters
+        df = df[df.journeys > 0].assign(conversion_pct = lambda d: d.converters / d.journeys * 100)
+        return df.sort_values(['journeys', 'converters'], ascending=False, kind='stable').reset_index(drop=True)